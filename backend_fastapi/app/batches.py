@@ -0,0 +1,142 @@
+"""
+Batch submissions (POST /api/batches): several recordings, sent as repeated `files` or as
+one ZIP archive, become tasks that share a batch_id and are inserted and scheduled together.
+
+Archive members are decompressed one at a time, chunk by chunk, straight into their task
+directories; neither the archive nor a member is ever held in memory or extracted to a
+scratch directory first. With `combined_email` the tasks of a batch send no notifications
+of their own: the last one to finish queues a single summary email with every DOCX.
+"""
+import logging
+import os
+import zipfile
+import zlib
+from datetime import datetime
+from typing import BinaryIO, List, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import func
+
+from .db import Task, TaskBatch, ACTIVE_STATUSES, session_scope
+from .mailer import queue_batch_email, outbox_sender
+from .uploads import MAX_UPLOAD_BYTES, copy_and_hash
+
+# Recordings accepted in one batch
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", "100"))
+# Request body limit of /api/batches, and the most an archive may unpack to
+BATCH_MAX_BYTES = int(os.environ.get("BATCH_MAX_BYTES", str(4 * MAX_UPLOAD_BYTES)))
+# Archive members with other extensions (notes, thumbnails, .DS_Store, ...) are skipped
+BATCH_AUDIO_EXTENSIONS = {
+    extension.strip().lower().lstrip(".")
+    for extension in os.environ.get(
+        "BATCH_AUDIO_EXTENSIONS", "mp3,m4a,wav,aac,flac,ogg,oga,opus,wma,amr,mp4,mpeg,mpga,webm,3gp"
+    ).split(",")
+    if extension.strip()
+}
+
+_UTF8_NAME_FLAG = 0x800
+_ENCRYPTED_FLAG = 0x1
+
+
+def is_archive(file_name: str) -> bool:
+    return file_name.lower().endswith(".zip")
+
+
+def member_file_name(info: zipfile.ZipInfo) -> str:
+    """
+    Base name of an archive member. zipfile decodes names without the UTF-8 flag as cp437;
+    archives made by the Windows "Send to compressed folder" tool on Chinese systems are GBK.
+    """
+    name = info.filename
+    if not info.flag_bits & _UTF8_NAME_FLAG:
+        try:
+            name = name.encode("cp437").decode("gbk")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return os.path.basename(name.replace("\\", "/"))
+
+
+def open_archive(source: BinaryIO) -> zipfile.ZipFile:
+    try:
+        return zipfile.ZipFile(source)
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Not a valid ZIP archive: {e}")
+
+
+def archive_members(archive: zipfile.ZipFile) -> Tuple[List[Tuple[str, zipfile.ZipInfo]], List[str]]:
+    """
+    The recordings in an archive as (file name, member) pairs in archive order, plus the
+    names of the files skipped for not looking like audio. Only the central directory is read.
+    """
+    members, skipped = [], []
+    for info in archive.infolist():
+        file_name = member_file_name(info)
+        if info.is_dir() or not file_name or info.filename.startswith("__MACOSX/") or file_name.startswith("."):
+            continue
+        if os.path.splitext(file_name)[1].lstrip(".").lower() not in BATCH_AUDIO_EXTENSIONS:
+            skipped.append(file_name)
+            continue
+        if info.flag_bits & _ENCRYPTED_FLAG:
+            raise HTTPException(status_code=400, detail=f"Encrypted archive members are not supported: {file_name}")
+        members.append((file_name, info))
+    if not members:
+        raise HTTPException(status_code=400, detail="The archive contains no audio files.")
+    check_batch_size(len(members), sum(info.file_size for _, info in members))
+    return members, skipped
+
+
+def check_batch_size(file_count: int, total_bytes: int):
+    if file_count > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"A batch holds at most {BATCH_MAX_FILES} recordings, got {file_count}.")
+    if total_bytes > BATCH_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"The batch unpacks to {total_bytes} bytes, more than the limit of {BATCH_MAX_BYTES}.")
+
+
+def extract_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, target_path: str) -> Tuple[int, str]:
+    """
+    Decompress one member to target_path in chunks, hashing on the way; returns (size, sha256).
+    The declared size bounds the copy, so a member can't inflate beyond what was admitted.
+    """
+    try:
+        with archive.open(info) as source:
+            return copy_and_hash(source, target_path, min(info.file_size, MAX_UPLOAD_BYTES))
+    except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+        raise HTTPException(status_code=400, detail=f"Corrupt archive member {member_file_name(info)}: {e}")
+    except NotImplementedError as e: # Compression method zipfile can't read
+        raise HTTPException(status_code=400, detail=f"Unsupported archive member {member_file_name(info)}: {e}")
+
+
+def batch_handles_notification(task_id: str) -> bool:
+    """
+    Called when a task finished (completed, failed, timed out or cancelled). True when its
+    notification is part of its batch's summary email, which is queued here once no task of
+    the batch is left unfinished; False when the task should send its own email. Tasks
+    finishing after the summary was queued (e.g. retried ones) report on their own.
+    """
+    with session_scope() as db:
+        task = db.query(Task).filter(Task.task_id == task_id).first()
+        if not task or not task.batch_id:
+            return False
+        batch = db.query(TaskBatch).filter(TaskBatch.batch_id == task.batch_id).first()
+        if not batch or not batch.combined_email:
+            return False
+        finished_at = task.finish_time or task.last_update_time
+        if batch.notified_at:
+            return finished_at is not None and finished_at <= batch.notified_at
+        unfinished = db.query(func.count(Task.task_id)).filter(
+            Task.batch_id == batch.batch_id, Task.status.in_(ACTIVE_STATUSES)
+        ).scalar()
+        if unfinished:
+            logging.info(f"Task {task_id}: Notification deferred to the batch summary ({unfinished} task(s) of batch {batch.batch_id} still running).")
+            return True
+        # Conditional UPDATE: when the last tasks finish at the same moment, only one queues the summary
+        notified_at = datetime.now()
+        claimed = db.query(TaskBatch).filter(
+            TaskBatch.batch_id == batch.batch_id, TaskBatch.notified_at.is_(None)
+        ).update({TaskBatch.notified_at: notified_at}, synchronize_session=False)
+        if not claimed:
+            return True
+        tasks = db.query(Task).filter(Task.batch_id == batch.batch_id).order_by(Task.submit_time.asc(), Task.file_name.asc()).all()
+        queue_batch_email(db, batch, tasks)
+    outbox_sender.notify()
+    return True
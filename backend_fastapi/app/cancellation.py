@@ -0,0 +1,111 @@
+"""
+Cancellation of running tasks (POST /api/tasks/{task_id}/cancel).
+
+The API records the request in Task.cancel_requested_at; the scheduler of the node running
+the task sees it on its next poll and sets the task's cancellation event here. The scheduler
+also sets it, with LEASE_LOST as the reason, when another node reclaimed the task's lease:
+that run must stop without writing anything, as the task now belongs to the other node. Pipeline
+code checks that event between stages, segments and chunk calls, and waits on it instead
+of sleeping or blocking on futures, so a cancelled task stops within a poll interval.
+
+Calls already sent to the transcription or LLM APIs are blocking calls inside audio2memo
+and can't be interrupted: their threads are abandoned (not waited for, results discarded)
+and no further calls are started. Like the task log tags, the event travels in a
+contextvar, so stage and segment threads started with `submit_with_context` see it.
+"""
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, wait
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+# How often blocked waits look at the cancellation event (seconds)
+CANCEL_CHECK_INTERVAL = 0.5
+
+# Reasons a run is stopped
+CANCELLED_BY_USER = "Cancelled by user"
+LEASE_LOST = "Lease lost to another worker"
+
+
+class _CancelEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.reason = CANCELLED_BY_USER
+
+
+_event: contextvars.ContextVar[Optional[_CancelEvent]] = contextvars.ContextVar("cancel_event", default=None)
+_events: Dict[str, _CancelEvent] = {}
+_events_lock = threading.Lock()
+
+
+class TaskCancelled(Exception):
+    """Raised inside the pipeline once its task was cancelled."""
+
+    def __init__(self, message: str = CANCELLED_BY_USER, pending=()):
+        super().__init__(message)
+        self.pending = list(pending) # Futures of abandoned work that may still write to the task directory
+
+
+def request_cancel(task_id: str, reason: str = CANCELLED_BY_USER) -> bool:
+    """Cancel a task running in this process; False when it doesn't run here."""
+    with _events_lock:
+        event = _events.get(task_id)
+    if event is None:
+        return False
+    if not event.is_set() or (reason == LEASE_LOST and event.reason != LEASE_LOST):
+        # A lost lease overrides a user cancel: the run must not record anything any more
+        logging.info(f"Task {task_id}: {reason}, stopping the pipeline.")
+        event.reason = reason
+        event.set()
+    return True
+
+
+@contextmanager
+def cancellation_scope(task_id: str, cancelled: bool = False):
+    """Make `task_id` cancellable for everything run inside (also by threads started from here)."""
+    event = _CancelEvent()
+    if cancelled: # Requested before the run started
+        event.set()
+    with _events_lock:
+        _events[task_id] = event
+    token = _event.set(event)
+    try:
+        yield event
+    finally:
+        _event.reset(token)
+        with _events_lock:
+            if _events.get(task_id) is event:
+                del _events[task_id]
+
+
+def cancel_requested() -> bool:
+    event = _event.get()
+    return event is not None and event.is_set()
+
+
+def cancel_reason() -> Optional[str]:
+    event = _event.get()
+    return event.reason if event is not None and event.is_set() else None
+
+
+def check_cancelled():
+    if cancel_requested():
+        raise TaskCancelled(cancel_reason())
+
+
+def sleep(seconds: float):
+    """time.sleep() that ends early, raising TaskCancelled, when the task is cancelled."""
+    event = _event.get()
+    if event is None:
+        time.sleep(seconds)
+    elif event.wait(timeout=seconds):
+        raise TaskCancelled(event.reason)
+
+
+def wait_for(future: Future) -> Any:
+    """future.result() that stops waiting, raising TaskCancelled, when the task is cancelled."""
+    while not wait([future], timeout=CANCEL_CHECK_INTERVAL).done:
+        check_cancelled()
+    return future.result()
@@ -0,0 +1,213 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from .db import SessionLocal, CacheEntry
+from .checkpoint import file_sha256
+
+CAS_ENABLED = os.environ.get("CAS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Total bytes kept in the store before least-recently-used entries are evicted
+CAS_MAX_BYTES = int(os.environ.get("CAS_MAX_BYTES", str(20 * 1024 ** 3)))
+
+_prompt_hashes: Dict[str, Tuple[Tuple[int, int], str]] = {} # path -> ((mtime_ns, size), sha256)
+
+
+def stage_cache_key(audio_sha256: str, stage: str, *parts: Optional[str]) -> str:
+    """Key for a stage output: the audio content plus everything else that shapes the result."""
+    material = "|".join([audio_sha256, stage] + [p or "" for p in parts])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def prompt_hash(prompt_path: str) -> str:
+    """
+    Hash of a prompt template, so editing a prompt invalidates results generated with the old one.
+    Kept until the file's mtime or size changes, so tasks don't rehash the templates every run.
+    """
+    if not os.path.isfile(prompt_path):
+        return "missing"
+    stat_result = os.stat(prompt_path)
+    signature = (stat_result.st_mtime_ns, stat_result.st_size)
+    cached = _prompt_hashes.get(prompt_path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = file_sha256(prompt_path)
+    _prompt_hashes[prompt_path] = (signature, digest)
+    return digest
+
+
+class ContentStore:
+    """
+    Content-addressed store under `root`:
+
+    - `originals/<sha256>`: one copy of each uploaded recording; task directories hardlink to it
+    - `entries/<key>/`: stage outputs (transcripts, word-for-word, memo draft) keyed by
+      (audio hash, model, prompt-template hash), reused when the same recording is resubmitted
+
+    Sizes and access times live in the cache_entries table; the least recently used entries
+    are removed once the total exceeds `max_bytes`.
+    """
+
+    def __init__(self, root: str, max_bytes: int = CAS_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._originals_dir = os.path.join(root, "originals")
+        self._entries_dir = os.path.join(root, "entries")
+        self._evict_lock = threading.Lock()
+        os.makedirs(self._originals_dir, exist_ok=True)
+        os.makedirs(self._entries_dir, exist_ok=True)
+
+    # --- Bookkeeping ---
+    def _record(self, key: str, kind: str, path: str, size_bytes: int, audio_sha256: Optional[str]):
+        db = SessionLocal()
+        try:
+            now = datetime.now()
+            db.add(CacheEntry(key=key, kind=kind, path=path, size_bytes=size_bytes,
+                              audio_sha256=audio_sha256, created_at=now, last_used_at=now))
+            db.commit()
+        except IntegrityError:
+            db.rollback() # Stored concurrently by another task
+        finally:
+            db.close()
+        self.evict()
+
+    def _touch(self, key: str) -> bool:
+        db = SessionLocal()
+        try:
+            updated = db.query(CacheEntry).filter(CacheEntry.key == key).update(
+                {CacheEntry.last_used_at: datetime.now()}, synchronize_session=False
+            )
+            db.commit()
+            return updated == 1
+        finally:
+            db.close()
+
+    def evict(self):
+        """Delete least recently used entries until the store fits in max_bytes."""
+        with self._evict_lock:
+            db = SessionLocal()
+            try:
+                total = db.query(func.coalesce(func.sum(CacheEntry.size_bytes), 0)).scalar() or 0
+                if total <= self.max_bytes:
+                    return
+                for entry in db.query(CacheEntry).order_by(CacheEntry.last_used_at.asc()).yield_per(100):
+                    if total <= self.max_bytes:
+                        break
+                    if os.path.isdir(entry.path):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    elif os.path.exists(entry.path):
+                        os.remove(entry.path) # Task directories keep their own hardlink
+                    total -= entry.size_bytes or 0
+                    logging.info(f"Content store: Evicted {entry.kind} {entry.key} ({entry.size_bytes} bytes).")
+                    db.delete(entry)
+                db.commit()
+            except Exception as e:
+                logging.error(f"Content store: Eviction failed: {e}", exc_info=True)
+                db.rollback()
+            finally:
+                db.close()
+
+    # --- Originals ---
+    def adopt_original(self, audio_sha256: str, file_path: str) -> bool:
+        """
+        Deduplicate an uploaded file. If the same content is already stored, the upload is
+        replaced by a hardlink to the stored copy (returns True); otherwise it becomes the stored copy.
+        """
+        stored_path = os.path.join(self._originals_dir, audio_sha256)
+        key = f"original:{audio_sha256}"
+        if os.path.exists(stored_path):
+            # Replace atomically so file_path never disappears
+            tmp_path = f"{file_path}.dedup"
+            try:
+                os.link(stored_path, tmp_path)
+            except OSError as e:
+                logging.warning(f"Content store: Cannot hardlink {stored_path} ({e}); keeping separate copy.")
+                return False
+            os.replace(tmp_path, file_path)
+            if not self._touch(key):
+                self._record(key, "original", stored_path, os.path.getsize(stored_path), audio_sha256)
+            return True
+        try:
+            os.link(file_path, stored_path)
+        except FileExistsError:
+            return self.adopt_original(audio_sha256, file_path)
+        except OSError as e:
+            logging.warning(f"Content store: Cannot hardlink upload into store ({e}); skipping deduplication.")
+            return False
+        self._record(key, "original", stored_path, os.path.getsize(stored_path), audio_sha256)
+        return False
+
+    # --- Stage outputs ---
+    def contains(self, key: str) -> bool:
+        return os.path.isdir(os.path.join(self._entries_dir, key))
+
+    def restore_files(self, key: str, target_dir: str) -> Optional[List[str]]:
+        """Copy a cached entry's files into target_dir; None on a miss."""
+        entry_dir = os.path.join(self._entries_dir, key)
+        if not os.path.isdir(entry_dir) or not self._touch(key):
+            return None
+        os.makedirs(target_dir, exist_ok=True)
+        restored = []
+        for name in sorted(os.listdir(entry_dir)):
+            target = os.path.join(target_dir, name)
+            # Copy rather than link, so later edits to task files can't corrupt the cache
+            shutil.copy2(os.path.join(entry_dir, name), target)
+            restored.append(target)
+        return restored
+
+    def restore_file(self, key: str, target_path: str) -> bool:
+        """Restore a single-file entry to target_path; False on a miss."""
+        entry_dir = os.path.join(self._entries_dir, key)
+        if not os.path.isdir(entry_dir):
+            return False
+        names = os.listdir(entry_dir)
+        if len(names) != 1 or not self._touch(key):
+            return False
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        shutil.copy2(os.path.join(entry_dir, names[0]), target_path)
+        return True
+
+    def store_files(self, key: str, file_paths: List[str], audio_sha256: Optional[str] = None, kind: str = "stage"):
+        entry_dir = os.path.join(self._entries_dir, key)
+        if os.path.isdir(entry_dir):
+            self._touch(key)
+            return
+        staging_dir = tempfile.mkdtemp(prefix=".tmp_", dir=self._entries_dir)
+        try:
+            size_bytes = 0
+            for path in file_paths:
+                target = os.path.join(staging_dir, os.path.basename(path))
+                shutil.copy2(path, target)
+                size_bytes += os.path.getsize(target)
+            os.rename(staging_dir, entry_dir)
+        except OSError as e:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                logging.warning(f"Content store: Failed to store entry {key}: {e}")
+            return
+        self._record(key, kind, entry_dir, size_bytes, audio_sha256)
+
+
+_store: Optional[ContentStore] = None
+_store_lock = threading.Lock()
+
+
+def get_content_store(audio_target_dir: Optional[str]) -> Optional[ContentStore]:
+    """Process-wide store under CAS_DIR (default: AUDIO_TARGET_DIR/_cas); None when disabled."""
+    global _store
+    if not CAS_ENABLED:
+        return None
+    with _store_lock:
+        if _store is None:
+            root = os.environ.get("CAS_DIR") or (os.path.join(audio_target_dir, "_cas") if audio_target_dir else None)
+            if not root:
+                return None
+            _store = ContentStore(root)
+        return _store
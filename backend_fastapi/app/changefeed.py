@@ -0,0 +1,44 @@
+from typing import Optional
+
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from .db import TaskSession, Task, ChangeCounter
+
+TASKS_FEED = "tasks"
+
+
+def next_version(connection) -> int:
+    """
+    Increment the feed counter inside the caller's transaction.
+
+    The UPDATE holds the counter row lock until commit, so writers are serialized and a
+    client that has seen version N can never later miss a commit stamped with N or lower.
+    """
+    bump = update(ChangeCounter).where(ChangeCounter.name == TASKS_FEED).values(value=ChangeCounter.value + 1)
+    if connection.execute(bump).rowcount == 0:
+        try:
+            with connection.begin_nested():
+                connection.execute(insert(ChangeCounter).values(name=TASKS_FEED, value=1))
+            return 1
+        except IntegrityError:
+            connection.execute(bump) # Created concurrently
+    return connection.execute(select(ChangeCounter.value).where(ChangeCounter.name == TASKS_FEED)).scalar_one()
+
+
+def current_version(db) -> int:
+    """Latest committed task version; 0 before the first change."""
+    value: Optional[int] = db.query(ChangeCounter.value).filter(ChangeCounter.name == TASKS_FEED).scalar()
+    return value or 0
+
+
+@event.listens_for(TaskSession, "before_flush")
+def _stamp_task_versions(session, flush_context, instances):
+    # Bulk UPDATEs (claims, heartbeats) bypass this hook and stamp next_version() themselves
+    changed = [obj for obj in session.new if isinstance(obj, Task)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Task) and session.is_modified(obj)]
+    if not changed:
+        return
+    version = next_version(session.connection())
+    for task in changed:
+        task.version = version
@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+MANIFEST_FILENAME = "manifest.json"
+HASH_CHUNK_SIZE = 1024 * 1024 # 1 MiB
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file, read in fixed-size chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _describe_artifact(path: str) -> Dict:
+    return {"path": path, "size": os.path.getsize(path), "sha256": file_sha256(path)}
+
+
+def _artifact_intact(artifact: Dict) -> bool:
+    path = artifact.get("path")
+    if not path or not os.path.isfile(path):
+        return False
+    # Cheap size check first, hash only when the size still matches
+    if os.path.getsize(path) != artifact.get("size"):
+        return False
+    return file_sha256(path) == artifact.get("sha256")
+
+
+class TaskManifest:
+    """
+    Completion manifest for one task directory (`<task_base_dir>/manifest.json`).
+
+    Records which pipeline stages finished, with the hashes of the artifacts they produced,
+    plus the transcription state of every audio segment. A retried or resumed run skips
+    stages whose artifacts are still intact and only transcribes segments that are missing.
+    """
+
+    def __init__(self, task_base_dir: str):
+        self.path = os.path.join(task_base_dir, MANIFEST_FILENAME)
+        self._lock = threading.Lock()
+        self._data = {"stages": {}, "segments": {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._data = json.load(f)
+                self._data.setdefault("stages", {})
+                self._data.setdefault("segments", {})
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"Manifest {self.path} is unreadable, starting from scratch: {e}")
+
+    def _save(self):
+        # Write to a temp file and rename so a crash never leaves a half-written manifest
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    # --- Stages ---
+    def is_stage_complete(self, stage: str) -> bool:
+        with self._lock:
+            record = self._data["stages"].get(stage)
+        if not record:
+            return False
+        if record.get("released_at"):
+            # Deliberately deleted once no longer needed (see release_artifacts)
+            return True
+        intact = all(_artifact_intact(a) for a in record.get("artifacts", []))
+        if not intact:
+            logging.info(f"Manifest {self.path}: Artifacts of stage '{stage}' changed or missing, stage will be redone.")
+        return intact
+
+    def stage_artifacts(self, stage: str) -> List[str]:
+        with self._lock:
+            record = self._data["stages"].get(stage) or {}
+            return [a["path"] for a in record.get("artifacts", [])]
+
+    def stage_info(self, stage: str) -> Dict:
+        with self._lock:
+            return dict((self._data["stages"].get(stage) or {}).get("info") or {})
+
+    def complete_stage(self, stage: str, artifact_paths: List[str], info: Optional[Dict] = None):
+        artifacts = [_describe_artifact(p) for p in artifact_paths]
+        with self._lock:
+            self._data["stages"][stage] = {
+                "completed_at": datetime.now().isoformat(),
+                "artifacts": artifacts,
+                "info": info or {},
+            }
+            self._save()
+
+    def artifacts_released(self, stage: str) -> bool:
+        with self._lock:
+            return bool((self._data["stages"].get(stage) or {}).get("released_at"))
+
+    def release_artifacts(self, stage: str) -> List[str]:
+        """
+        Mark a complete stage's artifacts as deleted on purpose (e.g. audio segments once all
+        transcripts exist): the stage stays complete instead of being redone on the next run.
+        Returns the artifact paths, which the caller then removes.
+        """
+        with self._lock:
+            record = self._data["stages"].get(stage)
+            if not record or record.get("released_at"):
+                return []
+            record["released_at"] = datetime.now().isoformat()
+            self._save()
+            return [a["path"] for a in record.get("artifacts", [])]
+
+    def invalidate_stages(self, *stages: str):
+        with self._lock:
+            removed = [s for s in stages if self._data["stages"].pop(s, None) is not None]
+            if removed:
+                self._save()
+
+    # --- Segments ---
+    def segment_done(self, segment_path: str) -> bool:
+        with self._lock:
+            record = self._data["segments"].get(os.path.basename(segment_path))
+        if not record or record.get("status") != "completed":
+            return False
+        return all(_artifact_intact(a) for a in record.get("transcripts", []))
+
+    def segment_transcripts(self, segment_path: str) -> List[str]:
+        with self._lock:
+            record = self._data["segments"].get(os.path.basename(segment_path)) or {}
+            return [a["path"] for a in record.get("transcripts", [])]
+
+    def record_segment(self, segment_path: str, status: str, transcript_paths: Optional[List[str]] = None,
+                       error: Optional[str] = None, attempts: int = 1):
+        transcripts = [_describe_artifact(p) for p in (transcript_paths or [])]
+        with self._lock:
+            self._data["segments"][os.path.basename(segment_path)] = {
+                "status": status,
+                "transcripts": transcripts,
+                "error": error,
+                "attempts": attempts,
+                "updated_at": datetime.now().isoformat(),
+            }
+            self._save()
+
+    def reset_segments(self):
+        with self._lock:
+            self._data["segments"] = {}
+            self._save()
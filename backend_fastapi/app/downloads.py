@@ -0,0 +1,282 @@
+"""
+Downloads of task outputs: the DOCX and markdown, the word-for-word text, the memo draft
+and the transcripts.
+
+Only files recorded in the task's manifest (or its result_files) are served, addressed by
+their path inside the task directory. A single file goes out as a FileResponse, which
+answers Range / If-Range requests and is handed to the server as a path (the ASGI
+pathsend extension, i.e. sendfile) where the server supports it; with
+DOWNLOAD_ACCEL_REDIRECT_PREFIX set, nginx serves the file itself via X-Accel-Redirect.
+Several files are bundled into a ZIP that is written while it is sent. Every response
+carries an ETag and Last-Modified, so re-downloads are answered with 304.
+
+The API has no user accounts (see the deployment notes), and /api/tasks hands out every
+task id, so downloads are authenticated by the link itself: links carry an expiring HMAC
+signature made with DOWNLOAD_SIGNING_KEY, and the file listing needs one as well (it hands
+out signed links for every file). Notification emails carry such links. Without a signing
+key downloads are refused, unless DOWNLOAD_ALLOW_UNSIGNED opens them to anyone on the network.
+
+The same key signs task tokens: returned to the submitter only, they authorize cancelling and
+retrying the task, which a task id from /api/tasks alone must not.
+"""
+import gzip
+import hashlib
+import hmac
+import mimetypes
+import os
+import time
+import zipfile
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+from fastapi import HTTPException
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from .checkpoint import TaskManifest
+from .lifecycle import stored_file
+
+# Secret for signed download links; downloads are refused while it is empty...
+DOWNLOAD_SIGNING_KEY = os.environ.get("DOWNLOAD_SIGNING_KEY", "")
+# ...unless unsigned downloads are explicitly allowed (open to anyone who can reach the API)
+DOWNLOAD_ALLOW_UNSIGNED = os.environ.get("DOWNLOAD_ALLOW_UNSIGNED", "false").lower() in ("1", "true", "yes")
+DOWNLOAD_LINK_TTL_SECONDS = int(os.environ.get("DOWNLOAD_LINK_TTL_SECONDS", str(7 * 24 * 3600)))
+# Public address of the API (e.g. http://audio2memo.intra:8000); notification emails link to downloads when set
+DOWNLOAD_BASE_URL = os.environ.get("DOWNLOAD_BASE_URL", "").rstrip("/")
+# nginx `internal` location aliased to AUDIO_TARGET_DIR (e.g. /protected-tasks/); empty = served by the app
+DOWNLOAD_ACCEL_REDIRECT_PREFIX = os.environ.get("DOWNLOAD_ACCEL_REDIRECT_PREFIX", "")
+
+# Manifest stage -> artifact kind offered for download
+ARTIFACT_KINDS = {
+    "document": "document",
+    "wordforword": "wordforword",
+    "memo_draft": "memo_draft",
+    "transcribe": "transcripts",
+}
+_CHUNK_BYTES = 256 * 1024
+# Already compressed; deflating them again only costs CPU
+_STORED_EXTENSIONS = (".docx", ".zip", ".gz", ".mp3", ".m4a")
+
+
+def task_dir(task_id: str) -> str:
+    return os.path.join(os.environ.get("AUDIO_TARGET_DIR") or "", task_id)
+
+
+# --- Artifacts ---
+def task_artifacts(task_id: str, result_files: Optional[Dict] = None) -> List[Dict]:
+    """
+    The downloadable files of a task in pipeline order: relative `path`, `kind`, `size`,
+    `modified`, and where the bytes are (`stored_path`, `gzipped` once the lifecycle
+    manager compressed the file). Files missing from disk are left out.
+    """
+    base_dir = os.path.realpath(task_dir(task_id))
+    manifest = TaskManifest(base_dir)
+    candidates = [(kind, path) for stage, kind in ARTIFACT_KINDS.items() for path in manifest.stage_artifacts(stage)]
+    if isinstance(result_files, dict): # Outputs of runs older than the manifest
+        candidates += [("document", path) for path in result_files.values() if isinstance(path, str)]
+    artifacts, seen = [], set()
+    for kind, path in candidates:
+        real_path = os.path.realpath(path)
+        if real_path in seen or os.path.commonpath([base_dir, real_path]) != base_dir:
+            continue
+        seen.add(real_path)
+        stored = stored_file(real_path)
+        if not stored:
+            continue
+        stored_path, gzipped = stored
+        stat_result = os.stat(stored_path)
+        artifacts.append({
+            "path": os.path.relpath(real_path, base_dir).replace(os.sep, "/"),
+            "kind": kind,
+            "size": None if gzipped else stat_result.st_size, # Unknown until decompressed
+            "modified": datetime.fromtimestamp(stat_result.st_mtime),
+            "stored_path": stored_path,
+            "gzipped": gzipped,
+        })
+    return artifacts
+
+
+def find_artifact(artifacts: List[Dict], path: str) -> Dict:
+    for artifact in artifacts:
+        if artifact["path"] == path:
+            return artifact
+    raise HTTPException(status_code=404, detail="File not found")
+
+
+# --- Signed links ---
+def _signature(task_id: str, resource: str, expires: int) -> str:
+    message = f"{task_id}/{resource}:{expires}".encode()
+    return hmac.new(DOWNLOAD_SIGNING_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+
+def downloads_enabled() -> bool:
+    return bool(DOWNLOAD_SIGNING_KEY) or DOWNLOAD_ALLOW_UNSIGNED
+
+
+def verify_link(task_id: str, resource: str, expires: Optional[int], signature: Optional[str]):
+    """403 unless the link is signed for this resource and not expired (or unsigned downloads are allowed)."""
+    if not DOWNLOAD_SIGNING_KEY:
+        if DOWNLOAD_ALLOW_UNSIGNED:
+            return
+        raise HTTPException(status_code=403, detail="Downloads are disabled: DOWNLOAD_SIGNING_KEY is not configured.")
+    if expires is None or not signature:
+        raise HTTPException(status_code=403, detail="Download link is not signed.")
+    if expires < time.time():
+        raise HTTPException(status_code=403, detail="Download link has expired.")
+    if not hmac.compare_digest(signature, _signature(task_id, resource, expires)):
+        raise HTTPException(status_code=403, detail="Invalid download link signature.")
+
+
+def task_token(task_id: str) -> Optional[str]:
+    """Token that lets the submitter cancel or retry the task; None without a signing key."""
+    if not DOWNLOAD_SIGNING_KEY:
+        return None
+    return hmac.new(DOWNLOAD_SIGNING_KEY.encode(), f"task-token:{task_id}".encode(), hashlib.sha256).hexdigest()
+
+
+def verify_task_token(task_id: str, token: Optional[str]):
+    """403 unless `token` is the task's token (or unsigned access is allowed)."""
+    if not DOWNLOAD_SIGNING_KEY:
+        if DOWNLOAD_ALLOW_UNSIGNED:
+            return
+        raise HTTPException(status_code=403, detail="Task actions are disabled: DOWNLOAD_SIGNING_KEY is not configured.")
+    if not token or not hmac.compare_digest(token, task_token(task_id)):
+        raise HTTPException(status_code=403, detail="Missing or invalid task token.")
+
+
+def _link(task_id: str, resource: str, path: str, query: Optional[Dict] = None, absolute: bool = False) -> str:
+    query = dict(query or {})
+    if DOWNLOAD_SIGNING_KEY:
+        expires = int(time.time()) + DOWNLOAD_LINK_TTL_SECONDS
+        query.update(expires=expires, signature=_signature(task_id, resource, expires))
+    url = f"{DOWNLOAD_BASE_URL if absolute else ''}/api/tasks/{task_id}/{path}"
+    return f"{url}?{urlencode(query, doseq=True)}" if query else url
+
+
+def files_url(task_id: str, absolute: bool = False) -> str:
+    """Link to the task's file listing, which in turn hands out links to each file."""
+    return _link(task_id, "files", "files", absolute=absolute)
+
+
+def file_url(task_id: str, path: str, absolute: bool = False) -> str:
+    return _link(task_id, path, f"files/{quote(path)}", absolute=absolute)
+
+
+def archive_url(task_id: str, kinds: Optional[List[str]] = None) -> str:
+    return _link(task_id, "archive", "archive", {"kind": kinds} if kinds else None)
+
+
+def email_files_url(task_id: str) -> Optional[str]:
+    """Absolute link to the task's file listing for a notification email; None when it couldn't be used."""
+    if not DOWNLOAD_BASE_URL or not downloads_enabled():
+        return None
+    return files_url(task_id, absolute=True)
+
+
+def email_download_url(task_id: str, file_path: str) -> Optional[str]:
+    """Absolute link to one of the task's files for a notification email; None when it couldn't be used."""
+    if not DOWNLOAD_BASE_URL or not downloads_enabled():
+        return None
+    relative = os.path.relpath(os.path.realpath(file_path), os.path.realpath(task_dir(task_id))).replace(os.sep, "/")
+    return file_url(task_id, relative, absolute=True)
+
+
+# --- Responses ---
+def _content_disposition(file_name: str) -> str:
+    return f"attachment; filename*=utf-8''{quote(file_name)}"
+
+
+def _not_modified(headers, etag: str, mtime: float) -> bool:
+    if_none_match = headers.get("if-none-match")
+    if if_none_match is not None: # Takes precedence over If-Modified-Since
+        return if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    if_modified_since = headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def file_response(headers, task_id: str, artifact: Dict) -> Response:
+    """Response for one artifact; gzipped files are sent as-is to clients accepting gzip."""
+    file_name = os.path.basename(artifact["path"])
+    media_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    stored_path = artifact["stored_path"]
+    stat_result = os.stat(stored_path)
+    decompress = artifact["gzipped"] and "gzip" not in (headers.get("accept-encoding") or "").lower()
+    etag_base = f"{stat_result.st_mtime}-{stat_result.st_size}{'-gunzip' if decompress else ''}"
+    response_headers = {
+        "ETag": f'"{hashlib.md5(etag_base.encode(), usedforsecurity=False).hexdigest()}"',
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": "no-cache", # Outputs change when a task is retried; revalidation is a 304
+    }
+    if artifact["gzipped"]:
+        response_headers["Vary"] = "Accept-Encoding"
+    if _not_modified(headers, response_headers["ETag"], stat_result.st_mtime):
+        return Response(status_code=304, headers=response_headers)
+    response_headers["Content-Disposition"] = _content_disposition(file_name)
+
+    if decompress:
+        # No Range here: offsets into the decompressed bytes would mean decompressing up to them
+        def chunks() -> Iterator[bytes]:
+            with gzip.open(stored_path, "rb") as f:
+                yield from iter(lambda: f.read(_CHUNK_BYTES), b"")
+        return StreamingResponse(chunks(), media_type=media_type, headers=response_headers)
+    if artifact["gzipped"]:
+        response_headers["Content-Encoding"] = "gzip"
+    if DOWNLOAD_ACCEL_REDIRECT_PREFIX:
+        relative = os.path.relpath(stored_path, os.path.realpath(task_dir(task_id))).replace(os.sep, "/")
+        response_headers["X-Accel-Redirect"] = quote(f"{DOWNLOAD_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{task_id}/{relative}")
+        return Response(media_type=media_type, headers=response_headers)
+    return FileResponse(stored_path, media_type=media_type, headers=response_headers, stat_result=stat_result)
+
+
+class _ChunkSink:
+    """Write-only file object that collects what zipfile writes until it is taken."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def zip_stream(artifacts: List[Dict]) -> Iterator[bytes]:
+    """
+    ZIP of the artifacts, produced while it is sent: zipfile writes to a non-seekable sink
+    (sizes go into data descriptors), so neither the archive nor a whole file is ever in memory.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", allowZip64=True) as archive:
+        for artifact in artifacts:
+            info = zipfile.ZipInfo(artifact["path"], date_time=artifact["modified"].timetuple()[:6])
+            info.compress_type = zipfile.ZIP_STORED if artifact["path"].lower().endswith(_STORED_EXTENSIONS) else zipfile.ZIP_DEFLATED
+            opener = gzip.open if artifact["gzipped"] else open
+            with opener(artifact["stored_path"], "rb") as source, archive.open(info, "w", force_zip64=True) as target:
+                for chunk in iter(lambda: source.read(_CHUNK_BYTES), b""):
+                    target.write(chunk)
+                    yield from _pending(sink)
+            yield from _pending(sink) # Entry trailer (data descriptor)
+    yield from _pending(sink) # Central directory
+
+
+def _pending(sink: _ChunkSink) -> Iterator[bytes]:
+    data = sink.take()
+    if data:
+        yield data
+
+
+def archive_response(file_name: str, artifacts: List[Dict]) -> StreamingResponse:
+    return StreamingResponse(zip_stream(artifacts), media_type="application/zip",
+                             headers={"Content-Disposition": _content_disposition(file_name)})
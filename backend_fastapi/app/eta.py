@@ -0,0 +1,219 @@
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import func
+
+from .db import Task, TaskStageMetric, ACTIVE_STATUSES, session_scope
+from .scheduler import SCHEDULER_WORKER_SLOTS
+
+# Worker slots across all nodes; the ETA simulation assumes this many tasks run at once
+ETA_WORKER_SLOTS = int(os.environ.get("ETA_WORKER_SLOTS", str(SCHEDULER_WORKER_SLOTS)))
+# Completed tasks used to (re)train the estimator, newest first
+ETA_TRAINING_TASKS = int(os.environ.get("ETA_TRAINING_TASKS", "1000"))
+# Retrain from the database this often (seconds), which also picks up tasks finished on other nodes
+ETA_RETRAIN_SECONDS = float(os.environ.get("ETA_RETRAIN_SECONDS", "900"))
+# The predicted schedule is reused for this long (seconds), so polling clients don't each recompute it
+ETA_CACHE_SECONDS = float(os.environ.get("ETA_CACHE_SECONDS", "5"))
+# Weight kept by older samples for every new one, so the fit follows recent API speed
+ETA_DECAY = float(os.environ.get("ETA_DECAY", "0.995"))
+# Before enough history exists: fixed overhead plus a multiple of the audio duration
+ETA_DEFAULT_OVERHEAD_SECONDS = float(os.environ.get("ETA_DEFAULT_OVERHEAD_SECONDS", "60"))
+ETA_DEFAULT_SECONDS_PER_AUDIO_SECOND = float(os.environ.get("ETA_DEFAULT_SECONDS_PER_AUDIO_SECOND", "0.5"))
+ETA_DEFAULT_SECONDS = float(os.environ.get("ETA_DEFAULT_SECONDS", "900")) # Audio duration unknown
+# Admission control: new uploads get 429 while a new task would wait longer than this to start (0 = off)
+ADMISSION_MAX_BACKLOG_SECONDS = float(os.environ.get("ADMISSION_MAX_BACKLOG_SECONDS", "0"))
+
+_MIN_SAMPLES_FOR_SLOPE = 5
+
+
+class _RunningFit:
+    """Exponentially weighted least squares of run time (y) against audio duration (x)."""
+
+    def __init__(self, decay: float = ETA_DECAY):
+        self._decay = decay
+        self.count = 0
+        self._w = self._sx = self._sy = self._sxx = self._sxy = 0.0
+        # Tasks without a probed duration only contribute to the mean
+        self._w_all = self._sy_all = 0.0
+
+    def add(self, x: Optional[float], y: float):
+        self.count += 1
+        self._w_all = self._w_all * self._decay + 1.0
+        self._sy_all = self._sy_all * self._decay + y
+        if x is None:
+            return
+        self._w = self._w * self._decay + 1.0
+        self._sx = self._sx * self._decay + x
+        self._sy = self._sy * self._decay + y
+        self._sxx = self._sxx * self._decay + x * x
+        self._sxy = self._sxy * self._decay + x * y
+
+    def predict(self, x: Optional[float]) -> Optional[float]:
+        if self._w_all == 0:
+            return None
+        if x is None or self._w == 0:
+            return self._sy_all / self._w_all
+        mean_x, mean_y = self._sx / self._w, self._sy / self._w
+        variance = self._sxx / self._w - mean_x * mean_x
+        if self.count < _MIN_SAMPLES_FOR_SLOPE or variance <= 1e-9:
+            # Not enough spread in durations for a slope: scale the mean rate instead
+            return mean_y * (x / mean_x) if mean_x > 0 else mean_y
+        slope = max(0.0, (self._sxy / self._w - mean_x * mean_y) / variance)
+        return mean_y + slope * (x - mean_x)
+
+
+class EtaEstimator:
+    """
+    Predicts task run times from history and derives start/finish times for queued tasks.
+
+    One fit per transcription model plus a global one for models without history. The
+    fits are trained from the database (run time = first stage start to last stage end of
+    the final attempt, see task_stage_metrics) and updated whenever a task completes here.
+    """
+
+    def __init__(self, worker_slots: int = ETA_WORKER_SLOTS):
+        self._worker_slots = max(1, worker_slots)
+        self._lock = threading.Lock()
+        self._fits: Dict[str, _RunningFit] = {}
+        self._global = _RunningFit()
+        self._trained_at = 0.0
+        self._schedule: Optional[Tuple[float, Dict[str, Tuple[datetime, datetime]], float]] = None
+
+    # --- Training ---
+    def observe(self, model: Optional[str], audio_duration: Optional[float], run_seconds: float):
+        """Add one finished run (called as tasks complete)."""
+        if run_seconds is None or run_seconds <= 0:
+            return
+        with self._lock:
+            self._fits.setdefault(model or "", _RunningFit()).add(audio_duration, run_seconds)
+            self._global.add(audio_duration, run_seconds)
+            self._schedule = None
+
+    def train(self):
+        """Rebuild the fits from recently completed tasks."""
+        with session_scope() as db:
+            tasks = db.query(Task.task_id, Task.model, Task.audio_duration, Task.processing_time).filter(
+                Task.status == "completed"
+            ).order_by(Task.submit_time.desc()).limit(ETA_TRAINING_TASKS).all()
+            task_ids = [task.task_id for task in tasks]
+            runs: Dict[str, Tuple[int, datetime, datetime]] = {}
+            for i in range(0, len(task_ids), 500):
+                for task_id, attempt, started, finished in db.query(
+                    TaskStageMetric.task_id, TaskStageMetric.attempt,
+                    func.min(TaskStageMetric.started_at), func.max(TaskStageMetric.finished_at),
+                ).filter(TaskStageMetric.task_id.in_(task_ids[i:i + 500])).group_by(
+                    TaskStageMetric.task_id, TaskStageMetric.attempt
+                ):
+                    if task_id not in runs or (attempt or 0) > (runs[task_id][0] or 0):
+                        runs[task_id] = (attempt, started, finished)
+
+        fits: Dict[str, _RunningFit] = {}
+        global_fit = _RunningFit()
+        for task in reversed(tasks): # Oldest first, so the newest carry the most weight
+            if task.task_id in runs:
+                _, started, finished = runs[task.task_id]
+                run_seconds = (finished - started).total_seconds()
+            else:
+                # Finished before stage metrics existed: processing_time also contains the queue wait
+                run_seconds = task.processing_time
+            if not run_seconds or run_seconds <= 0:
+                continue
+            fits.setdefault(task.model or "", _RunningFit()).add(task.audio_duration, run_seconds)
+            global_fit.add(task.audio_duration, run_seconds)
+        with self._lock:
+            self._fits, self._global = fits, global_fit
+            self._trained_at = time.monotonic()
+            self._schedule = None
+        logging.info(f"ETA: Trained on {global_fit.count} completed task(s) across {len(fits)} model(s).")
+
+    def _maybe_retrain(self):
+        if time.monotonic() - self._trained_at >= ETA_RETRAIN_SECONDS:
+            try:
+                self.train()
+            except Exception as e:
+                logging.error(f"ETA: Training failed: {e}", exc_info=True)
+                self._trained_at = time.monotonic() # Don't retry on every request
+
+    def predict_run_seconds(self, model: Optional[str], audio_duration: Optional[float]) -> float:
+        with self._lock:
+            fit = self._fits.get(model or "")
+            prediction = fit.predict(audio_duration) if fit else None
+            if prediction is None:
+                prediction = self._global.predict(audio_duration)
+        if prediction is None:
+            prediction = (ETA_DEFAULT_OVERHEAD_SECONDS + ETA_DEFAULT_SECONDS_PER_AUDIO_SECOND * audio_duration
+                          if audio_duration else ETA_DEFAULT_SECONDS)
+        return max(1.0, prediction)
+
+    # --- Schedule ---
+    def _simulate(self) -> Tuple[Dict[str, Tuple[datetime, datetime]], float]:
+        """
+        Replay the queue on the worker slots: running tasks keep their slot until their
+        predicted end, queued ones start in scheduler order (priority, then submit time).
+        Returns per-task (start, finish) and the wait a newly submitted task would have.
+        """
+        now = datetime.now()
+        with session_scope() as db:
+            active = db.query(
+                Task.task_id, Task.status, Task.model, Task.audio_duration, Task.start_time,
+                Task.worker_id, Task.priority, Task.submit_time,
+            ).filter(Task.status.in_(ACTIVE_STATUSES)).all()
+
+        running = [t for t in active if t.status != "submitted" or t.worker_id is not None]
+        queued = sorted(
+            (t for t in active if t.status == "submitted" and t.worker_id is None),
+            key=lambda t: (-(t.priority or 0), t.submit_time or datetime.min),
+        )
+        estimates: Dict[str, Tuple[datetime, datetime]] = {}
+        slots = []
+        for task in running:
+            started = task.start_time or now
+            finish = started + timedelta(seconds=self.predict_run_seconds(task.model, task.audio_duration))
+            finish = max(finish, now) # Overdue tasks are assumed to finish any moment
+            estimates[task.task_id] = (started, finish)
+            slots.append(finish)
+        heapq.heapify(slots)
+        while len(slots) < self._worker_slots:
+            heapq.heappush(slots, now)
+        for task in queued:
+            start = heapq.heappop(slots)
+            finish = start + timedelta(seconds=self.predict_run_seconds(task.model, task.audio_duration))
+            estimates[task.task_id] = (start, finish)
+            heapq.heappush(slots, finish)
+        backlog_seconds = max(0.0, (slots[0] - now).total_seconds())
+        return estimates, backlog_seconds
+
+    def schedule(self) -> Tuple[Dict[str, Tuple[datetime, datetime]], float]:
+        """(task_id -> (predicted start, predicted finish)) for unfinished tasks, and the current backlog in seconds."""
+        self._maybe_retrain()
+        with self._lock:
+            cached = self._schedule
+        if cached and time.monotonic() - cached[0] < ETA_CACHE_SECONDS:
+            return cached[1], cached[2]
+        estimates, backlog_seconds = self._simulate()
+        with self._lock:
+            self._schedule = (time.monotonic(), estimates, backlog_seconds)
+        return estimates, backlog_seconds
+
+    def invalidate(self):
+        """Forget the cached schedule, e.g. after a submission."""
+        with self._lock:
+            self._schedule = None
+
+    def admission_retry_after(self) -> Optional[int]:
+        """Seconds a client should wait before submitting, or None when a new task is accepted."""
+        if ADMISSION_MAX_BACKLOG_SECONDS <= 0:
+            return None
+        _, backlog_seconds = self.schedule()
+        if backlog_seconds <= ADMISSION_MAX_BACKLOG_SECONDS:
+            return None
+        return max(1, math.ceil(backlog_seconds - ADMISSION_MAX_BACKLOG_SECONDS))
+
+
+eta_estimator = EtaEstimator()
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+import os
+import select
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import event, inspect, text
+
+from .db import TaskSession, Task, engine
+
+# "local": events only reach subscribers of this process
+# "postgres": events go through LISTEN/NOTIFY, so every uvicorn worker / node sees every transition
+# "auto": postgres when the database is PostgreSQL, otherwise local
+TASK_EVENTS_BACKEND = os.environ.get("TASK_EVENTS_BACKEND", "auto")
+TASK_EVENTS_CHANNEL = os.environ.get("TASK_EVENTS_CHANNEL", "task_events")
+# Events buffered per subscriber; a client that falls further behind is told to resync instead
+TASK_EVENTS_QUEUE_SIZE = int(os.environ.get("TASK_EVENTS_QUEUE_SIZE", "100"))
+# Task columns whose changes are pushed to subscribers
+_WATCHED_COLUMNS = ("status", "active_stages")
+# pg_notify payloads are limited to 8000 bytes
+_MAX_ERROR_CHARS = 500
+
+
+def _use_postgres() -> bool:
+    if TASK_EVENTS_BACKEND == "auto":
+        return engine.dialect.name == "postgresql"
+    return TASK_EVENTS_BACKEND == "postgres"
+
+
+def _isoformat(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def task_event(task: Task) -> Dict:
+    """Payload pushed for a task status transition."""
+    return {
+        "type": "task",
+        "task_id": task.task_id,
+        "status": task.status,
+        "active_stages": task.active_stages,
+        "submit_time": _isoformat(task.submit_time),
+        "last_update_time": _isoformat(task.last_update_time),
+        "file_name": task.file_name,
+        "error": task.error[:_MAX_ERROR_CHARS] if task.error else None,
+    }
+
+
+class TaskEventBroadcaster:
+    """
+    Fans task status transitions out to the SSE subscribers of this process.
+
+    Subscribers are asyncio queues owned by the event loop; `dispatch` may be called from
+    any thread (pipeline workers, the scheduler, the LISTEN thread).
+    """
+
+    def __init__(self, queue_size: int = TASK_EVENTS_QUEUE_SIZE):
+        self._queue_size = queue_size
+        self._subscribers: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = set()
+        self._lock = threading.Lock()
+        self._listener: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+
+    # --- Subscribers ---
+    def subscribe(self) -> asyncio.Queue:
+        """Must be called from the event loop that will read the queue."""
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=self._queue_size))
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber[1]
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers = {s for s in self._subscribers if s[1] is not queue}
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    @staticmethod
+    def _offer(queue: asyncio.Queue, payload: Dict):
+        if queue.full():
+            # Slow client: drop its backlog and let it reload the task list once
+            while not queue.empty():
+                queue.get_nowait()
+            payload = {"type": "resync"}
+        queue.put_nowait(payload)
+
+    def dispatch(self, payload: Dict):
+        """Deliver an event to every subscriber of this process."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, payload)
+            except RuntimeError:
+                self.unsubscribe(queue) # Event loop already closed
+
+    # --- Cross-process delivery ---
+    def start(self):
+        """Start the LISTEN thread when events travel through PostgreSQL."""
+        if not _use_postgres() or self._listener is not None:
+            return
+        self._stop_event.clear()
+        self._listener = threading.Thread(target=self._listen_loop, name="task-events-listener", daemon=True)
+        self._listener.start()
+        logging.info(f"Task events: Listening on PostgreSQL channel '{TASK_EVENTS_CHANNEL}'.")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._listener is not None:
+            self._listener.join(timeout=5)
+            self._listener = None
+
+    def _listen_loop(self):
+        backoff = 1.0
+        while not self._stop_event.is_set():
+            raw_connection = None
+            try:
+                raw_connection = engine.raw_connection()
+                connection = raw_connection.driver_connection
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{TASK_EVENTS_CHANNEL}"')
+                if backoff > 1.0:
+                    # Notifications sent while disconnected are lost
+                    self.dispatch({"type": "resync"})
+                backoff = 1.0
+                while not self._stop_event.is_set():
+                    if select.select([connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        try:
+                            self.dispatch(json.loads(notification.payload))
+                        except json.JSONDecodeError:
+                            logging.warning(f"Task events: Ignoring malformed notification: {notification.payload[:200]}")
+            except Exception as e:
+                logging.error(f"Task events: LISTEN connection failed, retrying in {backoff:.0f}s: {e}")
+                self._stop_event.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if raw_connection is not None:
+                    # The connection was switched to autocommit; never hand it back to the pool
+                    raw_connection.invalidate()
+
+
+task_events = TaskEventBroadcaster()
+
+
+# --- Session hooks ---
+# Every committed change to a task's status is published, wherever it was made
+# (pipeline, scheduler recovery, retry endpoint), without sprinkling publish calls around.
+def _changed_tasks(session) -> List[Task]:
+    changed = [obj for obj in session.new if isinstance(obj, Task)]
+    for obj in session.dirty:
+        if isinstance(obj, Task):
+            state = inspect(obj)
+            if any(state.attrs[column].history.has_changes() for column in _WATCHED_COLUMNS):
+                changed.append(obj)
+    return changed
+
+
+@event.listens_for(TaskSession, "after_flush")
+def _collect_task_events(session, flush_context):
+    payloads = [task_event(task) for task in _changed_tasks(session)]
+    if not payloads:
+        return
+    if _use_postgres():
+        # Sent inside the transaction: PostgreSQL delivers it on commit and drops it on rollback
+        connection = session.connection()
+        for payload in payloads:
+            connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                               {"channel": TASK_EVENTS_CHANNEL, "payload": json.dumps(payload)})
+    else:
+        session.info.setdefault("task_events", []).extend(payloads)
+
+
+@event.listens_for(TaskSession, "after_commit")
+def _publish_task_events(session):
+    for payload in session.info.pop("task_events", []):
+        task_events.dispatch(payload)
+
+
+@event.listens_for(TaskSession, "after_soft_rollback")
+def _discard_task_events(session, previous_transaction):
+    session.info.pop("task_events", None)
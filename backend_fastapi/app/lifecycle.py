@@ -0,0 +1,394 @@
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, or_
+
+from .db import Task, CacheEntry, ACTIVE_STATUSES, session_scope
+from .checkpoint import TaskManifest
+
+LIFECYCLE_ENABLED = os.environ.get("LIFECYCLE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Pause between passes (seconds); a pass that filled its batch is followed by the next one right away
+LIFECYCLE_INTERVAL_SECONDS = float(os.environ.get("LIFECYCLE_INTERVAL_SECONDS", "300"))
+# Tasks compacted or expired per batch, so a pass never holds the disk busy for long
+LIFECYCLE_BATCH_TASKS = int(os.environ.get("LIFECYCLE_BATCH_TASKS", "20"))
+# Finished tasks are left alone this long (seconds) before their segments are removed and text compressed
+LIFECYCLE_COMPACT_AFTER_SECONDS = float(os.environ.get("LIFECYCLE_COMPACT_AFTER_SECONDS", "3600"))
+LIFECYCLE_DELETE_SEGMENTS = os.environ.get("LIFECYCLE_DELETE_SEGMENTS", "true").lower() in ("1", "true", "yes")
+LIFECYCLE_COMPRESS_TEXT = os.environ.get("LIFECYCLE_COMPRESS_TEXT", "true").lower() in ("1", "true", "yes")
+# Age retention: task directories of tasks finished more than this many days ago are deleted (0 = keep)
+LIFECYCLE_RETENTION_DAYS = float(os.environ.get("LIFECYCLE_RETENTION_DAYS", "0"))
+# Size retention: while task directories hold more than this, the oldest finished tasks are deleted (0 = no limit);
+# cached stage outputs don't count, the content store evicts them itself at CAS_MAX_BYTES
+LIFECYCLE_MAX_BYTES = int(os.environ.get("LIFECYCLE_MAX_BYTES", "0"))
+# Admission: uploads that would push stored data past the quota are refused (0 = no quota)
+STORAGE_QUOTA_BYTES = int(os.environ.get("STORAGE_QUOTA_BYTES", "0"))
+# Admission: uploads are refused while the filesystem would keep less than this free
+STORAGE_MIN_FREE_BYTES = int(os.environ.get("STORAGE_MIN_FREE_BYTES", str(1024 ** 3)))
+# Stored-bytes total used for admission is re-read from the database this often (seconds)
+STORAGE_USAGE_CACHE_SECONDS = float(os.environ.get("STORAGE_USAGE_CACHE_SECONDS", "30"))
+
+FINISHED_STATUSES = ("completed", "failed", "timed_out", "cancelled")
+# Transient states while the manager works on a task directory; such tasks can't be retried meanwhile
+BUSY_STORAGE_STATES = ("compacting", "expiring")
+_TEXT_DIRS = ("transcripts", "wordforword", "memo_draft")
+_COMPRESSED_SUFFIX = ".gz"
+_MIN_COMPRESS_BYTES = 4096 # Smaller files gain nothing from gzip
+_MAX_LIFECYCLE_ENTRIES = 20
+
+
+def directory_size(path: str) -> int:
+    """Total size of the files below `path` (0 if it doesn't exist)."""
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError):
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            continue # Removed while scanning
+    return total
+
+
+def _rewrite(source_path: str, target_path: str, open_source, open_target):
+    # Written under a temporary name and renamed, so an interruption never leaves a truncated file
+    tmp_path = f"{target_path}.tmp"
+    with open_source(source_path, "rb") as source, open_target(tmp_path, "wb") as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+    shutil.copystat(source_path, tmp_path)
+    os.replace(tmp_path, target_path)
+    os.remove(source_path)
+
+
+def compress_text_files(task_base_dir: str) -> Tuple[int, int]:
+    """gzip the text intermediates of a task; returns (files, bytes saved)."""
+    files = saved = 0
+    for dir_name in _TEXT_DIRS:
+        dir_path = os.path.join(task_base_dir, dir_name)
+        if not os.path.isdir(dir_path):
+            continue
+        for name in sorted(os.listdir(dir_path)):
+            path = os.path.join(dir_path, name)
+            if name.endswith((_COMPRESSED_SUFFIX, ".tmp")) or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            if size < _MIN_COMPRESS_BYTES:
+                continue
+            _rewrite(path, path + _COMPRESSED_SUFFIX, open, gzip.open)
+            files += 1
+            saved += size - os.path.getsize(path + _COMPRESSED_SUFFIX)
+    return files, saved
+
+
+def stored_file(path: str) -> Optional[Tuple[str, bool]]:
+    """Where a task file lives now: (path, False), (gzipped copy, True) once compacted, or None."""
+    if os.path.isfile(path):
+        return path, False
+    if os.path.isfile(path + _COMPRESSED_SUFFIX):
+        return path + _COMPRESSED_SUFFIX, True
+    return None
+
+
+def restore_compressed_files(task_base_dir: str) -> int:
+    """Unpack text intermediates compressed by the lifecycle manager (before a task runs again)."""
+    restored = 0
+    for dir_name in _TEXT_DIRS:
+        dir_path = os.path.join(task_base_dir, dir_name)
+        if not os.path.isdir(dir_path):
+            continue
+        for name in sorted(os.listdir(dir_path)):
+            if name.endswith(_COMPRESSED_SUFFIX):
+                path = os.path.join(dir_path, name)
+                _rewrite(path, path[:-len(_COMPRESSED_SUFFIX)], gzip.open, open)
+                restored += 1
+    return restored
+
+
+def remove_segments(task_base_dir: str) -> Tuple[int, int]:
+    """
+    Delete the audio segments (and the transcoded intermediate) of a task whose transcripts
+    are all confirmed by its manifest; returns (files, bytes freed). The stages stay
+    complete in the manifest, so a retry doesn't split and transcribe again.
+    """
+    manifest = TaskManifest(task_base_dir)
+    if not manifest.is_stage_complete("transcribe"):
+        return 0, 0
+    files = freed = 0
+    paths = manifest.release_artifacts("split") + manifest.release_artifacts("transcode")
+    segments_dir = os.path.join(task_base_dir, "audio_segments")
+    if os.path.isdir(segments_dir):
+        # Also leftovers of earlier partial runs that the manifest no longer lists
+        paths += [os.path.join(segments_dir, name) for name in os.listdir(segments_dir)]
+    for path in set(paths):
+        if os.path.isfile(path):
+            freed += os.path.getsize(path)
+            os.remove(path)
+            files += 1
+    return files, freed
+
+
+
+def clear_task_outputs(task_base_dir: str, keep: List[str]) -> Tuple[int, int]:
+    """
+    Delete everything a run left in a task directory (manifest, segments, transcripts,
+    drafts, documents, staging directories) except the files in `keep`, i.e. the upload;
+    returns (files, bytes freed). Emptied subdirectories are kept for a later run.
+    """
+    keep_paths = {os.path.realpath(path) for path in keep if path}
+    files = freed = 0
+    try:
+        entries = list(os.scandir(task_base_dir))
+    except FileNotFoundError:
+        return 0, 0
+    for entry in entries:
+        if os.path.realpath(entry.path) in keep_paths:
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                files += sum(len(names) for _, _, names in os.walk(entry.path))
+                freed += directory_size(entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                if not entry.name.startswith("."): # Staging directories are not recreated
+                    os.makedirs(entry.path, exist_ok=True)
+            else:
+                freed += entry.stat(follow_symlinks=False).st_size
+                os.remove(entry.path)
+                files += 1
+        except FileNotFoundError:
+            continue # Removed meanwhile, e.g. by a stage cleaning up its staging directory
+    return files, freed
+
+
+class LifecycleManager:
+    """
+    Keeps AUDIO_TARGET_DIR bounded on a background thread.
+
+    Finished tasks are compacted once (segments removed after their transcripts are
+    confirmed, text intermediates gzipped) and later deleted by the age and size retention
+    policies. Each pass handles at most LIFECYCLE_BATCH_TASKS tasks per step and claims
+    every task with a conditional UPDATE of Task.storage_state, so workers never wait for
+    it and several nodes can run it. What was done is appended to Task.lifecycle.
+    """
+
+    def __init__(self, root: Optional[str] = None, interval: float = LIFECYCLE_INTERVAL_SECONDS,
+                 batch_size: int = LIFECYCLE_BATCH_TASKS):
+        self.root = root or os.environ.get("AUDIO_TARGET_DIR")
+        self._interval = interval
+        self._batch_size = max(1, batch_size)
+        self._usage: Optional[Tuple[float, int, int]] = None # (measured at, task bytes, cache bytes)
+        self._usage_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # --- Lifecycle ---
+    def start(self):
+        if self._thread is not None or not LIFECYCLE_ENABLED:
+            return
+        if not self.root or not os.path.isdir(self.root):
+            logging.warning("Lifecycle: AUDIO_TARGET_DIR is not a directory; lifecycle manager not started.")
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="storage-lifecycle", daemon=True)
+        self._thread.start()
+        logging.info("Lifecycle: Manager started.")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def notify(self):
+        self._wakeup.set()
+
+    # --- Storage usage and admission ---
+    def storage_usage(self, refresh: bool = False) -> int:
+        """
+        Bytes held by task directories plus cached stage outputs. Tasks not measured yet
+        count with their upload size; stored originals share their inode with the task
+        uploads and are not counted twice.
+        """
+        _, task_bytes, cache_bytes = self._measure(refresh)
+        return task_bytes + cache_bytes
+
+    def task_storage_bytes(self, refresh: bool = False) -> int:
+        """Bytes held by task directories alone, the part expiring tasks can free."""
+        return self._measure(refresh)[1]
+
+    def _measure(self, refresh: bool) -> Tuple[float, int, int]:
+        with self._usage_lock:
+            cached = self._usage
+        if not refresh and cached and time.monotonic() - cached[0] < STORAGE_USAGE_CACHE_SECONDS:
+            return cached
+        with session_scope() as db:
+            task_bytes = db.query(func.coalesce(func.sum(func.coalesce(Task.storage_bytes, Task.file_size, 0)), 0)).filter(
+                or_(Task.storage_state.is_(None), Task.storage_state != "expired")
+            ).scalar() or 0
+            cache_bytes = db.query(func.coalesce(func.sum(CacheEntry.size_bytes), 0)).filter(
+                CacheEntry.kind != "original"
+            ).scalar() or 0
+        usage = (time.monotonic(), int(task_bytes), int(cache_bytes))
+        with self._usage_lock:
+            self._usage = usage
+        return usage
+
+    def record_upload(self, size_bytes: int):
+        """Count a new upload in the cached total right away."""
+        with self._usage_lock:
+            if self._usage:
+                measured_at, task_bytes, cache_bytes = self._usage
+                self._usage = (measured_at, task_bytes + (size_bytes or 0), cache_bytes)
+
+    def admission_error(self, incoming_bytes: int = 0) -> Optional[str]:
+        """Why an upload of `incoming_bytes` must be refused, or None when there is room."""
+        if not self.root or not os.path.isdir(self.root):
+            return None
+        free = shutil.disk_usage(self.root).free
+        if free - incoming_bytes < STORAGE_MIN_FREE_BYTES:
+            self.notify()
+            return "The server is running out of disk space."
+        if STORAGE_QUOTA_BYTES > 0 and self.storage_usage() + incoming_bytes > STORAGE_QUOTA_BYTES:
+            self.notify() # Let size retention free space now rather than at the next pass
+            return "The storage quota for recordings is exhausted."
+        return None
+
+    # --- Task bookkeeping ---
+    def _claim(self, task_id: str, from_states: Tuple[Optional[str], ...], to_state: str) -> bool:
+        conditions = [Task.storage_state.in_([s for s in from_states if s is not None])]
+        if None in from_states:
+            conditions.append(Task.storage_state.is_(None))
+        with session_scope() as db:
+            return db.query(Task).filter(
+                Task.task_id == task_id, Task.status.in_(FINISHED_STATUSES), or_(*conditions)
+            ).update({Task.storage_state: to_state}, synchronize_session=False) == 1
+
+    def _record(self, task_id: str, state: str, storage_bytes: int, entry: Dict):
+        with session_scope() as db:
+            task = db.query(Task).filter(Task.task_id == task_id).first()
+            if task is None:
+                return
+            entry = {"at": datetime.now().isoformat(timespec="seconds"), **entry}
+            task.lifecycle = ((task.lifecycle or []) + [entry])[-_MAX_LIFECYCLE_ENTRIES:]
+            task.storage_state = state
+            task.storage_bytes = storage_bytes
+            task.storage_checked_at = datetime.now()
+
+    def _task_dir(self, task_id: str) -> str:
+        return os.path.join(self.root, task_id)
+
+    # --- Steps ---
+    def measure_active(self) -> int:
+        """Refresh storage_bytes of running tasks (few at a time, and they keep growing)."""
+        with session_scope() as db:
+            task_ids = [row.task_id for row in db.query(Task.task_id).filter(Task.status.in_(ACTIVE_STATUSES))]
+        for task_id in task_ids:
+            size = directory_size(self._task_dir(task_id))
+            with session_scope() as db:
+                db.query(Task).filter(Task.task_id == task_id).update(
+                    {Task.storage_bytes: size, Task.storage_checked_at: datetime.now()}, synchronize_session=False
+                )
+        return len(task_ids)
+
+    def compact_task(self, task_id: str) -> bool:
+        if not self._claim(task_id, (None,), "compacting"):
+            return False
+        task_dir = self._task_dir(task_id)
+        entry: Dict = {"action": "compact"}
+        try:
+            if LIFECYCLE_DELETE_SEGMENTS:
+                entry["segments_removed"], entry["segment_bytes_freed"] = remove_segments(task_dir)
+            if LIFECYCLE_COMPRESS_TEXT:
+                entry["files_compressed"], entry["compression_bytes_saved"] = compress_text_files(task_dir)
+        except Exception as e:
+            # Recorded as compacted anyway: a half-done pass is harmless and retrying it every pass is not
+            logging.error(f"Task {task_id}: Lifecycle compaction failed: {e}", exc_info=True)
+            entry["error"] = str(e)[:500]
+        self._record(task_id, "compacted", directory_size(task_dir), entry)
+        logging.info(f"Task {task_id}: Storage compacted: {entry}")
+        return True
+
+    def expire_task(self, task_id: str, reason: str) -> int:
+        """Delete a finished task's directory; returns the bytes freed."""
+        if not self._claim(task_id, (None, "compacted"), "expiring"):
+            return 0
+        task_dir = self._task_dir(task_id)
+        freed = directory_size(task_dir)
+        shutil.rmtree(task_dir, ignore_errors=True)
+        self._record(task_id, "expired", 0, {"action": "expire", "reason": reason, "bytes_freed": freed})
+        logging.info(f"Task {task_id}: Task directory deleted ({reason} retention, {freed} bytes).")
+        return freed
+
+    def _finished_tasks(self, states: Tuple[Optional[str], ...], finished_before: Optional[datetime] = None) -> List[str]:
+        """Oldest finished tasks in one of `states`, at most one batch."""
+        finished_at = func.coalesce(Task.finish_time, Task.last_update_time)
+        conditions = [Task.storage_state.in_([s for s in states if s is not None])]
+        if None in states:
+            conditions.append(Task.storage_state.is_(None))
+        with session_scope() as db:
+            query = db.query(Task.task_id).filter(Task.status.in_(FINISHED_STATUSES), or_(*conditions))
+            if finished_before is not None:
+                query = query.filter(finished_at < finished_before)
+            return [row.task_id for row in query.order_by(finished_at.asc()).limit(self._batch_size)]
+
+    def run_pass(self) -> bool:
+        """One incremental pass; True when a step filled its batch and more work is waiting."""
+        more = False
+        self.measure_active()
+
+        if LIFECYCLE_DELETE_SEGMENTS or LIFECYCLE_COMPRESS_TEXT:
+            task_ids = self._finished_tasks((None,), datetime.now() - timedelta(seconds=LIFECYCLE_COMPACT_AFTER_SECONDS))
+            for task_id in task_ids:
+                if self._stop.is_set():
+                    return False
+                self.compact_task(task_id)
+            more = more or len(task_ids) == self._batch_size
+
+        if LIFECYCLE_RETENTION_DAYS > 0:
+            task_ids = self._finished_tasks((None, "compacted"), datetime.now() - timedelta(days=LIFECYCLE_RETENTION_DAYS))
+            for task_id in task_ids:
+                if self._stop.is_set():
+                    return False
+                self.expire_task(task_id, "age")
+            more = more or len(task_ids) == self._batch_size
+
+        if LIFECYCLE_MAX_BYTES > 0:
+            # Task bytes only: expiring tasks never shrinks the content store, which has its own LRU limit
+            usage = self.task_storage_bytes(refresh=True)
+            while usage > LIFECYCLE_MAX_BYTES and not self._stop.is_set():
+                task_ids = self._finished_tasks((None, "compacted"))
+                if not task_ids:
+                    logging.warning(f"Lifecycle: Task data ({usage} bytes) exceeds LIFECYCLE_MAX_BYTES, "
+                                    f"but no finished task is left to delete.")
+                    break
+                for task_id in task_ids:
+                    usage -= self.expire_task(task_id, "size")
+                    if usage <= LIFECYCLE_MAX_BYTES or self._stop.is_set():
+                        break
+            self.storage_usage(refresh=True)
+        return more
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                more = self.run_pass()
+            except Exception as e:
+                logging.error(f"Lifecycle: Pass failed: {e}", exc_info=True)
+                more = False
+            # A full batch means a backlog (e.g. after enabling the manager): continue after a short breather
+            self._wakeup.wait(timeout=1.0 if more else self._interval)
+            self._wakeup.clear()
+
+
+lifecycle_manager = LifecycleManager()
@@ -0,0 +1,528 @@
+import base64
+import email.policy
+import html
+import logging
+import mimetypes
+import os
+import re
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from email.mime.text import MIMEText
+from email.utils import formataddr, formatdate, make_msgid
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_
+
+from .db import SessionLocal, EmailOutbox, Task, TaskBatch, session_scope
+from .tasklog import task_log_context
+from .downloads import email_download_url, email_files_url
+
+# --- Mail Configuration ---
+MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
+MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+MAIL_SMTP_SERVER = os.environ.get("MAIL_SMTP_SERVER")
+MAIL_SMTP_PORT = int(os.environ.get("MAIL_SMTP_PORT", "587")) # Default to 587 if not set
+MAIL_SENDER_NAME = os.environ.get("MAIL_SENDER_NAME", "Audio2Memo Notification")
+# STARTTLS before login; turn off only for a local SMTP stub (e.g. aiosmtpd) in tests
+MAIL_SMTP_STARTTLS = os.environ.get("MAIL_SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+MAIL_SMTP_TIMEOUT = float(os.environ.get("MAIL_SMTP_TIMEOUT", "30"))
+# An authenticated connection is reused until it has been idle this long (seconds)
+MAIL_SMTP_IDLE_SECONDS = float(os.environ.get("MAIL_SMTP_IDLE_SECONDS", "60"))
+# Delivery attempts per message; retries back off exponentially from MAIL_RETRY_BASE_DELAY seconds
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", "6"))
+MAIL_RETRY_BASE_DELAY = float(os.environ.get("MAIL_RETRY_BASE_DELAY", "30"))
+# Fallback polling interval (seconds); enqueue_task_email wakes the sender immediately
+MAIL_POLL_INTERVAL = float(os.environ.get("MAIL_POLL_INTERVAL", "15"))
+# A message stuck in 'sending' longer than this (e.g. the node died) is picked up again
+MAIL_SEND_LEASE_SECONDS = float(os.environ.get("MAIL_SEND_LEASE_SECONDS", "300"))
+# Larger documents are linked instead of attached when download links are configured (DOWNLOAD_BASE_URL)
+MAIL_MAX_ATTACHMENT_BYTES = int(os.environ.get("MAIL_MAX_ATTACHMENT_BYTES", str(10 * 1024 * 1024)))
+# Total size of the DOCX files attached to one batch summary; documents beyond it are only listed
+MAIL_BATCH_ATTACHMENT_BYTES = int(os.environ.get("MAIL_BATCH_ATTACHMENT_BYTES", str(20 * 1024 * 1024)))
+
+# Attachments are read and base64-encoded in chunks of this many bytes (a multiple of 57,
+# so every chunk encodes to whole 76-character lines)
+_ATTACHMENT_CHUNK_BYTES = 57 * 1024
+_SMTP_POLICY = email.policy.SMTP
+
+
+def mail_configured() -> bool:
+    return bool(MAIL_SMTP_SERVER and MAIL_USERNAME)
+
+
+def render_task_email(task_id: str, project_name: str, status: str, error_message: Optional[str],
+                      download_url: Optional[str] = None, attached: bool = True,
+                      files_url: Optional[str] = None) -> Tuple[str, str]:
+    """Subject and HTML body of a task notification."""
+    if status == "completed":
+        subject = f"任务完成通知: {project_name} (ID: {task_id}) 已处理完毕"
+        result_html = "<p>处理结果已作为附件发送，请查收。</p>" if attached else ""
+        if download_url:
+            link = f'<a href="{html.escape(download_url)}">{html.escape(download_url)}</a>'
+            result_html += f"<p>{'也可' if attached else '处理结果文件较大，请'}通过以下链接下载: {link}</p>"
+        if files_url:
+            link = f'<a href="{html.escape(files_url)}">{html.escape(files_url)}</a>'
+            result_html += f"<p>逐字稿、纪要初稿与转录文本等全部产物: {link}</p>"
+        body_html = f"""
+        <html>
+            <body>
+                <p>您好,</p>
+                <p>您的音频转写任务 <b>{html.escape(project_name)}</b> (任务ID: {task_id}) 已成功处理完毕。</p>
+                {result_html}
+                <p>感谢使用我们的服务。</p>
+            </body>
+        </html>"""
+    elif status == "failed":
+        subject = f"任务失败通知: {project_name} (ID: {task_id}) 处理失败"
+        body_html = f"""\
+        <html>
+            <body>
+                <p>您好,</p>
+                <p>非常抱歉，您的音频转写任务 <b>{html.escape(project_name)}</b> (任务ID: {task_id}) 处理失败。</p>
+        """
+        if error_message:
+            body_html += f"<p>错误详情: <pre>{html.escape(error_message)}</pre></p>"
+        body_html += "<p>请检查您的文件或联系支持人员。 </p></body></html>"
+    else:
+        raise ValueError(f"Unknown task status for email: {status}")
+    return subject, body_html
+
+
+def enqueue_task_email(task_id: str, project_name: str, to_email: str, cc_emails: Optional[str], status: str,
+                       error_message: Optional[str] = None, attachment_path: Optional[str] = None) -> int:
+    """
+    Put a task notification into the outbox and return its id. The pipeline worker is done
+    after this; delivery, connection reuse and retries are left to the OutboxSender.
+    With download links configured the mail links to the document, and documents larger
+    than MAIL_MAX_ATTACHMENT_BYTES are only linked.
+    """
+    download_url = email_download_url(task_id, attachment_path) if attachment_path else None
+    if download_url and os.path.isfile(attachment_path) and os.path.getsize(attachment_path) > MAIL_MAX_ATTACHMENT_BYTES:
+        logging.info(f"Task {task_id}: {attachment_path} exceeds MAIL_MAX_ATTACHMENT_BYTES, sending a download link instead.")
+        attachment_path = None
+    subject, body_html = render_task_email(task_id, project_name, status, error_message,
+                                           download_url=download_url, attached=attachment_path is not None,
+                                           files_url=email_files_url(task_id) if status == "completed" else None)
+    with session_scope() as db:
+        message = EmailOutbox(
+            task_id=task_id,
+            kind=status,
+            status="pending",
+            sender=MAIL_USERNAME,
+            to_email=to_email,
+            cc_emails=cc_emails or None,
+            subject=subject,
+            body_html=body_html,
+            attachment_path=attachment_path,
+            attempts=0,
+            next_attempt_at=datetime.now(),
+            created_at=datetime.now(),
+        )
+        db.add(message)
+        task = db.query(Task).filter(Task.task_id == task_id).first()
+        if task:
+            task.email_status = "Queued"
+        db.flush()
+        message_id = message.id
+    outbox_sender.notify()
+    logging.info(f"Task {task_id}: Notification email queued (outbox id {message_id}).")
+    return message_id
+
+
+_BATCH_STATUS_LABELS = {"completed": "已完成", "failed": "失败", "timed_out": "超时", "cancelled": "已取消"}
+
+
+def render_batch_email(batch_id: str, tasks: List[Task], attached: List[str]) -> Tuple[str, str]:
+    """Subject and HTML body of the combined notification of a batch: one row per task."""
+    completed = sum(1 for task in tasks if task.status == "completed")
+    subject = f"批量任务完成通知: {completed}/{len(tasks)} 个录音已处理完毕 (批次ID: {batch_id})"
+    rows = []
+    for task in tasks:
+        docx_path = (task.result_files or {}).get("docx_path") if isinstance(task.result_files, dict) else None
+        if task.status == "completed":
+            download_url = email_download_url(task.task_id, docx_path) if docx_path else None
+            if docx_path in attached:
+                note = "见附件"
+            elif download_url:
+                note = f'<a href="{html.escape(download_url)}">下载</a>'
+            else:
+                note = "文档过大未附上，请在任务列表中查看"
+        else:
+            note = html.escape((task.error or "")[:300])
+        rows.append(f"<tr><td>{html.escape(task.file_name or '')}</td><td>{task.task_id}</td>"
+                    f"<td>{_BATCH_STATUS_LABELS.get(task.status, task.status)}</td><td>{note}</td></tr>")
+    body_html = f"""
+        <html>
+            <body>
+                <p>您好,</p>
+                <p>您批量提交的 {len(tasks)} 个音频转写任务 (批次ID: {batch_id}) 已全部处理结束，其中 {completed} 个成功。</p>
+                <table border="1" cellpadding="4" cellspacing="0">
+                    <tr><th>文件</th><th>任务ID</th><th>状态</th><th>说明</th></tr>
+                    {"".join(rows)}
+                </table>
+                <p>成功任务的会议纪要已作为附件发送，请查收。</p>
+                <p>感谢使用我们的服务。</p>
+            </body>
+        </html>"""
+    return subject, body_html
+
+
+def queue_batch_email(db, batch: TaskBatch, tasks: List[Task]) -> EmailOutbox:
+    """
+    Add the combined notification of a finished batch to the outbox within the caller's
+    transaction (so claiming the batch and queueing its email commit together). The DOCX
+    of every completed task is attached, up to MAIL_BATCH_ATTACHMENT_BYTES in total.
+    The caller wakes the sender after committing.
+    """
+    attached, attached_bytes = [], 0
+    for task in tasks:
+        docx_path = (task.result_files or {}).get("docx_path") if isinstance(task.result_files, dict) else None
+        if task.status != "completed" or not docx_path or not os.path.isfile(docx_path):
+            continue
+        size = os.path.getsize(docx_path)
+        if attached_bytes + size > MAIL_BATCH_ATTACHMENT_BYTES:
+            logging.warning(f"Batch {batch.batch_id}: {docx_path} would exceed the attachment limit; listed only.")
+            continue
+        attached.append(docx_path)
+        attached_bytes += size
+    subject, body_html = render_batch_email(batch.batch_id, tasks, attached)
+    message = EmailOutbox(
+        task_id=None,
+        batch_id=batch.batch_id,
+        kind="batch",
+        status="pending",
+        sender=MAIL_USERNAME,
+        to_email=batch.to_email,
+        cc_emails=batch.cc_emails or None,
+        subject=subject,
+        body_html=body_html,
+        attachment_paths=attached,
+        attempts=0,
+        next_attempt_at=datetime.now(),
+        created_at=datetime.now(),
+    )
+    db.add(message)
+    for task in tasks:
+        task.email_status = "Queued (batch summary)"
+    logging.info(f"Batch {batch.batch_id}: Summary email of {len(tasks)} task(s) queued with {len(attached)} attachment(s).")
+    return message
+
+
+def _message_label(message: EmailOutbox) -> str:
+    return f"Batch {message.batch_id}" if message.batch_id else f"Task {message.task_id}"
+
+
+def _message_tasks(db, message: EmailOutbox) -> List[Task]:
+    """Tasks whose email_status reflects this message: the task, or the tasks included in the batch summary."""
+    if message.batch_id:
+        # Tasks that finished after the summary was queued (retries) report through their own emails
+        return db.query(Task).join(TaskBatch, TaskBatch.batch_id == Task.batch_id).filter(
+            Task.batch_id == message.batch_id,
+            func.coalesce(Task.finish_time, Task.last_update_time) <= TaskBatch.notified_at).all()
+    task = db.query(Task).filter(Task.task_id == message.task_id).first()
+    return [task] if task else []
+
+
+# --- Message generation ---
+def _fold_headers(headers: EmailMessage) -> bytes:
+    return b"".join(_SMTP_POLICY.fold_binary(name, value) for name, value in headers.items())
+
+
+def _attachment_headers(path: str) -> bytes:
+    file_name = os.path.basename(path)
+    part = EmailMessage(policy=_SMTP_POLICY)
+    part["Content-Type"] = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    part.set_param("name", file_name) # RFC 2231-encoded when not ASCII
+    part["Content-Transfer-Encoding"] = "base64"
+    part["Content-Disposition"] = "attachment"
+    part.set_param("filename", file_name, header="Content-Disposition")
+    return _fold_headers(part)
+
+
+def message_chunks(message: EmailOutbox) -> Iterator[bytes]:
+    """
+    The MIME message as a stream of CRLF-terminated lines. Attachments are read and
+    encoded chunk by chunk, so only one chunk of them is ever in memory.
+    """
+    boundary = f"=_audio2memo_{uuid.uuid4().hex}"
+    headers = EmailMessage(policy=_SMTP_POLICY)
+    headers["From"] = formataddr((MAIL_SENDER_NAME, message.sender))
+    headers["To"] = message.to_email
+    if message.cc_emails:
+        headers["Cc"] = message.cc_emails
+    headers["Subject"] = message.subject
+    headers["Date"] = formatdate(localtime=True)
+    headers["Message-ID"] = make_msgid(domain=(message.sender or "localhost").rpartition("@")[2] or None)
+    headers["MIME-Version"] = "1.0"
+    headers["Content-Type"] = f'multipart/mixed; boundary="{boundary}"'
+    yield _fold_headers(headers) + b"\r\n"
+
+    yield f"--{boundary}\r\n".encode()
+    yield MIMEText(message.body_html, "html", "utf-8").as_bytes(policy=_SMTP_POLICY) + b"\r\n"
+
+    attachment_paths = ([message.attachment_path] if message.attachment_path else []) + list(message.attachment_paths or [])
+    for attachment_path in attachment_paths:
+        if not os.path.isfile(attachment_path):
+            logging.warning(f"{_message_label(message)}: Attachment {attachment_path} no longer exists; sending without it.")
+            continue
+        yield f"--{boundary}\r\n".encode() + _attachment_headers(attachment_path) + b"\r\n"
+        with open(attachment_path, "rb") as f:
+            for chunk in iter(lambda: f.read(_ATTACHMENT_CHUNK_BYTES), b""):
+                yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+    yield f"--{boundary}--\r\n".encode()
+
+
+def recipients_of(message: EmailOutbox) -> List[str]:
+    recipients = [email.strip() for email in (message.to_email or "").split(",") if email.strip()]
+    if message.cc_emails:
+        recipients.extend([email.strip() for email in message.cc_emails.split(",") if email.strip()])
+    return recipients
+
+
+def send_streaming(smtp: smtplib.SMTP, sender: str, recipients: List[str], chunks: Iterator[bytes]) -> Dict:
+    """
+    smtplib.sendmail() needs the whole message as one string; this issues MAIL/RCPT/DATA
+    itself and writes the message chunk by chunk. Returns the refused recipients, like sendmail.
+    """
+    code, response = smtp.mail(sender)
+    if code != 250:
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    refused = {}
+    for recipient in recipients:
+        code, response = smtp.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+    if len(refused) == len(recipients):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, response = smtp.docmd("data")
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, response)
+    for chunk in chunks:
+        # Chunks always start at a line boundary, so dot-stuffing can work per chunk
+        smtp.send(re.sub(rb"(?m)^\.", b"..", chunk))
+    smtp.send(b".\r\n")
+    code, response = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+class SmtpConnection:
+    """One authenticated SMTP session, kept open across messages and reopened when stale."""
+
+    def __init__(self):
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._last_used = 0.0
+
+    def _open(self) -> smtplib.SMTP:
+        logging.info(f"Mail: Connecting to SMTP server {MAIL_SMTP_SERVER}:{MAIL_SMTP_PORT}")
+        smtp = smtplib.SMTP(MAIL_SMTP_SERVER, MAIL_SMTP_PORT, timeout=MAIL_SMTP_TIMEOUT)
+        try:
+            smtp.ehlo() # Extended Hello
+            if MAIL_SMTP_STARTTLS:
+                smtp.starttls() # Enable STARTTLS
+                smtp.ehlo() # Re-send ehlo after STARTTLS
+            if MAIL_PASSWORD:
+                smtp.login(MAIL_USERNAME, MAIL_PASSWORD)
+        except Exception:
+            smtp.close()
+            raise
+        return smtp
+
+    def get(self) -> smtplib.SMTP:
+        if self._smtp is not None:
+            if time.monotonic() - self._last_used > MAIL_SMTP_IDLE_SECONDS:
+                self.close()
+            else:
+                try:
+                    if self._smtp.noop()[0] == 250:
+                        return self._smtp
+                except (smtplib.SMTPException, OSError):
+                    pass
+                self.close() # Server dropped the session; open a fresh one
+        self._smtp = self._open()
+        return self._smtp
+
+    def release(self):
+        self._last_used = time.monotonic()
+
+    def close_if_idle(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > MAIL_SMTP_IDLE_SECONDS:
+            self.close()
+
+    def close(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self._smtp.close()
+        self._smtp = None
+
+
+def _is_permanent(error: Exception) -> bool:
+    """5xx replies won't change on retry (bad address, rejected content); everything else might."""
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False # Usually fixed by correcting the credentials, then the retry succeeds
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+    return False
+
+
+class OutboxSender:
+    """
+    Delivers rows of the `email_outbox` table on a dedicated thread.
+
+    The table is the queue: messages survive restarts, a message is claimed with a
+    conditional UPDATE (so several nodes can run a sender), and transient failures are
+    retried with exponential backoff up to MAIL_MAX_ATTEMPTS. One authenticated SMTP
+    connection is reused for consecutive messages.
+    """
+
+    def __init__(self, poll_interval: float = MAIL_POLL_INTERVAL, max_attempts: int = MAIL_MAX_ATTEMPTS,
+                 retry_base_delay: float = MAIL_RETRY_BASE_DELAY, lease_seconds: float = MAIL_SEND_LEASE_SECONDS):
+        self._poll_interval = poll_interval
+        self._max_attempts = max(1, max_attempts)
+        self._retry_base_delay = retry_base_delay
+        self._lease = timedelta(seconds=lease_seconds)
+        self._connection = SmtpConnection()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # --- Lifecycle ---
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="email-outbox", daemon=True)
+        self._thread.start()
+        logging.info("Mail: Outbox sender started.")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def notify(self):
+        self._wakeup.set()
+
+    # --- Claiming ---
+    def _claim_next(self) -> Optional[EmailOutbox]:
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            now = datetime.now()
+            due = or_(
+                and_(EmailOutbox.status == "pending", EmailOutbox.next_attempt_at <= now),
+                and_(EmailOutbox.status == "sending", EmailOutbox.locked_until < now),
+            )
+            for (message_id,) in db.query(EmailOutbox.id).filter(due).order_by(EmailOutbox.next_attempt_at.asc()).limit(10):
+                claimed = db.query(EmailOutbox).filter(EmailOutbox.id == message_id, due).update({
+                    EmailOutbox.status: "sending",
+                    EmailOutbox.locked_until: now + self._lease,
+                    EmailOutbox.attempts: EmailOutbox.attempts + 1,
+                }, synchronize_session=False)
+                db.commit()
+                if claimed == 1:
+                    return db.query(EmailOutbox).filter(EmailOutbox.id == message_id).first()
+            return None
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _idle_timeout(self) -> float:
+        """Sleep until the next scheduled retry, but never longer than the poll interval."""
+        with session_scope() as db:
+            next_due = db.query(func.min(EmailOutbox.next_attempt_at)).filter(EmailOutbox.status == "pending").scalar()
+        if next_due is None:
+            return self._poll_interval
+        return min(self._poll_interval, max(0.0, (next_due - datetime.now()).total_seconds()))
+
+    # --- Delivery ---
+    def deliver(self, message: EmailOutbox):
+        if not mail_configured():
+            self._record_failure(message, "Mail server configuration incomplete.", permanent=True)
+            return
+        recipients = recipients_of(message)
+        try:
+            smtp = self._connection.get()
+            refused = send_streaming(smtp, message.sender, recipients, message_chunks(message))
+            self._connection.release()
+        except Exception as e:
+            # A failure mid-DATA leaves the session unusable; start the next message on a new one
+            self._connection.close()
+            self._record_failure(message, f"{type(e).__name__}: {e}", permanent=_is_permanent(e))
+            return
+        if refused:
+            logging.warning(f"{_message_label(message)}: Email not accepted for {list(refused)}: {refused}")
+        self._record_sent(message, recipients)
+
+    def _record_sent(self, message: EmailOutbox, recipients: List[str]):
+        with session_scope() as db:
+            db.query(EmailOutbox).filter(EmailOutbox.id == message.id).update({
+                EmailOutbox.status: "sent", EmailOutbox.sent_at: datetime.now(),
+                EmailOutbox.locked_until: None, EmailOutbox.last_error: None,
+            }, synchronize_session=False)
+            for task in _message_tasks(db, message):
+                task.email_sent = True
+                task.email_status = {"completed": "Sent", "batch": "Sent (batch summary)"}.get(message.kind, "Sent (failure notice)")
+        logging.info(f"{_message_label(message)}: Email sent successfully to {recipients} (attempt {message.attempts}).")
+
+    def _record_failure(self, message: EmailOutbox, error: str, permanent: bool):
+        give_up = permanent or message.attempts >= self._max_attempts
+        delay = self._retry_base_delay * (2 ** (message.attempts - 1))
+        with session_scope() as db:
+            db.query(EmailOutbox).filter(EmailOutbox.id == message.id).update({
+                EmailOutbox.status: "failed" if give_up else "pending",
+                EmailOutbox.next_attempt_at: datetime.now() + timedelta(seconds=min(delay, 3600)),
+                EmailOutbox.locked_until: None,
+                EmailOutbox.last_error: error[:2000],
+            }, synchronize_session=False)
+            for task in _message_tasks(db, message):
+                task.email_sent = False
+                task.email_status = (f"Failed after {message.attempts} attempt(s): {error}" if give_up
+                                     else f"Retrying (attempt {message.attempts} of {self._max_attempts} failed): {error}")[:2000]
+        if give_up:
+            logging.error(f"{_message_label(message)}: Giving up on email after {message.attempts} attempt(s): {error}")
+        else:
+            logging.warning(f"{_message_label(message)}: Email attempt {message.attempts} failed, retrying in {min(delay, 3600):.0f}s: {error}")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                message = self._claim_next()
+            except Exception as e:
+                logging.error(f"Mail: Failed to claim outbox message: {e}", exc_info=True)
+                message = None
+
+            if message is None:
+                self._connection.close_if_idle()
+                try:
+                    timeout = self._idle_timeout()
+                except Exception:
+                    timeout = self._poll_interval
+                self._wakeup.wait(timeout=timeout)
+                self._wakeup.clear()
+                continue
+            try:
+                with task_log_context(message.task_id):
+                    self.deliver(message)
+            except Exception as e:
+                logging.error(f"Mail: Unexpected error delivering outbox message {message.id}: {e}", exc_info=True)
+        self._connection.close()
+
+
+outbox_sender = OutboxSender()
@@ -8,47 +8,109 @@ import os # Ensure os is imported early if not already
 # it should find backend_fastapi/.env
 load_dotenv()
 
-from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException, Depends, BackgroundTasks # Added BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, Request, HTTPException, Depends, Query, Header as HeaderParam
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from pydantic import BaseModel # Ensure BaseModel is imported
 import logging
 import uuid
+import asyncio
 import shutil
-from typing import Optional, Dict, List
+import functools
+import importlib
+import queue
+import threading
+import time
+from concurrent.futures import wait as wait_futures
+from typing import Optional, Dict, List, Callable, Tuple
 from datetime import datetime
-from .db import SessionLocal, Task # Assuming db.py defines SessionLocal and Task model correctly
-from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+from .db import AsyncSessionLocal, Task, TaskBatch, ACTIVE_STATUSES, session_scope, async_engine, engine, api_pool_metrics, worker_pool_metrics # Assuming db.py defines SessionLocal and Task model correctly
+from .scheduler import TaskScheduler
+from .checkpoint import TaskManifest, file_sha256
+from .cas import get_content_store, stage_cache_key, prompt_hash
+from .transcription import transcribe_segments
+from .pipeline import Stage, StageGraph, PARALLEL_STATUS
+from .segmentation import PIPELINE_STREAMING_SPLIT, PIPELINE_TRANSCODE, stream_split_audio, transcode_audio, transcoded_extension
+from .events import task_events
+from .changefeed import current_version, next_version
+from .search import index_task_documents, matching_task_ids
+from .mediaprobe import probe_media, MediaProbeError
+from .eta import eta_estimator
+from .mapreduce import use_chunked_mode, chunked_wordforword, chunked_memo, token_encoding
+from .lifecycle import lifecycle_manager, restore_compressed_files, clear_task_outputs, BUSY_STORAGE_STATES
+from .mailer import enqueue_task_email, outbox_sender
+from .downloads import (
+    task_artifacts, find_artifact, verify_link, file_url, archive_url, file_response, archive_response,
+    task_token, verify_task_token, DOWNLOAD_SIGNING_KEY, DOWNLOAD_ALLOW_UNSIGNED,
+)
+from .batches import (
+    BATCH_MAX_BYTES, is_archive, open_archive, archive_members, check_batch_size, extract_member,
+    batch_handles_notification,
+)
+from .tasklog import configure_logging, task_log_context
+from .warmup import pipeline_components
+from .cancellation import CANCELLED_BY_USER, LEASE_LOST, TaskCancelled, cancellation_scope, cancel_reason, cancel_requested, check_cancelled, request_cancel
+from .metrics import StageMetrics, total_size, observe_task_started, observe_task_finished
+from .uploads import (
+    UploadSizeLimitMiddleware, MAX_UPLOAD_BYTES, save_upload_file, copy_and_hash, create_upload_session,
+    get_upload_session, append_to_upload_session, complete_upload_session, claim_completed_upload,
+)
+from sqlalchemy import select, tuple_, update
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
+import base64
 import json
-import smtplib # For email
-from email.mime.text import MIMEText # For email
-from email.mime.multipart import MIMEMultipart # For email
-from email.header import Header # For email
-from email.utils import formataddr # For email
-from email.mime.application import MIMEApplication # For attaching files
 
 
 # Assuming db.py defines SessionLocal and Task model correctly
 # from .db import SessionLocal, Task # Already imported
 
-# --- Import refactored audio2memo functions --- 
-# (Adjust paths if your structure differs slightly, e.g., no 'app' prefix if main.py is inside 'app')
-try:
-    from .audio2memo import process_audio
-    from .audio2memo import audio2text
-    from .audio2memo import text_to_wordforword
-    from .audio2memo import wordforword_to_memo
-    from .audio2memo import combine_to_docx
-    # funcs module might not be needed directly if others import it
-except ImportError as e:
-    logging.error(f"Failed to import audio2memo modules: {e}. Ensure they exist and paths are correct.")
-    # Depending on setup, you might want to exit or raise an error here
-    process_audio = audio2text = text_to_wordforword = wordforword_to_memo = combine_to_docx = None
-
-app = FastAPI()
-
-# 日志配置
-logging.basicConfig(filename='transcribe.log', level=logging.INFO,
-                    format='%(asctime)s %(levelname)s %(message)s')
+# --- audio2memo modules --- 
+# Not imported with the app: they pull in pydub, openai, google-generativeai, python-docx and
+# tiktoken. The warm-up (warmup.py) loads them after startup, or the pipeline on first use.
+AUDIO2MEMO_MODULES = ["process_audio", "audio2text", "text_to_wordforword", "wordforword_to_memo", "combine_to_docx"]
+for _module_name in AUDIO2MEMO_MODULES:
+    pipeline_components.register(_module_name, functools.partial(importlib.import_module, f".audio2memo.{_module_name}", __package__))
+
+def audio2memo(module_name: str):
+    """An audio2memo module, imported on first use (waits for the warm-up if it is importing it)."""
+    return pipeline_components.load(module_name)
+
+def _require_pipeline():
+    if pipeline_components.failed(AUDIO2MEMO_MODULES):
+        logging.error("audio2memo modules not loaded, cannot process request.")
+        raise HTTPException(status_code=500, detail="Server configuration error: audio processing module failed to load.")
+
+def _on_pipeline_loaded(ok: bool):
+    # Start the task scheduler; it re-enqueues tasks left unfinished by a previous run
+    if ok:
+        scheduler.start()
+    else:
+        logging.error("audio2memo modules not loaded, task scheduler not started.")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Requests are served while the pipeline loads; the scheduler starts once it is loaded
+    pipeline_components.start(on_ready=_on_pipeline_loaded)
+    task_events.start()
+    outbox_sender.start()
+    lifecycle_manager.start()
+    yield
+    pipeline_components.stop()
+    scheduler.stop()
+    outbox_sender.stop()
+    lifecycle_manager.stop()
+    task_events.stop()
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=BATCH_MAX_BYTES, path_prefixes=("/api/batches",))
+
+# 日志配置：经队列异步写入（JSON，按大小轮转），并按任务收集到 Task.log
+configure_logging()
 
 # Load AUDIO_TARGET_DIR from environment variable
 # It will be checked for validity within the transcribe endpoint.
@@ -56,13 +118,11 @@ AUDIO_TARGET_DIR = os.environ.get("AUDIO_TARGET_DIR")
 if not AUDIO_TARGET_DIR:
     logging.warning("AUDIO_TARGET_DIR environment variable is not set. The application will fail if a task is submitted unless this is configured correctly.")
     # No default value is set here; the transcribe function must handle the missing configuration.
-
-# --- Load Mail Configuration from Environment --- 
-MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
-MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
-MAIL_SMTP_SERVER = os.environ.get("MAIL_SMTP_SERVER")
-MAIL_SMTP_PORT = os.environ.get("MAIL_SMTP_PORT", "587") # Default to 587 if not set
-MAIL_SENDER_NAME = os.environ.get("MAIL_SENDER_NAME", "Audio2Memo Notification")
+if not DOWNLOAD_SIGNING_KEY:
+    if DOWNLOAD_ALLOW_UNSIGNED:
+        logging.warning("DOWNLOAD_SIGNING_KEY is not set and DOWNLOAD_ALLOW_UNSIGNED is on: task outputs can be downloaded by anyone who can reach the API.")
+    else:
+        logging.warning("DOWNLOAD_SIGNING_KEY is not set: downloads of task outputs are refused (403).")
 
 # --- Define paths for prompts and template --- 
 # Assuming main.py is in the 'app' directory, and audio2memo is a subdirectory
@@ -71,6 +131,54 @@ BASE_AUDIO2MEMO_DIR = os.path.dirname(__file__) # Gets the directory of main.py
 AUDIO2MEMO_MODULE_DIR = os.path.join(BASE_AUDIO2MEMO_DIR, "audio2memo")
 PROMPT_TEXT_TO_WORDFORWORD_PATH = os.path.join(AUDIO2MEMO_MODULE_DIR, "prompts", "text_to_wordforword_prompt.txt")
 PROMPT_WORDFORWORD_TO_MEMO_PATH = os.path.join(AUDIO2MEMO_MODULE_DIR, "prompts", "wordforword_to_memo_prompt.txt")
+# Prompt that merges partial memos of a long recording (chunked mode); the memo prompt unless configured
+PROMPT_MEMO_REDUCE_PATH = os.environ.get("PROMPT_MEMO_REDUCE_PATH") or PROMPT_WORDFORWORD_TO_MEMO_PATH
+# Text structure combine_to_docx fills in; only read ahead of time by the warm-up
+DOCX_TEMPLATE_PATH = os.environ.get("DOCX_TEMPLATE_PATH") or os.path.join(AUDIO2MEMO_MODULE_DIR, "memo_template.txt")
+
+def _load_prompts() -> Dict[str, str]:
+    # Hashed once here; prompt_hash keeps the result until a template changes
+    hashes = {}
+    for path in dict.fromkeys([PROMPT_TEXT_TO_WORDFORWORD_PATH, PROMPT_WORDFORWORD_TO_MEMO_PATH, PROMPT_MEMO_REDUCE_PATH]):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        hashes[path] = prompt_hash(path)
+    return hashes
+
+def _load_token_encoding():
+    encoding = token_encoding()
+    if encoding is None:
+        raise RuntimeError("tiktoken encoding unavailable; token counts are estimated from characters")
+    return encoding
+
+def _load_docx_template():
+    # python-docx parses its bundled default document on the first Document() call
+    docx = importlib.import_module("docx")
+    docx.Document()
+    if os.path.isfile(DOCX_TEMPLATE_PATH):
+        with open(DOCX_TEMPLATE_PATH, "r", encoding="utf-8") as f:
+            return f.read()
+    return None
+
+# Not needed to run tasks, only to make the first one faster: reported by /api/ready without gating it
+pipeline_components.register("prompts", _load_prompts, required=False)
+pipeline_components.register("tiktoken", _load_token_encoding, required=False)
+pipeline_components.register("docx_template", _load_docx_template, required=False)
+
+def get_task_dirs(task_id: str) -> Dict[str, str]:
+    """Directory layout for a task under AUDIO_TARGET_DIR."""
+    task_base_dir = os.path.join(AUDIO_TARGET_DIR, task_id)
+    return {
+        "task_base_dir": task_base_dir,
+        "audio_segments_dir": os.path.join(task_base_dir, "audio_segments"),
+        "transcripts_dir": os.path.join(task_base_dir, "transcripts"),
+        "wordforword_dir": os.path.join(task_base_dir, "wordforword"),
+        "memo_draft_dir": os.path.join(task_base_dir, "memo_draft"),
+        "output_docx_dir": os.path.join(task_base_dir, "output_docx"),
+        # Pipeline intermediates such as the transcoded audio; the upload keeps its own name in
+        # task_base_dir, so nothing the pipeline writes may live there next to it
+        "work_dir": os.path.join(task_base_dir, "_work"),
+    }
 
 # --- Check if necessary files exist (optional but recommended) ---
 
@@ -81,6 +189,19 @@ class TranscribeResponse(BaseModel):
     status: str
     task_id: str # Changed 'project' to 'project_id' for clarity, then to task_id
     message: Optional[str] = None
+    task_token: Optional[str] = None # On submission only: send as X-Task-Token to cancel or retry the task
+
+class CreateUploadRequest(BaseModel):
+    file_name: str
+    total_size: Optional[int] = None # Bytes; when given, the upload completes automatically at this size
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    file_name: str
+    offset: int # Bytes received so far; the next chunk must start here
+    total_size: Optional[int] = None
+    status: str # open / complete / consumed
+    sha256: Optional[str] = None
 
 class TaskStatusResponse(BaseModel):
     # Define fields based on your Task model, excluding SQLAlchemy internal fields
@@ -90,120 +211,96 @@ class TaskStatusResponse(BaseModel):
     last_update_time: datetime
     file_name: Optional[str] = None         # Original uploaded file name
     model: Optional[str] = None             # Model used for processing
-    error: Optional[str] = None             # Error message if status is 'failed' or 'timed_out'
+    error: Optional[str] = None             # Error message if status is 'failed', 'timed_out' or 'cancelled'
     result_files: Optional[Dict[str, str]] = None # Dictionary of output files if 'completed'
     processing_time: Optional[float] = None # Duration in seconds
     to_email: Optional[str] = None          # For user reference
     email_status: Optional[str] = None      # Status of the notification email
+    active_stages: Optional[List[str]] = None # Statuses of the stages running right now (several when stages run in parallel)
+    file_size: Optional[int] = None         # Bytes
+    audio_duration: Optional[float] = None  # Seconds, from the upload-time media probe
+    estimated_start_time: Optional[datetime] = None  # Predicted from the queue and past run times (unfinished tasks only)
+    estimated_finish_time: Optional[datetime] = None
+    storage_state: Optional[str] = None     # Set by the lifecycle manager: compacted, or expired once the files are deleted
+    batch_id: Optional[str] = None          # Set for tasks submitted through /api/batches
+    cancel_requested_at: Optional[datetime] = None # Set by /cancel; the task stops at its next check
     # Consider adding other relevant fields like:
     # output_type: Optional[str] = None
-    # file_size: Optional[int] = None
 
 # New Pydantic model for the list of tasks
+class TaskHistoryResponse(BaseModel):
+    tasks: List[TaskStatusResponse]
+    next_cursor: Optional[str] = None # Pass back as `cursor` for the next (older) page; None on the last page
+
+class TaskEstimate(BaseModel):
+    estimated_start_time: datetime
+    estimated_finish_time: datetime
+
 class TaskListResponse(BaseModel):
     tasks: List[TaskStatusResponse]
+    cursor: int = 0 # Pass back as `since` to receive only later changes
+    full: bool = True # False when `tasks` only holds the changes since the given cursor
+    # Current predictions for every unfinished task, also those not included in a change-feed response
+    estimates: Dict[str, TaskEstimate] = {}
     # total_active: int # Optional: count of tasks returned
 
-# --- Email Sending Function --- 
-def send_email_notification(
-    task_id: str,
-    project_name: str,
-    to_email: str,
-    cc_emails: Optional[str],
-    status: str, # "completed" or "failed"
-    result_files: Optional[Dict[str, str]], # Contains docx_path for completed tasks
-    error_message: Optional[str],
-    attachment_path: Optional[str] = None # New parameter for the attachment
-) -> tuple[bool, str]:
-    if not all([MAIL_USERNAME, MAIL_PASSWORD, MAIL_SMTP_SERVER, MAIL_SMTP_PORT]):
-        logging.error(f"Task {task_id}: Mail server configuration incomplete. Cannot send email.")
-        return False, "Mail server configuration incomplete."
-
-    subject = ""
-    body_html = "" # Using HTML for richer emails
-
-    if status == "completed":
-        subject = f"任务完成通知: {project_name} (ID: {task_id}) 已处理完毕"
-        body_html = f"""
-        <html>
-            <body>
-                <p>您好,</p>
-                <p>您的音频转写任务 <b>{project_name}</b> (任务ID: {task_id}) 已成功处理完毕。</p>
-                <p>处理结果已作为附件发送，请查收。</p> 
-                <p>感谢使用我们的服务。</p>
-            </body>
-        </html>"""
-        # Removed the section listing file paths
-    elif status == "failed":
-        subject = f"任务失败通知: {project_name} (ID: {task_id}) 处理失败"
-        body_html = f"""\
-        <html>
-            <body>
-                <p>您好,</p>
-                <p>非常抱歉，您的音频转写任务 <b>{project_name}</b> (任务ID: {task_id}) 处理失败。</p>
-        """
-        if error_message:
-            body_html += f"<p>错误详情: <pre>{error_message}</pre></p>"
-        body_html += "<p>请检查您的文件或联系支持人员。 </p></body></html>"
-    else:
-        logging.warning(f"Task {task_id}: Attempted to send email for unknown status '{status}'.")
-        return False, f"Unknown task status for email: {status}"
-
-    msg = MIMEMultipart('alternative')
-    msg['From'] = formataddr((str(Header(MAIL_SENDER_NAME, 'utf-8')), MAIL_USERNAME))
-    msg['To'] = to_email
-    if cc_emails:
-        msg['Cc'] = cc_emails
-    msg['Subject'] = Header(subject, 'utf-8')
+class BatchFileResult(BaseModel):
+    file_name: str
+    task_id: Optional[str] = None # Task created for the file
+    task_token: Optional[str] = None # X-Task-Token for cancelling or retrying that task
+    error: Optional[str] = None   # Why the file was rejected (no task was created)
 
-    msg.attach(MIMEText(body_html, 'html', 'utf-8'))
+class BatchSubmitResponse(BaseModel):
+    status: str
+    batch_id: str
+    tasks: List[BatchFileResult] # Accepted recordings, in upload (or archive) order
+    rejected: List[BatchFileResult] = []
+    skipped: List[str] = [] # Archive members that are not audio files
 
-    # Add attachment if provided (for completed tasks)
-    if status == "completed" and attachment_path and os.path.exists(attachment_path):
-        try:
-            with open(attachment_path, "rb") as fil_to_attach:
-                part = MIMEApplication(
-                    fil_to_attach.read(),
-                    Name=os.path.basename(attachment_path)
-                )
-            # After the file is closed
-            part['Content-Disposition'] = f'attachment; filename="{os.path.basename(attachment_path)}"'
-            msg.attach(part)
-            logging.info(f"Task {task_id}: Attached file {attachment_path} to email.")
-        except Exception as e:
-            logging.error(f"Task {task_id}: Failed to attach file {attachment_path} to email: {e}", exc_info=True)
-            # Email will be sent without attachment in this case
+class TaskFile(BaseModel):
+    path: str # Inside the task directory, e.g. output_docx/meeting.docx
+    kind: str # document / wordforword / memo_draft / transcripts
+    size: Optional[int] = None # Bytes; None while the file is stored compressed
+    modified: datetime
+    url: str # Download link (signed when DOWNLOAD_SIGNING_KEY is set)
 
-    recipients = [to_email]
-    if cc_emails:
-        recipients.extend([email.strip() for email in cc_emails.split(',') if email.strip()])
+class TaskFilesResponse(BaseModel):
+    task_id: str
+    files: List[TaskFile]
+    archive_url: str # All files as one ZIP; add `kind` parameters to select kinds
 
-    try:
-        logging.info(f"Task {task_id}: Connecting to SMTP server {MAIL_SMTP_SERVER}:{MAIL_SMTP_PORT}")
-        server = smtplib.SMTP(MAIL_SMTP_SERVER, int(MAIL_SMTP_PORT))
-        server.ehlo() # Extended Hello
-        server.starttls() # Enable STARTTLS
-        server.ehlo() # Re-send ehlo after STARTTLS
-        server.login(MAIL_USERNAME, MAIL_PASSWORD)
-        logging.info(f"Task {task_id}: Sending email to {recipients}")
-        server.sendmail(MAIL_USERNAME, recipients, msg.as_string())
-        server.quit()
-        logging.info(f"Task {task_id}: Email sent successfully to {recipients}.")
-        return True, "Email sent successfully."
-    except smtplib.SMTPAuthenticationError as e:
-        logging.error(f"Task {task_id}: SMTP Authentication Error: {e}. Check username/password.")
-        return False, f"SMTP Authentication Error: {e}"
-    except Exception as e:
-        logging.error(f"Task {task_id}: Failed to send email: {e}", exc_info=True)
-        return False, f"Failed to send email: {e}"
+class BatchStatusResponse(BaseModel):
+    batch_id: str
+    created_at: datetime
+    task_count: int
+    counts: Dict[str, int] # Tasks per status
+    finished: bool # True once no task of the batch is queued or running
+    combined_email: bool
+    notified_at: Optional[datetime] = None # When the summary email was queued (combined_email only)
+    tasks: List[TaskStatusResponse]
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
-    try:
+# Dependency to get DB session (async, from the API pool; workers use db.session_scope)
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+def _dir_size(path: str) -> int:
+    return total_size(os.path.join(path, name) for name in os.listdir(path)) if os.path.isdir(path) else 0
+
+def update_task(task_id: str, owner: Optional[str] = None, **fields) -> Optional[Task]:
+    """
+    Apply `fields` to a task in a short-lived session; returns the updated (detached) row.
+    With `owner`, only while that worker still holds the task (None once another node took it over).
+    """
+    with session_scope() as db:
+        query = db.query(Task).filter(Task.task_id == task_id)
+        if owner is not None:
+            query = query.filter(Task.worker_id == owner).with_for_update()
+        task = query.first()
+        if task:
+            for name, value in fields.items():
+                setattr(task, name, value)
+    return task
 
 # --- Background Task Processing Function ---
 def process_transcription_task( # Renamed and made into a background task
@@ -219,175 +316,576 @@ def process_transcription_task( # Renamed and made into a background task
     transcripts_dir: str,
     wordforword_dir: str,
     memo_draft_dir: str,
-    output_docx_dir: str
+    output_docx_dir: str,
+    work_dir: str,
     # Prompt and template paths are global, so accessible directly
+    audio_sha256: Optional[str] = None # Content hash of the upload, computed here if missing
 ):
-    db: Session = SessionLocal() # Create a new session for the background task
+    # No session is held for the whole run: each status update takes a short-lived one,
+    # so hours-long tasks don't pin pool connections the API and other workers need
     task = None
+    run_started_at = datetime.now()
     # Determine project_name for output files (use original filename base)
     project_name_base = os.path.splitext(original_filename)[0]
     # Basic sanitization for project name
     project_name_sanitized = "".join(c if c.isalnum() or c in [' ', '_', '-'] else '_' for c in project_name_base)
 
     try:
-        task = db.query(Task).filter(Task.task_id == project_id).first()
+        with session_scope() as db:
+            task = db.query(Task).filter(Task.task_id == project_id).first()
         if not task:
             logging.error(f"Background Task {project_id}: Task not found in DB. Aborting processing.")
             return # Or raise an exception to be caught by a higher level background task runner if any
+        observe_task_started(task)
+        if task.storage_state:
+            # Rerun of a task the lifecycle manager already compacted: unpack its text intermediates
+            restored = restore_compressed_files(task_base_dir)
+            update_task(project_id, storage_state=None)
+            logging.info(f"Task {project_id}: Restored {restored} compressed intermediate file(s).")
+        # Timing, bytes and external-call stats per stage (task_stage_metrics table and /metrics)
+        stage_metrics = StageMetrics(project_id, task.attempts)
+
+        # Completion manifest of earlier runs; finished stages and segments are not redone
+        manifest = TaskManifest(task_base_dir)
+        output_wordforword_filepath = os.path.join(wordforword_dir, f"{project_name_sanitized}_wordforword.txt")
+        output_memo_draft_filepath = os.path.join(memo_draft_dir, f"{project_name_sanitized}_memo_draft.txt")
+
+        # Content-addressed reuse: identical recordings processed with the same model and
+        # prompt templates get their transcripts and drafts from the store instead of the APIs
+        content_store = get_content_store(AUDIO_TARGET_DIR)
+        transcripts_cache_key = wordforword_cache_key = memo_draft_cache_key = None # Stay None with the store disabled
+        if content_store:
+            audio_sha256 = audio_sha256 or file_sha256(local_file_path)
+            llm_model_name = os.environ.get("GEMINI_MODEL_NAME")
+            transcripts_cache_key = stage_cache_key(audio_sha256, "transcripts", model_name_param)
+            wordforword_cache_key = stage_cache_key(audio_sha256, "wordforword", model_name_param, llm_model_name,
+                                                    prompt_hash(PROMPT_TEXT_TO_WORDFORWORD_PATH))
+            memo_prompt_parts = [prompt_hash(PROMPT_WORDFORWORD_TO_MEMO_PATH)]
+            if PROMPT_MEMO_REDUCE_PATH != PROMPT_WORDFORWORD_TO_MEMO_PATH:
+                memo_prompt_parts.append(prompt_hash(PROMPT_MEMO_REDUCE_PATH))
+            memo_draft_cache_key = stage_cache_key(audio_sha256, "memo_draft", model_name_param, llm_model_name,
+                                                   *memo_prompt_parts)
+            if not manifest.is_stage_complete("transcribe") and content_store.contains(transcripts_cache_key):
+                shutil.rmtree(transcripts_dir, ignore_errors=True)
+                cached_transcripts = content_store.restore_files(transcripts_cache_key, transcripts_dir)
+                if cached_transcripts:
+                    logging.info(f"Task {project_id}: Reusing {len(cached_transcripts)} cached transcript(s); skipping split and transcription.")
+                    manifest.reset_segments()
+                    manifest.invalidate_stages("wordforword", "memo_draft", "document")
+                    manifest.complete_stage("transcode", [], info={"from_cache": True})
+                    manifest.complete_stage("split", [], info={"from_cache": True})
+                    manifest.complete_stage("transcribe", cached_transcripts, info={"from_cache": True})
+                else:
+                    os.makedirs(transcripts_dir, exist_ok=True)
+
+        def cache_text_output(cache_key: str, output_path: str):
+            # Drafts built from an incomplete set of transcripts must not be reused
+            if content_store and manifest.is_stage_complete("transcribe"):
+                content_store.store_files(cache_key, [output_path], audio_sha256=audio_sha256)
+
+        def on_active_stages(active_statuses: List[str]):
+            if cancel_requested():
+                return # Abandoned stages finishing late must not overwrite the 'cancelled' status
+            # One running stage reports its own status; several report PARALLEL_STATUS plus the list
+            status = active_statuses[0] if len(active_statuses) == 1 else PARALLEL_STATUS
+            update_task(project_id, owner=scheduler.worker_id, status=status, active_stages=active_statuses,
+                        last_update_time=datetime.now())
+            logging.info(f"Task {project_id}: Status set to {status} (active stages: {active_statuses}).")
 
-        # Update task status to indicate start of processing (more granular)
-        task.status = "processing_audio_split" 
-        task.last_update_time = datetime.now()
-        db.commit()
-        db.refresh(task)
-        logging.info(f"Task {project_id}: Status set to processing_audio_split.")
+        # Step 0 (optional): Transcode the upload once to compact mono speech audio
+        def run_transcode(results):
+            if manifest.is_stage_complete("transcode"):
+                artifacts = manifest.stage_artifacts("transcode")
+                logging.info(f"Task {project_id}: Audio already transcoded, reusing it.")
+                stage_metrics.reused("transcode")
+                # None once the lifecycle manager deleted it; a new split then reads the upload
+                return artifacts[0] if artifacts and os.path.isfile(artifacts[0]) else None
+            # Segments cut from an earlier intermediate (or the original upload) are stale
+            manifest.invalidate_stages("split", "transcribe", "wordforword", "memo_draft", "document")
+            os.makedirs(work_dir, exist_ok=True) # Task directories created before it existed
+            transcoded_path = os.path.join(work_dir, f"transcoded{transcoded_extension()}")
+            logging.info(f"Task {project_id}: Transcoding audio to {os.path.basename(transcoded_path)}...")
+            transcode_audio(local_file_path, transcoded_path)
+            manifest.complete_stage("transcode", [transcoded_path])
+            stage_metrics.add_bytes("transcode", bytes_in=total_size([local_file_path]), bytes_out=total_size([transcoded_path]))
+            logging.info(f"Task {project_id}: Audio transcoded "
+                         f"({total_size([local_file_path])} -> {total_size([transcoded_path])} bytes).")
+            return transcoded_path
 
         # Step 1: Split audio
-        logging.info(f"Task {project_id}: Splitting audio...")
-        segment_paths = process_audio.split_audio(
-            input_file_path=local_file_path,
-            output_dir_path=audio_segments_dir
-        )
-        if not segment_paths:
-            raise ValueError("Audio splitting failed.")
-        logging.info(f"Task {project_id}: Audio split completed.")
-        task.status = "transcribing"
-        task.last_update_time = datetime.now()
-        db.commit()
-        db.refresh(task)
-
-        # Step 2: Transcribe
-        logging.info(f"Task {project_id}: Transcribing audio segments...")
-        transcription_summary = audio2text.process_directory_of_audio_files(
-            input_audio_segments_dir=audio_segments_dir,
-            output_transcripts_dir=transcripts_dir,
-            model_name=model_name_param # Use the model specified in the request
-        )
-        if not transcription_summary or (transcription_summary.get("failed_count", 0) > 0 and transcription_summary.get("successful_count",0) == 0):
-            raise ValueError(f"Audio transcription failed. Summary: {transcription_summary}")
-        logging.info(f"Task {project_id}: Transcription completed. Summary: {transcription_summary}")
-        task.status = "generating_wordforword"
-        task.last_update_time = datetime.now()
-        db.commit()
-        db.refresh(task)
+        # Segments are handed to the transcribe stage through this queue as soon as they exist;
+        # with PIPELINE_STREAMING_SPLIT both stages run at the same time.
+        segment_queue: "queue.Queue[Optional[str]]" = queue.Queue()
+
+        def run_split(results):
+            try:
+                # Segments deleted by the lifecycle manager are only fine while the transcripts still exist
+                segments_gone = manifest.artifacts_released("split") and not manifest.is_stage_complete("transcribe")
+                if manifest.is_stage_complete("split") and not segments_gone:
+                    segment_paths = manifest.stage_artifacts("split")
+                    logging.info(f"Task {project_id}: Audio split already done, reusing {len(segment_paths)} segment(s).")
+                    stage_metrics.reused("split")
+                    for segment_path in segment_paths:
+                        segment_queue.put(segment_path)
+                    return segment_paths
+
+                # New segments make every later result stale, including files of an earlier partial run
+                manifest.reset_segments()
+                manifest.invalidate_stages("transcribe", "wordforword", "memo_draft", "document")
+                for stale_dir in (audio_segments_dir, transcripts_dir):
+                    shutil.rmtree(stale_dir, ignore_errors=True)
+                    os.makedirs(stale_dir, exist_ok=True)
+
+                # The transcoded intermediate is already compact mono audio: cut it without re-encoding
+                split_input_path = results.get("transcode") or local_file_path
+                logging.info(f"Task {project_id}: Splitting audio (streaming={PIPELINE_STREAMING_SPLIT})...")
+                segment_paths = []
+                if PIPELINE_STREAMING_SPLIT:
+                    for segment_path in stream_split_audio(split_input_path, audio_segments_dir,
+                                                           copy_codec=split_input_path != local_file_path):
+                        # Raising here closes the generator, whose cleanup kills ffmpeg
+                        check_cancelled()
+                        segment_paths.append(segment_path)
+                        segment_queue.put(segment_path)
+                else:
+                    segment_paths = audio2memo("process_audio").split_audio(
+                        input_file_path=split_input_path,
+                        output_dir_path=audio_segments_dir
+                    ) or []
+                    for segment_path in segment_paths:
+                        segment_queue.put(segment_path)
+                if not segment_paths:
+                    raise ValueError("Audio splitting failed.")
+                manifest.complete_stage("split", segment_paths)
+                stage_metrics.add_bytes("split", bytes_in=total_size([split_input_path]), bytes_out=total_size(segment_paths))
+                logging.info(f"Task {project_id}: Audio split completed ({len(segment_paths)} segment(s)).")
+                return segment_paths
+            finally:
+                segment_queue.put(None) # End of stream, also on failure
+
+        # Step 2: Transcribe (per segment, skipping segments already transcribed)
+        def run_transcribe(results):
+            if manifest.is_stage_complete("transcribe"):
+                logging.info(f"Task {project_id}: Transcription already done, skipping.")
+                stage_metrics.reused("transcribe")
+                return manifest.stage_info("transcribe")
+            segment_paths = []
+            pending_segments = []
+
+            def pending_stream():
+                for segment_path in iter(segment_queue.get, None):
+                    segment_paths.append(segment_path)
+                    if not manifest.segment_done(segment_path):
+                        pending_segments.append(segment_path)
+                        yield segment_path
+
+            logging.info(f"Task {project_id}: Transcribing audio segments as they become available...")
+            segment_results = transcribe_segments(
+                segment_paths=pending_stream(),
+                transcripts_dir=transcripts_dir,
+                model_name=model_name_param, # Use the model specified in the request
+                transcribe_directory=stage_metrics.timed_call(
+                    "transcribe", "transcription_api", audio2memo("audio2text").process_directory_of_audio_files,
+                    check=lambda summary: bool(summary) and summary.get("successful_count", 0) > 0
+                ),
+                on_segment_done=lambda path, status, transcripts, error, attempts: manifest.record_segment(
+                    path, status, transcripts, error=error, attempts=attempts
+                )
+            )
+            if not manifest.is_stage_complete("split"):
+                # The split stage failed mid-stream; its error is reported by the stage graph
+                raise ValueError("Audio splitting did not complete.")
+            failed_segments = [path for path, transcripts in segment_results.items() if transcripts is None]
+            stage_metrics.add_bytes(
+                "transcribe",
+                bytes_in=total_size(pending_segments),
+                bytes_out=total_size(t for p in pending_segments for t in manifest.segment_transcripts(p)),
+            )
+            transcription_summary = {
+                "successful_count": len(segment_paths) - len(failed_segments),
+                "failed_count": len(failed_segments),
+            }
+            if transcription_summary["successful_count"] == 0:
+                raise ValueError(f"Audio transcription failed. Summary: {transcription_summary}")
+            if pending_segments:
+                # Transcripts changed, so text generated from the old set is stale
+                manifest.invalidate_stages("wordforword", "memo_draft", "document")
+            if not failed_segments:
+                all_transcripts = [t for p in segment_paths for t in manifest.segment_transcripts(p)]
+                manifest.complete_stage("transcribe", all_transcripts, info=transcription_summary)
+                if content_store:
+                    content_store.store_files(transcripts_cache_key, all_transcripts, audio_sha256=audio_sha256)
+            logging.info(f"Task {project_id}: Transcription completed. Summary: {transcription_summary}")
+            return transcription_summary
 
         # Step 3: Text to Word-for-word
-        logging.info(f"Task {project_id}: Generating word-for-word...")
-        output_wordforword_filepath = os.path.join(wordforword_dir, f"{project_name_sanitized}_wordforword.txt")
-        wordforword_success = text_to_wordforword.generate_wordforword(
-            input_transcript_dir_path=transcripts_dir,
-            output_wordforword_file_path=output_wordforword_filepath,
-            prompt_template_path=PROMPT_TEXT_TO_WORDFORWORD_PATH
-        )
-        if not wordforword_success:
-            raise ValueError("Failed to generate word-for-word text.")
-        logging.info(f"Task {project_id}: Word-for-word generated.")
-        task.status = "generating_memo_draft"
-        task.last_update_time = datetime.now()
-        db.commit()
-        db.refresh(task)
+        def run_wordforword(results):
+            if manifest.is_stage_complete("wordforword"):
+                logging.info(f"Task {project_id}: Word-for-word already generated, skipping.")
+                stage_metrics.reused("wordforword")
+                return output_wordforword_filepath
+            if content_store and content_store.restore_file(wordforword_cache_key, output_wordforword_filepath):
+                logging.info(f"Task {project_id}: Reusing cached word-for-word.")
+                stage_metrics.reused("wordforword")
+            else:
+                generate_wordforword = stage_metrics.timed_call("wordforword", "llm", audio2memo("text_to_wordforword").generate_wordforword, check=bool)
+                if use_chunked_mode(transcripts_dir):
+                    # Too long for one call: concurrent calls over token-budgeted windows, joined in order
+                    logging.info(f"Task {project_id}: Generating word-for-word in chunks...")
+                    wordforword_success = chunked_wordforword(
+                        lambda input_dir, output_path: generate_wordforword(
+                            input_transcript_dir_path=input_dir,
+                            output_wordforword_file_path=output_path,
+                            prompt_template_path=PROMPT_TEXT_TO_WORDFORWORD_PATH
+                        ),
+                        transcripts_dir, output_wordforword_filepath
+                    )
+                else:
+                    logging.info(f"Task {project_id}: Generating word-for-word...")
+                    wordforword_success = generate_wordforword(
+                        input_transcript_dir_path=transcripts_dir,
+                        output_wordforword_file_path=output_wordforword_filepath,
+                        prompt_template_path=PROMPT_TEXT_TO_WORDFORWORD_PATH
+                    )
+                if not wordforword_success:
+                    raise ValueError("Failed to generate word-for-word text.")
+                cache_text_output(wordforword_cache_key, output_wordforword_filepath)
+                stage_metrics.add_bytes("wordforword", bytes_in=_dir_size(transcripts_dir),
+                                        bytes_out=total_size([output_wordforword_filepath]))
+            manifest.invalidate_stages("document")
+            manifest.complete_stage("wordforword", [output_wordforword_filepath])
+            logging.info(f"Task {project_id}: Word-for-word generated.")
+            return output_wordforword_filepath
         
-        # Step 4: Wordforword to Memo Draft (or Transcripts to Memo Draft)
-        logging.info(f"Task {project_id}: Generating memo draft...")
-        output_memo_draft_filepath = os.path.join(memo_draft_dir, f"{project_name_sanitized}_memo_draft.txt")
-        memo_success = wordforword_to_memo.generate_memo_from_transcripts( # Name implies it uses transcripts
-            input_transcript_dir_path=transcripts_dir, # Confirm this input based on function def
-            output_memo_file_path=output_memo_draft_filepath,
-            prompt_template_path=PROMPT_WORDFORWORD_TO_MEMO_PATH
-        )
-        if not memo_success:
-            raise ValueError("Failed to generate memo draft.")
-        logging.info(f"Task {project_id}: Memo draft generated.")
-        task.status = "generating_document"
-        task.last_update_time = datetime.now()
-        db.commit()
-        db.refresh(task)
-
-        # Step 5: Combine to DOCX
-        logging.info(f"Task {project_id}: Combining outputs to DOCX...")
-        final_output_paths = combine_to_docx.combine_to_docx_and_markdown(
-            project_name=project_name_sanitized,
-            summary_md_path=output_memo_draft_filepath, # This is the memo draft
-            wordforword_md_path=output_wordforword_filepath, # This is the word-for-word .txt
-            output_dir_docx=output_docx_dir
-        )
-        if not final_output_paths or not final_output_paths.get("docx_path"):
-            raise ValueError("Failed to combine outputs into DOCX.")
-        logging.info(f"Task {project_id}: Final DOCX output generated: {final_output_paths}")
+        # Step 4: Memo Draft from transcripts (independent of step 3, so both run concurrently)
+        def run_memo_draft(results):
+            if manifest.is_stage_complete("memo_draft"):
+                logging.info(f"Task {project_id}: Memo draft already generated, skipping.")
+                stage_metrics.reused("memo_draft")
+                return output_memo_draft_filepath
+            if content_store and content_store.restore_file(memo_draft_cache_key, output_memo_draft_filepath):
+                logging.info(f"Task {project_id}: Reusing cached memo draft.")
+                stage_metrics.reused("memo_draft")
+            else:
+                generate_memo = stage_metrics.timed_call("memo_draft", "llm", audio2memo("wordforword_to_memo").generate_memo_from_transcripts, check=bool) # Name implies it uses transcripts
+                if use_chunked_mode(transcripts_dir):
+                    # Too long for one call: partial memos per window, merged hierarchically
+                    logging.info(f"Task {project_id}: Generating memo draft in chunks...")
+                    memo_success = chunked_memo(
+                        lambda input_dir, output_path: generate_memo(
+                            input_transcript_dir_path=input_dir,
+                            output_memo_file_path=output_path,
+                            prompt_template_path=PROMPT_WORDFORWORD_TO_MEMO_PATH
+                        ),
+                        transcripts_dir, output_memo_draft_filepath,
+                        reduce_generate=lambda input_dir, output_path: generate_memo(
+                            input_transcript_dir_path=input_dir,
+                            output_memo_file_path=output_path,
+                            prompt_template_path=PROMPT_MEMO_REDUCE_PATH
+                        ),
+                    )
+                else:
+                    logging.info(f"Task {project_id}: Generating memo draft...")
+                    memo_success = generate_memo(
+                        input_transcript_dir_path=transcripts_dir, # Confirm this input based on function def
+                        output_memo_file_path=output_memo_draft_filepath,
+                        prompt_template_path=PROMPT_WORDFORWORD_TO_MEMO_PATH
+                    )
+                if not memo_success:
+                    raise ValueError("Failed to generate memo draft.")
+                cache_text_output(memo_draft_cache_key, output_memo_draft_filepath)
+                stage_metrics.add_bytes("memo_draft", bytes_in=_dir_size(transcripts_dir),
+                                        bytes_out=total_size([output_memo_draft_filepath]))
+            manifest.invalidate_stages("document")
+            manifest.complete_stage("memo_draft", [output_memo_draft_filepath])
+            logging.info(f"Task {project_id}: Memo draft generated.")
+            return output_memo_draft_filepath
+
+        # Step 5: Combine to DOCX (joins steps 3 and 4)
+        def run_document(results):
+            if manifest.is_stage_complete("document"):
+                final_output_paths = manifest.stage_info("document")
+                logging.info(f"Task {project_id}: DOCX already generated, reusing {final_output_paths}.")
+                stage_metrics.reused("document")
+                return final_output_paths
+            logging.info(f"Task {project_id}: Combining outputs to DOCX...")
+            final_output_paths = audio2memo("combine_to_docx").combine_to_docx_and_markdown(
+                project_name=project_name_sanitized,
+                summary_md_path=results["memo_draft"], # This is the memo draft
+                wordforword_md_path=results["wordforword"], # This is the word-for-word .txt
+                output_dir_docx=output_docx_dir
+            )
+            if not final_output_paths or not final_output_paths.get("docx_path"):
+                raise ValueError("Failed to combine outputs into DOCX.")
+            stage_metrics.add_bytes(
+                "document",
+                bytes_in=total_size([results["memo_draft"], results["wordforword"]]),
+                bytes_out=total_size(p for p in final_output_paths.values() if isinstance(p, str)),
+            )
+            manifest.complete_stage(
+                "document",
+                [p for p in final_output_paths.values() if isinstance(p, str) and os.path.isfile(p)],
+                info=final_output_paths
+            )
+            logging.info(f"Task {project_id}: Final DOCX output generated: {final_output_paths}")
+            return final_output_paths
+
+        # Transcoding reports the split status: to clients both are audio preparation
+        transcode_stages = [
+            Stage("transcode", "processing_audio_split", stage_metrics.instrument("transcode", run_transcode)),
+        ] if PIPELINE_TRANSCODE else []
+        first_stage = ["transcode"] if PIPELINE_TRANSCODE else []
+        stage_graph = StageGraph(transcode_stages + [
+            Stage("split", "processing_audio_split", stage_metrics.instrument("split", run_split),
+                  depends_on=first_stage),
+            # Streaming split feeds transcription while it runs, so the two stages overlap
+            Stage("transcribe", "transcribing", stage_metrics.instrument("transcribe", run_transcribe),
+                  depends_on=first_stage if PIPELINE_STREAMING_SPLIT else ["split"]),
+            Stage("wordforword", "generating_wordforword", stage_metrics.instrument("wordforword", run_wordforword),
+                  depends_on=["transcribe"]),
+            Stage("memo_draft", "generating_memo_draft", stage_metrics.instrument("memo_draft", run_memo_draft),
+                  depends_on=["transcribe"]),
+            Stage("document", "generating_document", stage_metrics.instrument("document", run_document),
+                  depends_on=["wordforword", "memo_draft"]),
+        ], on_active_change=on_active_stages)
+        final_output_paths = stage_graph.run()["document"]
+        check_cancelled() # Cancelled while the last stage finished: no completion, no email
 
         # --- Update Task in DB as Completed --- 
-        task.status = "completed"
-        task.result_files = final_output_paths 
-        task.last_update_time = datetime.now()
-        processing_duration = task.last_update_time - task.submit_time
-        task.processing_time = processing_duration.total_seconds()
-        db.commit()
-        db.refresh(task)
+        finished_at = datetime.now()
+        completed_task = update_task(
+            project_id,
+            owner=scheduler.worker_id, # Not once the lease went to another node, which now runs the task
+            status="completed",
+            active_stages=None,
+            result_files=final_output_paths,
+            finish_time=finished_at,
+            last_update_time=finished_at,
+            processing_time=(finished_at - task.submit_time).total_seconds() if task.submit_time else None,
+        )
+        if completed_task is None:
+            raise TaskCancelled(LEASE_LOST)
+        task = completed_task
+        observe_task_finished(task)
+        if task:
+            eta_estimator.observe(task.model, task.audio_duration, (finished_at - run_started_at).total_seconds())
         logging.info(f"Task {project_id}: Completed successfully.")
+
+        # --- Make the outputs searchable (failures here don't fail the task) ---
+        try:
+            with session_scope() as db:
+                index_task_documents(db, project_id, {
+                    "transcript": manifest.stage_artifacts("transcribe"),
+                    "wordforword": [output_wordforword_filepath],
+                    "memo_draft": [output_memo_draft_filepath],
+                })
+        except Exception as e:
+            logging.error(f"Task {project_id}: Failed to index outputs for search: {e}", exc_info=True)
         
-        # --- Trigger email notification on Success --- 
+        # --- Queue email notification on Success (delivered by the outbox sender) --- 
         attachment_to_send = final_output_paths.get("docx_path") if final_output_paths else None
-        email_sent_status, email_message = send_email_notification(
-            task_id=project_id,
-            project_name=project_name_sanitized,
-            to_email=task.to_email,
-            cc_emails=task.cc_emails, # Send to CC on success
-            status="completed",
-            result_files=task.result_files, 
-            error_message=None,
-            attachment_path=attachment_to_send # Pass the docx_path for attachment
-        )
-        task.email_sent = datetime.now()
-        task.email_status = email_message if not email_sent_status else "Sent"
-        db.commit()
+        try:
+            # Tasks of a batch with a combined notification are reported in its summary email instead
+            if not batch_handles_notification(project_id):
+                enqueue_task_email(
+                    task_id=project_id,
+                    project_name=project_name_sanitized,
+                    to_email=task.to_email,
+                    cc_emails=task.cc_emails, # Send to CC on success
+                    status="completed",
+                    attachment_path=attachment_to_send # The docx is streamed from disk when the mail is sent
+                )
+        except Exception as e:
+            logging.error(f"Task {project_id}: Failed to queue notification email: {e}", exc_info=True)
+            update_task(project_id, email_sent=False, email_status=f"Failed to queue email: {e}"[:2000])
+
+    except TaskCancelled as cancelled:
+        if _lease_lost(project_id, str(cancelled)):
+            _abandon_run(project_id)
+        elif task:
+            _finish_cancelled_run(project_id, task, local_file_path, task_base_dir, cancelled.pending)
 
     except Exception as process_error: 
+        if _lease_lost(project_id, cancel_reason()):
+            _abandon_run(project_id)
+            return
+        if task and cancel_requested():
+            # Failed because of the cancellation (e.g. a stage read input another one left incomplete)
+            _finish_cancelled_run(project_id, task, local_file_path, task_base_dir)
+            return
         logging.error(f"Task {project_id}: Background processing failed - {str(process_error)}", exc_info=True)
         if task: 
-            task.status = "failed"
-            task.error = str(process_error)[:2000] 
-            task.last_update_time = datetime.now()
-            if task.submit_time: # Ensure submit_time is not None for duration calculation
-                 processing_duration = task.last_update_time - task.submit_time
-                 task.processing_time = processing_duration.total_seconds()
-            db.commit()
-
-            # --- Trigger email notification on Failure --- 
-            email_sent_status, email_message = send_email_notification(
-                task_id=project_id,
-                project_name=project_name_sanitized, # project_name_sanitized should be defined
-                to_email=task.to_email,
-                cc_emails=None, # Do NOT send to CC on failure
+            failed_at = datetime.now()
+            failed_task = update_task(
+                project_id,
+                owner=scheduler.worker_id,
                 status="failed",
-                result_files=None,
-                error_message=task.error,
-                attachment_path=None # No attachment on failure
+                active_stages=None,
+                error=str(process_error)[:2000],
+                finish_time=failed_at,
+                last_update_time=failed_at,
+                # Ensure submit_time is not None for duration calculation
+                processing_time=(failed_at - task.submit_time).total_seconds() if task.submit_time else None,
             )
-            task.email_sent = datetime.now() # Record email attempt time
-            task.email_status = email_message if not email_sent_status else "Sent (failure notice)"
-            db.commit()
-    finally:
-        db.close() # Ensure DB session is closed for the background task
+            if failed_task is None:
+                _abandon_run(project_id)
+                return
+            task = failed_task
+            observe_task_finished(task)
+
+            # --- Queue email notification on Failure --- 
+            try:
+                if not batch_handles_notification(project_id):
+                    enqueue_task_email(
+                        task_id=project_id,
+                        project_name=project_name_sanitized, # project_name_sanitized should be defined
+                        to_email=task.to_email,
+                        cc_emails=None, # Do NOT send to CC on failure
+                        status="failed",
+                        error_message=task.error,
+                    )
+            except Exception as e:
+                logging.error(f"Task {project_id}: Failed to queue failure notification: {e}", exc_info=True)
+
+def _lease_lost(task_id: str, reason: Optional[str]) -> bool:
+    return reason == LEASE_LOST or scheduler.lease_lost(task_id)
+
+def _abandon_run(task_id: str):
+    # The task was requeued or runs on another node: leave its status, outputs and email to that run
+    logging.warning(f"Task {task_id}: Lease lost to another worker; this run stops without recording a result.")
+
+def _discard_task_outputs(task_id: str, task_base_dir: str, local_file_path: str):
+    files, freed = clear_task_outputs(task_base_dir, [local_file_path])
+    logging.info(f"Task {task_id}: Removed {files} partial output file(s) ({freed} bytes); the upload is kept.")
+
+def _discard_late_outputs(task_id: str, task_base_dir: str, local_file_path: str, pending: List):
+    # Abandoned calls may still write into the task directory when they return; clean up again after them
+    wait_futures(pending)
+    with session_scope() as db:
+        status = db.query(Task.status).filter(Task.task_id == task_id).scalar()
+    if status == "cancelled": # Not retried in the meantime
+        _discard_task_outputs(task_id, task_base_dir, local_file_path)
+
+def _finish_cancelled_run(task_id: str, task: Task, local_file_path: str, task_base_dir: str, pending: List = ()):
+    """Record a cancelled run and delete its partial outputs; no notification email is sent."""
+    logging.info(f"Task {task_id}: Cancelled by user.")
+    cancelled_at = datetime.now()
+    cancelled_task = update_task(
+        task_id,
+        owner=scheduler.worker_id,
+        status="cancelled",
+        active_stages=None,
+        error="Cancelled by user",
+        result_files=None,
+        finish_time=cancelled_at,
+        last_update_time=cancelled_at,
+        processing_time=(cancelled_at - task.submit_time).total_seconds() if task.submit_time else None,
+    )
+    if cancelled_task is None:
+        _abandon_run(task_id)
+        return
+    observe_task_finished(cancelled_task)
+    try:
+        _discard_task_outputs(task_id, task_base_dir, local_file_path)
+    except Exception as e:
+        logging.error(f"Task {task_id}: Failed to remove partial outputs: {e}", exc_info=True)
+    pending = [future for future in pending if not future.done()]
+    if pending:
+        threading.Thread(target=_discard_late_outputs, args=(task_id, task_base_dir, local_file_path, pending),
+                         name=f"cancel-cleanup-{task_id[:8]}", daemon=True).start()
+    try:
+        # The batch summary may have been waiting for this task only
+        batch_handles_notification(task_id)
+    except Exception as e:
+        logging.error(f"Task {task_id}: Failed to check the batch notification: {e}", exc_info=True)
+
+def run_scheduled_task(task_id: str):
+    """Entry point for scheduler workers: rebuild the task's arguments from its DB row and run the pipeline."""
+    with task_log_context(task_id):
+        with session_scope() as db:
+            task = db.query(Task).filter(Task.task_id == task_id).first()
+            if not task:
+                logging.error(f"Task {task_id}: Scheduled but not found in DB.")
+                return
+            task_args = {
+                "local_file_path": task.file_path,
+                "original_filename": task.file_name,
+                "model_name_param": task.model,
+                "to_email": task.to_email,
+                "cc_emails": task.cc_emails,
+                "audio_sha256": task.audio_sha256,
+            }
+            cancelled = task.cancel_requested_at is not None # Cancelled after it was claimed
+
+        with cancellation_scope(task_id, cancelled=cancelled):
+            process_transcription_task(
+                project_id=task_id,
+                **task_args,
+                **get_task_dirs(task_id)
+            )
+
+# Timed-out tasks may be the last unfinished task of a batch with a combined notification
+scheduler = TaskScheduler(runner=run_scheduled_task, on_timed_out=batch_handles_notification)
+
+
+def _new_task(request: Request, task_id: str, original_filename: str, local_file_path: str, file_size: int,
+              audio_sha256: str, media_info: Optional[Dict], *, to_email: str, cc_emails: Optional[str], model: str,
+              priority: int, batch_id: Optional[str] = None) -> Task:
+    """The 'submitted' row of a saved and probed upload."""
+    return Task(
+        task_id=task_id, # Use the generated UUID as task_id
+        status="submitted", 
+        submit_time=datetime.now(),
+        last_update_time=datetime.now(),
+        file_name=original_filename,
+        file_path=local_file_path, # Needed by the scheduler to (re)run the task
+        file_size=file_size,
+        file_type=media_info["container"] if media_info else (os.path.splitext(original_filename)[1].lstrip(".").lower() or None),
+        audio_duration=media_info["duration"] if media_info else None,
+        extra_options={"media": media_info} if media_info else None, # codec, sample rate, channels, bit rate
+        audio_sha256=audio_sha256,
+        submitter_ip=request.client.host if request.client else None,
+        user_agent=request.headers.get("user-agent"),
+        priority=priority,
+        model=model, # Save the model name used
+        # output_type=output_type, # Save output_type if relevant
+        to_email=to_email,
+        cc_emails=cc_emails if cc_emails else None,
+        batch_id=batch_id,
+        # result_files initially null
+        # error initially null
+        # processing_time initially null
+    )
 
 
 @app.post("/api/transcribe", response_model=TranscribeResponse)
 async def transcribe(
     request: Request,
-    background_tasks: BackgroundTasks, # Inject BackgroundTasks
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None), # Either a file, or the id of a completed upload session
+    upload_id: Optional[str] = Form(None),
     to_email: str = Form(...),
     cc_emails: Optional[str] = Form(""),
     model: str = Form("gpt-4o-transcribe"), # This is the transcription model name
     output_type: str = Form("all"), # This param seems unused in the core pipeline now
-    db: Session = Depends(get_db) 
+    priority: int = Form(0), # Scheduling priority, higher runs first
+    db: AsyncSession = Depends(get_db) 
 ):
-    if not process_audio: 
-        logging.error("audio2memo modules not loaded, cannot process request.")
-        raise HTTPException(status_code=500, detail="Server configuration error: audio processing module failed to load.")
+    _require_pipeline()
+    if (file is None) == (upload_id is None):
+        raise HTTPException(status_code=400, detail="Provide either a file or an upload_id.")
+    if file is not None:
+        # Uploads through a session were already admitted when the session was created
+        await _check_storage(int(request.headers.get("content-length") or 0))
+        await _check_admission()
+    if upload_id:
+        upload_session = await run_in_threadpool(get_upload_session, upload_id)
+        original_filename = upload_session["file_name"]
+    else:
+        original_filename = os.path.basename(file.filename)
         
     # For now, we use the original filename (without extension) as project_name
     # You might want a more sophisticated way to name projects or let users specify it.
-    project_name_from_file = os.path.splitext(file.filename)[0]
+    project_name_from_file = os.path.splitext(original_filename)[0]
 
     # --- Create Task Directory Structure ---
     # Use a unique ID for the task directory to avoid collisions
@@ -400,20 +898,15 @@ async def transcribe(
         logging.error(f"Task {project_id}: AUDIO_TARGET_DIR ('{AUDIO_TARGET_DIR}') is not configured or not a directory.")
         raise HTTPException(status_code=500, detail=f"Server configuration error: AUDIO_TARGET_DIR is invalid.")
 
-    task_base_dir = os.path.join(AUDIO_TARGET_DIR, project_id)
-    audio_segments_dir = os.path.join(task_base_dir, "audio_segments")
-    transcripts_dir = os.path.join(task_base_dir, "transcripts")
-    wordforword_dir = os.path.join(task_base_dir, "wordforword")
-    memo_draft_dir = os.path.join(task_base_dir, "memo_draft")
-    output_docx_dir = os.path.join(task_base_dir, "output_docx")
+    task_dirs = get_task_dirs(project_id)
+    task_base_dir = task_dirs["task_base_dir"]
     
+    def make_task_dirs():
+        for dir_path in task_dirs.values():
+            os.makedirs(dir_path, exist_ok=True)
+
     try:
-        os.makedirs(task_base_dir, exist_ok=True)
-        os.makedirs(audio_segments_dir, exist_ok=True)
-        os.makedirs(transcripts_dir, exist_ok=True)
-        os.makedirs(wordforword_dir, exist_ok=True)
-        os.makedirs(memo_draft_dir, exist_ok=True)
-        os.makedirs(output_docx_dir, exist_ok=True)
+        await run_in_threadpool(make_task_dirs) # Keep filesystem calls off the event loop
         logging.info(f"Task {project_id}: Created directory structure at {task_base_dir}")
     except OSError as e:
         logging.error(f"Task {project_id}: Failed to create directory structure: {e}", exc_info=True)
@@ -421,19 +914,38 @@ async def transcribe(
         raise HTTPException(status_code=500, detail=f"Failed to create task directories: {e}")
 
 
-    local_file_path = os.path.join(task_base_dir, file.filename) # Save original file in task_base_dir
+    local_file_path = os.path.join(task_base_dir, original_filename) # Save original file in task_base_dir
 
     try:
-        with open(local_file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        logging.info(f"Task {project_id}: File '{file.filename}' saved to '{local_file_path}'")
+        if upload_id:
+            # Resumable upload: already on disk and hashed, just move it into the task directory
+            _, file_size, audio_sha256 = await run_in_threadpool(claim_completed_upload, upload_id, local_file_path)
+        else:
+            # Copied in chunks on a worker thread, hashed on the way so deduplication needs no second pass
+            file_size, audio_sha256 = await save_upload_file(file.file, local_file_path)
+        logging.info(f"Task {project_id}: File '{original_filename}' saved to '{local_file_path}' ({file_size} bytes, sha256 {audio_sha256})")
+        # Header-only probe: corrupt or non-audio files are rejected here instead of failing in a worker slot
+        try:
+            media_info = await run_in_threadpool(probe_media, local_file_path)
+        except MediaProbeError as e:
+            logging.warning(f"Task {project_id}: Rejected upload '{original_filename}': {e}")
+            raise HTTPException(status_code=422, detail=str(e))
+        if media_info:
+            logging.info(f"Task {project_id}: Media probe: {media_info}")
+        content_store = get_content_store(AUDIO_TARGET_DIR)
+        if content_store and await run_in_threadpool(content_store.adopt_original, audio_sha256, local_file_path):
+            logging.info(f"Task {project_id}: Identical recording already stored; upload replaced by a hardlink.")
+    except HTTPException:
+        await run_in_threadpool(shutil.rmtree, task_base_dir, True)
+        raise
     except Exception as e:
         logging.error(f"Task {project_id}: Error saving uploaded file: {e}", exc_info=True)
         # Clean up task directory if file saving fails
-        shutil.rmtree(task_base_dir, ignore_errors=True)
+        await run_in_threadpool(shutil.rmtree, task_base_dir, True)
         raise HTTPException(status_code=500, detail=f"Could not save uploaded file: {e}")
     finally:
-        file.file.close() # Ensure file is closed
+        if file is not None:
+            file.file.close() # Ensure file is closed
 
     # --- Database Interaction: Create Task Record ---
     new_task = None # Initialize to ensure it's defined for the finally block
@@ -442,24 +954,12 @@ async def transcribe(
         if not to_email: # Ensure to_email is provided
             raise HTTPException(status_code=400, detail="To Email is required.")
 
-        new_task = Task(
-            task_id=project_id, # Use the generated UUID as task_id
-            project_name=project_name_from_file, # Use filename as project name
-            status="submitted", 
-            submit_time=datetime.now(),
-            last_update_time=datetime.now(),
-            file_name=file.filename,
-            model=model, # Save the model name used
-            # output_type=output_type, # Save output_type if relevant
-            to_email=to_email,
-            cc_emails=cc_emails if cc_emails else None,
-            # result_files initially null
-            # error initially null
-            # processing_time initially null
+        new_task = _new_task(
+            request, project_id, original_filename, local_file_path, file_size, audio_sha256, media_info,
+            to_email=to_email, cc_emails=cc_emails, model=model, priority=priority,
         )
         db.add(new_task)
-        db.commit()
-        db.refresh(new_task)
+        await db.commit()
         logging.info(f"Task {new_task.task_id}: Record created in DB with status 'submitted'.")
     except HTTPException: # Re-raise HTTPExceptions
         if os.path.exists(task_base_dir): # Clean up if DB operation fails after file save
@@ -467,62 +967,240 @@ async def transcribe(
         raise
     except Exception as e: # Catch other SQLAlchemy or DB errors
         logging.error(f"Task {project_id}: Database error creating task: {e}", exc_info=True)
-        db.rollback()
+        await db.rollback()
         if os.path.exists(task_base_dir): # Clean up if DB operation fails after file save
              shutil.rmtree(task_base_dir, ignore_errors=True)
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
 
-    # --- Add Transcription to Background Tasks ---
-    try:
-        background_tasks.add_task(
-            process_transcription_task,
-            project_id=new_task.task_id, # Pass the task_id
-            local_file_path=local_file_path,
-            original_filename=file.filename,
-            model_name_param=model, # Pass the model name for transcription
-            to_email=to_email,
-            cc_emails=cc_emails,
-            # Directory paths
-            task_base_dir=task_base_dir,
-            audio_segments_dir=audio_segments_dir,
-            transcripts_dir=transcripts_dir,
-            wordforword_dir=wordforword_dir,
-            memo_draft_dir=memo_draft_dir,
-            output_docx_dir=output_docx_dir
-        )
-        logging.info(f"Task {new_task.task_id}: Added to background tasks for processing.")
-    except Exception as e: # Catch errors during add_task
-        logging.error(f"Task {new_task.task_id}: Failed to add task to background queue: {e}", exc_info=True)
-        # Update task status to 'failed' as it won't be processed
-        new_task.status = "failed"
-        new_task.error = f"Failed to enqueue for processing: {e}"
-        new_task.last_update_time = datetime.now()
-        db.commit()
-        # No need to rmtree here as the file is saved, but it won't be processed. 
-        # Consider if cleanup is desired if enqueueing fails.
-        raise HTTPException(status_code=500, detail=f"Failed to enqueue task for processing: {e}")
+    # --- Hand over to the scheduler ---
+    # The committed 'submitted' row is the durable queue entry; just wake up idle workers.
+    scheduler.notify()
+    eta_estimator.invalidate()
+    lifecycle_manager.record_upload(file_size)
+    logging.info(f"Task {new_task.task_id}: Queued for processing.")
     
-    return TranscribeResponse(status="success", task_id=new_task.task_id, message="Task submitted successfully")
+    return TranscribeResponse(status="success", task_id=new_task.task_id, message="Task submitted successfully",
+                              task_token=task_token(new_task.task_id))
 
 
-@app.get("/api/task_status/{task_id}", response_model=TaskStatusResponse)
-def get_task_status(task_id: str, db: Session = Depends(get_db)):
-    task = db.query(Task).filter(Task.task_id == task_id).first()
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
-    
+# --- Batch submissions ---
+def _ingest_batch_file(task_id: str, original_filename: str, save: Callable[[str], Tuple[int, str]]):
+    """
+    Worker thread: save one recording of a batch into a new task directory, probe it and
+    deduplicate it. Returns (local_file_path, file_size, audio_sha256, media_info).
+    """
+    task_dirs = get_task_dirs(task_id)
+    for dir_path in task_dirs.values():
+        os.makedirs(dir_path, exist_ok=True)
+    local_file_path = os.path.join(task_dirs["task_base_dir"], original_filename)
+    try:
+        file_size, audio_sha256 = save(local_file_path)
+        media_info = probe_media(local_file_path)
+        content_store = get_content_store(AUDIO_TARGET_DIR)
+        if content_store and content_store.adopt_original(audio_sha256, local_file_path):
+            logging.info(f"Task {task_id}: Identical recording already stored; upload replaced by a hardlink.")
+    except Exception:
+        shutil.rmtree(task_dirs["task_base_dir"], ignore_errors=True)
+        raise
+    logging.info(f"Task {task_id}: File '{original_filename}' saved to '{local_file_path}' ({file_size} bytes, sha256 {audio_sha256})")
+    return local_file_path, file_size, audio_sha256, media_info
+
+@app.post("/api/batches", response_model=BatchSubmitResponse)
+async def submit_batch(
+    request: Request,
+    files: List[UploadFile] = File(...), # Several recordings, or a single .zip archive of recordings
+    to_email: str = Form(...),
+    cc_emails: Optional[str] = Form(""),
+    model: str = Form("gpt-4o-transcribe"),
+    priority: int = Form(0),
+    combined_email: bool = Form(False), # One summary email with every DOCX once the whole batch has finished
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Submit many recordings in one request. Every file (or every audio file in the archive)
+    becomes a task carrying the same batch_id; the rows are inserted in one transaction and
+    the scheduler is woken once. Files rejected by the media probe are reported in
+    `rejected` without failing the rest of the batch.
+    """
+    _require_pipeline()
+    _require_audio_target_dir()
+    if not to_email:
+        raise HTTPException(status_code=400, detail="To Email is required.")
+    await _check_storage(int(request.headers.get("content-length") or 0))
+    await _check_admission()
+
+    batch_id = str(uuid.uuid4())
+    archive = None
+    accepted, rejected = [], []
+    try:
+        if len(files) == 1 and is_archive(files[0].filename or ""):
+            # Members are decompressed one by one straight into their task directories
+            archive = await run_in_threadpool(open_archive, files[0].file)
+            members, skipped = await run_in_threadpool(archive_members, archive)
+            sources = [(file_name, functools.partial(extract_member, archive, info)) for file_name, info in members]
+        else:
+            check_batch_size(len(files), 0) # Total size is bounded by the request limit (BATCH_MAX_BYTES)
+            skipped = []
+            sources = [(os.path.basename(file.filename or "") or f"recording_{index + 1}",
+                        functools.partial(copy_and_hash, file.file, max_bytes=MAX_UPLOAD_BYTES))
+                       for index, file in enumerate(files)]
+        logging.info(f"Batch {batch_id}: Receiving {len(sources)} recording(s) ({len(skipped)} non-audio file(s) skipped).")
+
+        for file_name, save in sources:
+            task_id = str(uuid.uuid4())
+            try:
+                ingested = await run_in_threadpool(_ingest_batch_file, task_id, file_name, save)
+            except (MediaProbeError, HTTPException) as e:
+                error = e.detail if isinstance(e, HTTPException) else str(e)
+                logging.warning(f"Batch {batch_id}: Rejected '{file_name}': {error}")
+                rejected.append(BatchFileResult(file_name=file_name, error=error))
+                continue
+            accepted.append((task_id, file_name) + ingested)
+    except HTTPException:
+        await run_in_threadpool(_remove_task_dirs, [item[0] for item in accepted])
+        raise
+    except Exception as e:
+        logging.error(f"Batch {batch_id}: Error saving uploaded files: {e}", exc_info=True)
+        await run_in_threadpool(_remove_task_dirs, [item[0] for item in accepted])
+        raise HTTPException(status_code=500, detail=f"Could not save uploaded files: {e}")
+    finally:
+        if archive is not None:
+            archive.close()
+        for file in files:
+            file.file.close()
+
+    if not accepted:
+        raise HTTPException(status_code=422, detail="No file of the batch could be accepted: " +
+                            "; ".join(f"{item.file_name}: {item.error}" for item in rejected))
+
+    # --- One transaction for the batch and all of its tasks ---
+    new_tasks = [
+        _new_task(request, task_id, file_name, local_file_path, file_size, audio_sha256, media_info,
+                  to_email=to_email, cc_emails=cc_emails, model=model, priority=priority, batch_id=batch_id)
+        for task_id, file_name, local_file_path, file_size, audio_sha256, media_info in accepted
+    ]
+    try:
+        db.add(TaskBatch(batch_id=batch_id, created_at=datetime.now(), task_count=len(new_tasks), to_email=to_email,
+                         cc_emails=cc_emails or None, combined_email=combined_email))
+        db.add_all(new_tasks)
+        await db.commit()
+    except Exception as e:
+        logging.error(f"Batch {batch_id}: Database error creating tasks: {e}", exc_info=True)
+        await db.rollback()
+        await run_in_threadpool(_remove_task_dirs, [task.task_id for task in new_tasks])
+        raise HTTPException(status_code=500, detail=f"Database error: {e}")
+
+    scheduler.notify()
+    eta_estimator.invalidate()
+    lifecycle_manager.record_upload(sum(task.file_size or 0 for task in new_tasks))
+    logging.info(f"Batch {batch_id}: {len(new_tasks)} task(s) queued for processing, {len(rejected)} file(s) rejected.")
+    return BatchSubmitResponse(
+        status="success",
+        batch_id=batch_id,
+        tasks=[BatchFileResult(file_name=task.file_name, task_id=task.task_id, task_token=task_token(task.task_id)) for task in new_tasks],
+        rejected=rejected,
+        skipped=skipped,
+    )
+
+def _remove_task_dirs(task_ids: List[str]):
+    for task_id in task_ids:
+        shutil.rmtree(get_task_dirs(task_id)["task_base_dir"], ignore_errors=True)
+
+@app.get("/api/batches/{batch_id}", response_model=BatchStatusResponse)
+async def get_batch_status(batch_id: str, db: AsyncSession = Depends(get_db)):
+    batch = (await db.execute(select(TaskBatch).where(TaskBatch.batch_id == batch_id))).scalar_one_or_none()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    tasks = (await db.execute(
+        select(Task).options(load_only(*TASK_STATUS_COLUMNS))
+        .where(Task.batch_id == batch_id).order_by(Task.submit_time.asc(), Task.task_id.asc())
+    )).scalars().all()
+    counts: Dict[str, int] = {}
+    for task in tasks:
+        counts[task.status] = counts.get(task.status, 0) + 1
+    finished = not any(task.status in ACTIVE_STATUSES for task in tasks)
+    estimates = None
+    if not finished:
+        estimates, _ = await run_in_threadpool(eta_estimator.schedule)
+    return BatchStatusResponse(
+        batch_id=batch.batch_id,
+        created_at=batch.created_at,
+        task_count=len(tasks),
+        counts=counts,
+        finished=finished,
+        combined_email=bool(batch.combined_email),
+        notified_at=batch.notified_at,
+        tasks=[_task_status_response(task, estimates) for task in tasks],
+    )
+
+
+# --- Resumable chunked uploads ---
+# POST /api/uploads creates a session, PUT sends bytes starting at Upload-Offset,
+# GET reports the offset to resume from; the finished upload_id is then passed to /api/transcribe.
+async def _check_admission():
+    """Backpressure: 429 with Retry-After while the predicted backlog exceeds ADMISSION_MAX_BACKLOG_SECONDS."""
+    retry_after = await run_in_threadpool(eta_estimator.admission_retry_after)
+    if retry_after is not None:
+        logging.warning(f"Admission: Rejecting new upload, predicted backlog exceeds the limit (retry in {retry_after}s).")
+        raise HTTPException(status_code=429, headers={"Retry-After": str(retry_after)},
+                            detail=f"The processing queue is full. Please try again in {retry_after} seconds.")
+
+async def _check_storage(incoming_bytes: int):
+    """507 while the upload would exceed STORAGE_QUOTA_BYTES or leave less than STORAGE_MIN_FREE_BYTES on disk."""
+    error = await run_in_threadpool(lifecycle_manager.admission_error, incoming_bytes)
+    if error:
+        logging.warning(f"Storage: Rejecting new upload of {incoming_bytes} bytes: {error}")
+        raise HTTPException(status_code=507, detail=f"{error} Please try again later.")
+
+def _require_audio_target_dir():
+    if not AUDIO_TARGET_DIR or not os.path.isdir(AUDIO_TARGET_DIR):
+        raise HTTPException(status_code=500, detail="Server configuration error: AUDIO_TARGET_DIR is invalid.")
+
+@app.post("/api/uploads", response_model=UploadSessionResponse)
+async def create_upload(body: CreateUploadRequest):
+    _require_audio_target_dir()
+    await _check_storage(body.total_size or 0)
+    await _check_admission()
+    session = await run_in_threadpool(create_upload_session, AUDIO_TARGET_DIR, body.file_name, body.total_size)
+    return UploadSessionResponse(**session)
+
+@app.get("/api/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload(upload_id: str):
+    session = await run_in_threadpool(get_upload_session, upload_id)
+    return UploadSessionResponse(**session)
+
+@app.put("/api/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def upload_chunk(upload_id: str, request: Request, upload_offset: int = HeaderParam(...)):
+    session = await append_to_upload_session(upload_id, upload_offset, request.stream())
+    return UploadSessionResponse(**session)
+
+@app.post("/api/uploads/{upload_id}/complete", response_model=UploadSessionResponse)
+async def complete_upload(upload_id: str):
+    """Only needed when total_size was not declared up front."""
+    session = await run_in_threadpool(complete_upload_session, upload_id)
+    return UploadSessionResponse(**session)
+
+
+# Columns read by _task_status_response; list queries load only these (not log, user_agent, ...)
+TASK_STATUS_COLUMNS = (
+    Task.task_id, Task.status, Task.submit_time, Task.last_update_time, Task.file_name, Task.model,
+    Task.error, Task.result_files, Task.processing_time, Task.to_email, Task.email_status, Task.active_stages,
+    Task.file_size, Task.audio_duration, Task.storage_state, Task.batch_id, Task.cancel_requested_at,
+)
+
+def _task_status_response(task: Task, estimates: Optional[Dict] = None) -> TaskStatusResponse:
     processed_result_files = None
     if task.result_files:
         if isinstance(task.result_files, str): # If stored as JSON string
             try:
                 processed_result_files = json.loads(task.result_files)
             except json.JSONDecodeError:
-                logging.error(f"Task {task_id}: Failed to decode result_files JSON: {task.result_files}")
+                logging.error(f"Task {task.task_id}: Failed to decode result_files JSON: {task.result_files}")
                 processed_result_files = {"error": "Failed to parse result files"}
         elif isinstance(task.result_files, dict): # If already a dict (e.g. from SQLAlchemy JSON type)
             processed_result_files = task.result_files
         else: # Handle unexpected type
-            logging.warning(f"Task {task_id}: result_files is of unexpected type: {type(task.result_files)}")
+            logging.warning(f"Task {task.task_id}: result_files is of unexpected type: {type(task.result_files)}")
             processed_result_files = {"info": "Result files in non-standard format"}
 
     task_data = {
@@ -537,64 +1215,338 @@ def get_task_status(task_id: str, db: Session = Depends(get_db)):
         "processing_time": task.processing_time,
         "to_email": task.to_email,
         "email_status": task.email_status,
+        "active_stages": task.active_stages,
+        "file_size": task.file_size,
+        "audio_duration": task.audio_duration,
+        "storage_state": task.storage_state,
+        "batch_id": task.batch_id,
+        "cancel_requested_at": task.cancel_requested_at,
         # Populate other fields from task object as needed by TaskStatusResponse
         # For example, if you added output_type to TaskStatusResponse:
         # "output_type": task.output_type,
-        # "file_size": task.file_size,
     }
+    if estimates and task.task_id in estimates:
+        task_data["estimated_start_time"], task_data["estimated_finish_time"] = estimates[task.task_id]
     return TaskStatusResponse(**task_data) # Validate against the model
 
+@app.get("/api/task_status/{task_id}", response_model=TaskStatusResponse)
+async def get_task_status(task_id: str, db: AsyncSession = Depends(get_db)):
+    task = (await db.execute(
+        select(Task).options(load_only(*TASK_STATUS_COLUMNS)).where(Task.task_id == task_id)
+    )).scalar_one_or_none()
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    
+    estimates = None
+    if task.status in ACTIVE_STATUSES:
+        estimates, _ = await run_in_threadpool(eta_estimator.schedule)
+    return _task_status_response(task, estimates)
+
+@app.get("/api/tasks/{task_id}/log")
+async def get_task_log(task_id: str, db: AsyncSession = Depends(get_db)):
+    """The task's captured log records, one JSON object per line."""
+    row = (await db.execute(select(Task.task_id, Task.log).where(Task.task_id == task_id))).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return Response(content=row.log or "", media_type="application/x-ndjson")
+
+# --- Downloads of task outputs ---
+async def _downloadable_task(db: AsyncSession, task_id: str) -> Task:
+    task = (await db.execute(
+        select(Task).options(load_only(Task.task_id, Task.file_name, Task.result_files, Task.storage_state))
+        .where(Task.task_id == task_id)
+    )).scalar_one_or_none()
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task.storage_state == "expired":
+        raise HTTPException(status_code=410, detail="The task's files were deleted by the retention policy.")
+    return task
+
+@app.get("/api/tasks/{task_id}/files", response_model=TaskFilesResponse)
+async def list_task_files(task_id: str, expires: Optional[int] = None, signature: Optional[str] = None,
+                          db: AsyncSession = Depends(get_db)):
+    """Final and intermediate outputs of a task that can be downloaded; needs a signed link like the files."""
+    verify_link(task_id, "files", expires, signature)
+    task = await _downloadable_task(db, task_id)
+    artifacts = await run_in_threadpool(task_artifacts, task_id, task.result_files)
+    return TaskFilesResponse(
+        task_id=task_id,
+        files=[TaskFile(path=a["path"], kind=a["kind"], size=a["size"], modified=a["modified"], url=file_url(task_id, a["path"]))
+               for a in artifacts],
+        archive_url=archive_url(task_id),
+    )
+
+@app.api_route("/api/tasks/{task_id}/files/{file_path:path}", methods=["GET", "HEAD"])
+async def download_task_file(task_id: str, file_path: str, request: Request, expires: Optional[int] = None,
+                             signature: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    """One output file; supports Range, If-Range, If-None-Match and If-Modified-Since."""
+    verify_link(task_id, file_path, expires, signature)
+    task = await _downloadable_task(db, task_id)
+    artifacts = await run_in_threadpool(task_artifacts, task_id, task.result_files)
+    return await run_in_threadpool(file_response, request.headers, task_id, find_artifact(artifacts, file_path))
+
+@app.get("/api/tasks/{task_id}/archive")
+async def download_task_archive(task_id: str, kind: Optional[List[str]] = Query(None), expires: Optional[int] = None,
+                                signature: Optional[str] = None, db: AsyncSession = Depends(get_db)):
+    """Several outputs as one ZIP, streamed while it is built; `kind` (repeatable) selects what to include."""
+    verify_link(task_id, "archive", expires, signature)
+    task = await _downloadable_task(db, task_id)
+    artifacts = await run_in_threadpool(task_artifacts, task_id, task.result_files)
+    if kind:
+        artifacts = [a for a in artifacts if a["kind"] in kind]
+    if not artifacts:
+        raise HTTPException(status_code=404, detail="No files to download")
+    base_name = os.path.splitext(task.file_name or "")[0] or task_id
+    return archive_response(f"{base_name}.zip", artifacts)
+
+@app.post("/api/tasks/{task_id}/retry", response_model=TranscribeResponse)
+async def retry_task(task_id: str, x_task_token: Optional[str] = HeaderParam(None), db: AsyncSession = Depends(get_db)):
+    """
+    Re-queue a failed, timed-out or cancelled task. Stages recorded as complete in the task's
+    manifest are skipped, so only the missing work (e.g. failed segments) is redone; a
+    cancelled task's outputs were deleted, so it runs from the start. Requires the task token
+    handed out on submission (X-Task-Token).
+    """
+    verify_task_token(task_id, x_task_token)
+    task = (await db.execute(select(Task).where(Task.task_id == task_id))).scalar_one_or_none()
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task.status not in ("failed", "timed_out", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"Only failed, timed-out or cancelled tasks can be retried (current status: {task.status}).")
+    if task.storage_state == "expired":
+        raise HTTPException(status_code=409, detail="The task's files were deleted by the retention policy; please upload the recording again.")
+    if task.storage_state in BUSY_STORAGE_STATES:
+        raise HTTPException(status_code=409, detail="The task's files are being archived; please retry in a moment.")
+
+    task.status = "submitted"
+    task.error = None
+    task.attempts = 0
+    task.worker_id = None
+    task.lease_expires_at = None
+    task.cancel_requested_at = None
+    task.last_update_time = datetime.now()
+    await db.commit()
+    scheduler.notify()
+    logging.info(f"Task {task_id}: Re-queued for retry.")
+    return TranscribeResponse(status="success", task_id=task_id, message="Task re-queued for retry")
+
+@app.post("/api/tasks/{task_id}/cancel", response_model=TranscribeResponse)
+async def cancel_task(task_id: str, response: Response, x_task_token: Optional[str] = HeaderParam(None),
+                      db: AsyncSession = Depends(get_db)):
+    """
+    Cancel a queued or running task. A task still waiting in the queue is cancelled at once
+    (200). A running one is flagged (202): the node running it stops the pipeline at its next
+    check, between stages, segments and chunk calls, deletes the partial outputs and takes
+    the next queued task. Cancelled tasks send no notification email. Requires the task token
+    handed out on submission (X-Task-Token).
+    """
+    verify_task_token(task_id, x_task_token)
+    task = (await db.execute(select(Task).where(Task.task_id == task_id))).scalar_one_or_none()
+    if not task:
+        raise HTTPException(status_code=404, detail="Task not found")
+    if task.status not in ACTIVE_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Only queued or running tasks can be cancelled (current status: {task.status}).")
+
+    now = datetime.now()
+    if task.status == "submitted" and task.worker_id is None:
+        # Not claimed yet. Same conditional UPDATE as the claim, so exactly one of them wins;
+        # it bypasses the ORM hook, so it stamps the change-feed version itself.
+        version = await db.run_sync(lambda session: next_version(session.connection()))
+        cancelled = (await db.execute(update(Task).where(
+            Task.task_id == task_id, Task.status == "submitted", Task.worker_id.is_(None)
+        ).values(
+            status="cancelled",
+            error=CANCELLED_BY_USER,
+            cancel_requested_at=now,
+            finish_time=now,
+            processing_time=(now - task.submit_time).total_seconds() if task.submit_time else None,
+            last_update_time=now,
+            version=version,
+        ).execution_options(synchronize_session=False))).rowcount
+        await db.commit()
+        if cancelled == 1:
+            logging.info(f"Task {task_id}: Cancelled while queued.")
+            task_base_dir = get_task_dirs(task_id)["task_base_dir"]
+            await run_in_threadpool(_discard_task_outputs, task_id, task_base_dir, task.file_path)
+            await run_in_threadpool(batch_handles_notification, task_id)
+            return TranscribeResponse(status="success", task_id=task_id, message="Task cancelled")
+        # A worker claimed it in the meantime: flag it like any running task
+        logging.info(f"Task {task_id}: Claimed while being cancelled, requesting cancellation instead.")
+        await db.refresh(task)
+        if task.status not in ACTIVE_STATUSES:
+            raise HTTPException(status_code=409, detail=f"Only queued or running tasks can be cancelled (current status: {task.status}).")
+
+    task.cancel_requested_at = now
+    task.last_update_time = now
+    await db.commit()
+    if not request_cancel(task_id):
+        logging.info(f"Task {task_id}: Cancellation requested; the node running it stops it at its next poll.")
+    response.status_code = 202
+    return TranscribeResponse(status="success", task_id=task_id, message="Cancellation requested; the task stops shortly")
+
 @app.get("/api/tasks", response_model=TaskListResponse)
-def list_active_tasks(db: Session = Depends(get_db)):
+async def list_active_tasks(request: Request, response: Response, since: Optional[int] = None, db: AsyncSession = Depends(get_db)):
     """
     Retrieves a list of all tasks currently in 'submitted' or 'processing' state,
     ordered by their submission time (oldest first).
-    It will now also include tasks with more granular processing statuses.
+
+    Change-feed mode: with `since` set to the `cursor` of a previous response, only tasks
+    changed after it are returned (in any status, so clients can drop finished ones).
+    Responses carry an ETag derived from the cursor and the current estimate period: a client
+    whose last response (full list or changes) had the current cursor has seen every change, and
+    its If-None-Match costs a 304 without loading any task. The estimates move with time alone,
+    so the ETag also changes every TASK_LIST_ESTIMATE_REFRESH_SECONDS to hand out fresh ones.
     """
-    active_tasks_query = db.query(Task).filter(
-        Task.status.in_([
-            "submitted", 
-            "processing_audio_split", 
-            "transcribing", 
-            "generating_wordforword", 
-            "generating_memo_draft",
-            "generating_document"
-            # "processing" could be a general fallback if needed, but specific states are better
-        ])
-    ).order_by(Task.submit_time.asc())
-    
-    active_tasks = active_tasks_query.all()
+    cursor = await db.run_sync(current_version)
+    if since is not None and since > cursor:
+        since = None # Cursor from another database (or a reset one): start over with the full list
+    estimate_period = int(time.time() // TASK_LIST_ESTIMATE_REFRESH_SECONDS)
+    etag = f'"tasks-{cursor}-{estimate_period}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in (request.headers.get("if-none-match") or ""):
+        return Response(status_code=304, headers=headers)
+
+    changed_tasks = None
+    if since is not None:
+        changed_tasks = (await db.execute(
+            select(Task).options(load_only(*TASK_STATUS_COLUMNS)).where(Task.version > since)
+            .order_by(Task.version.asc()).limit(TASK_FEED_MAX_CHANGES + 1)
+        )).scalars().all()
+        if len(changed_tasks) > TASK_FEED_MAX_CHANGES:
+            changed_tasks = None # Too far behind; a full list is cheaper than replaying every change
+
+    if changed_tasks is None:
+        tasks = (await db.execute(
+            select(Task).options(load_only(*TASK_STATUS_COLUMNS)).where(
+                Task.status.in_(ACTIVE_STATUSES)
+            ).order_by(Task.submit_time.asc())
+        )).scalars().all()
+    else:
+        tasks = changed_tasks
+
+    estimates, _ = await run_in_threadpool(eta_estimator.schedule)
+    response.headers.update(headers)
+    return TaskListResponse(
+        tasks=[_task_status_response(task, estimates) for task in tasks],
+        cursor=cursor,
+        full=changed_tasks is None,
+        estimates={
+            task_id: TaskEstimate(estimated_start_time=start, estimated_finish_time=finish)
+            for task_id, (start, finish) in estimates.items()
+        },
+    )
+
+
+def _encode_history_cursor(task: Task) -> str:
+    return base64.urlsafe_b64encode(f"{task.submit_time.isoformat()}|{task.task_id}".encode()).decode()
+
+def _decode_history_cursor(cursor: str):
+    try:
+        submit_time, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(submit_time), task_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@app.get("/api/tasks/history", response_model=TaskHistoryResponse)
+async def task_history(
+    status: Optional[List[str]] = Query(None), # Repeatable: ?status=completed&status=failed
+    submitter: Optional[str] = None,           # user_id or to_email
+    model: Optional[str] = None,
+    submitted_from: Optional[datetime] = None,
+    submitted_to: Optional[datetime] = None,
+    q: Optional[str] = None,                   # Full-text search over transcripts, word-for-word and memo drafts
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    All tasks, newest first, with keyset pagination on (submit_time, task_id): each page is an
+    index range scan no matter how deep the client pages.
+    """
+    query = select(Task).options(load_only(*TASK_STATUS_COLUMNS)).where(Task.submit_time.isnot(None))
+    if status:
+        query = query.where(Task.status.in_(status))
+    if submitter:
+        query = query.where((Task.user_id == submitter) | (Task.to_email == submitter))
+    if model:
+        query = query.where(Task.model == model)
+    if submitted_from:
+        query = query.where(Task.submit_time >= submitted_from)
+    if submitted_to:
+        query = query.where(Task.submit_time < submitted_to)
+    if q and q.strip():
+        matches = await db.run_sync(matching_task_ids, q.strip())
+        query = query.where(Task.task_id.in_(matches))
+    if cursor:
+        query = query.where(tuple_(Task.submit_time, Task.task_id) < tuple_(*_decode_history_cursor(cursor)))
+
+    tasks = (await db.execute(
+        query.order_by(Task.submit_time.desc(), Task.task_id.desc()).limit(limit + 1)
+    )).scalars().all()
+    next_cursor = _encode_history_cursor(tasks[limit - 1]) if len(tasks) > limit else None
+    return TaskHistoryResponse(tasks=[_task_status_response(task) for task in tasks[:limit]], next_cursor=next_cursor)
+
+
+# Largest change set returned in change-feed mode before falling back to the full list
+TASK_FEED_MAX_CHANGES = int(os.environ.get("TASK_FEED_MAX_CHANGES", "500"))
+# Seconds a 304 from /api/tasks may keep a client's estimates; they are recomputed after that
+TASK_LIST_ESTIMATE_REFRESH_SECONDS = max(1.0, float(os.environ.get("TASK_LIST_ESTIMATE_REFRESH_SECONDS", "60")))
+
+# Seconds between SSE keep-alive comments, so proxies don't close idle streams
+TASK_EVENTS_KEEPALIVE_SECONDS = float(os.environ.get("TASK_EVENTS_KEEPALIVE_SECONDS", "15"))
+
+@app.get("/api/tasks/events")
+async def stream_task_events(request: Request):
+    """
+    Server-Sent Events stream of task status transitions.
+
+    Clients load /api/tasks once and then apply `task` events; a `resync` event means
+    events were missed and the list should be loaded again.
+    """
+    subscription = task_events.subscribe()
 
-    response_tasks = []
-    for task in active_tasks:
-        processed_result_files = None
-        if task.result_files:
-            if isinstance(task.result_files, str): # If stored as JSON string
+    async def event_stream():
+        try:
+            yield "retry: 5000\n\n"
+            while not await request.is_disconnected():
                 try:
-                    processed_result_files = json.loads(task.result_files)
-                except json.JSONDecodeError:
-                    logging.error(f"Task {task.task_id}: Failed to decode result_files JSON: {task.result_files}")
-                    processed_result_files = {"error": "Failed to parse result files"}
-            elif isinstance(task.result_files, dict): # If already a dict
-                processed_result_files = task.result_files
-            else: 
-                logging.warning(f"Task {task.task_id}: result_files is of unexpected type: {type(task.result_files)}")
-                processed_result_files = {"info": "Result files in non-standard format"}
-
-        task_data = TaskStatusResponse(
-            task_id=task.task_id,
-            status=task.status,
-            submit_time=task.submit_time,
-            last_update_time=task.last_update_time,
-            file_name=task.file_name,
-            model=task.model,
-            error=task.error,
-            result_files=processed_result_files,
-            processing_time=task.processing_time,
-            to_email=task.to_email,
-            email_status=task.email_status
-            # Ensure all fields required by TaskStatusResponse are populated
-        )
-        response_tasks.append(task_data)
-    
-    return TaskListResponse(tasks=response_tasks) 
\ No newline at end of file
+                    payload = await asyncio.wait_for(subscription.get(), timeout=TASK_EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            task_events.unsubscribe(subscription)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/metrics", include_in_schema=False)
+def prometheus_metrics():
+    """Prometheus scrape endpoint: stage/external-call histograms plus queue, task and DB pool gauges."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/api/metrics/db-pool")
+def db_pool_metrics():
+    """Connection pool usage and checkout wait times for the API (async) and worker (sync) pools."""
+    return {
+        "api": api_pool_metrics.snapshot(async_engine.pool),
+        "worker": worker_pool_metrics.snapshot(engine.pool),
+    }
+
+
+@app.get("/api/ready")
+async def readiness(response: Response):
+    """
+    Readiness probe: 200 once the audio2memo modules are loaded and the scheduler runs, 503
+    while the warm-up is still loading them (the other endpoints are already served). Lists
+    every warm-up component with its state and load time.
+    """
+    status = pipeline_components.status()
+    status["scheduler_running"] = scheduler.is_running()
+    status["ready"] = status["ready"] and status["scheduler_running"]
+    if not status["ready"]:
+        response.status_code = 503
+    return status
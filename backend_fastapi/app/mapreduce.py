@@ -0,0 +1,230 @@
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+from . import cancellation
+from .cancellation import TaskCancelled, cancel_requested, check_cancelled
+from .tasklog import submit_with_context
+
+# Transcripts longer than this (tokens) are processed in chunks instead of one LLM call
+MAPREDUCE_ENABLED = os.environ.get("MAPREDUCE_ENABLED", "true").lower() in ("1", "true", "yes")
+MAPREDUCE_THRESHOLD_TOKENS = int(os.environ.get("MAPREDUCE_THRESHOLD_TOKENS", "30000"))
+# Input budget of one map call, and of one reduce call combining partial memos
+MAPREDUCE_CHUNK_TOKENS = int(os.environ.get("MAPREDUCE_CHUNK_TOKENS", "8000"))
+MAPREDUCE_REDUCE_TOKENS = int(os.environ.get("MAPREDUCE_REDUCE_TOKENS", "8000"))
+# Chunk calls of one stage running at once, and the cap across all tasks in this process
+MAPREDUCE_WORKERS = int(os.environ.get("MAPREDUCE_WORKERS", "4"))
+LLM_MAX_CONCURRENT_CALLS = int(os.environ.get("LLM_MAX_CONCURRENT_CALLS", "8"))
+MAPREDUCE_CALL_RETRIES = int(os.environ.get("MAPREDUCE_CALL_RETRIES", "2"))
+MAPREDUCE_RETRY_BASE_DELAY = float(os.environ.get("MAPREDUCE_RETRY_BASE_DELAY", "2"))
+# tiktoken encoding used to measure text; only an estimate for non-OpenAI models, so budgets keep headroom
+TOKENIZER_ENCODING = os.environ.get("TOKENIZER_ENCODING", "cl100k_base")
+
+_inflight_calls = threading.BoundedSemaphore(max(1, LLM_MAX_CONCURRENT_CALLS))
+
+# generate(input_dir, output_path) -> success; one audio2memo LLM call over the text files in input_dir
+Generate = Callable[[str, str], bool]
+
+
+@lru_cache(maxsize=1)
+def token_encoding():
+    """The tiktoken encoding, loaded on first use or by the warm-up (importing tiktoken is slow)."""
+    try:
+        import tiktoken
+    except ImportError: # Token counts fall back to a character estimate
+        logging.warning("Map-reduce: tiktoken is not installed; estimating one token per character.")
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logging.warning(f"Map-reduce: Cannot load tiktoken encoding '{TOKENIZER_ENCODING}' ({e}); estimating one token per character.")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encoding = token_encoding()
+    return len(encoding.encode(text, disallowed_special=())) if encoding else len(text)
+
+
+def read_transcripts(transcripts_dir: str) -> List[str]:
+    """Texts of the transcript files in segment order."""
+    texts = []
+    for name in sorted(os.listdir(transcripts_dir)):
+        path = os.path.join(transcripts_dir, name)
+        if not name.startswith(".") and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                texts.append(f.read())
+    return texts
+
+
+def use_chunked_mode(transcripts_dir: str) -> bool:
+    """Whether the transcripts are too long for a single LLM call."""
+    if not MAPREDUCE_ENABLED or not os.path.isdir(transcripts_dir):
+        return False
+    return count_tokens("\n".join(read_transcripts(transcripts_dir))) > MAPREDUCE_THRESHOLD_TOKENS
+
+
+def _split_oversized(text: str, budget: int) -> List[str]:
+    """Cut a text longer than `budget` at line breaks, and long lines by length."""
+    pieces = []
+    for line in text.splitlines(keepends=True):
+        tokens = count_tokens(line)
+        if tokens <= budget:
+            pieces.append(line)
+            continue
+        step = max(1, len(line) * budget // tokens)
+        pieces.extend(line[i:i + step] for i in range(0, len(line), step))
+    return pieces
+
+
+def token_windows(texts: List[str], budget: int, split: bool = True) -> List[List[str]]:
+    """
+    Pack consecutive texts into windows of at most `budget` tokens, keeping their order.
+    Texts over the budget are cut up, or with `split=False` get a window of their own.
+    """
+    windows: List[List[str]] = []
+    current: List[str] = []
+    current_tokens = 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if tokens <= budget or not split:
+            pieces = [(text, tokens)]
+        else:
+            pieces = [(piece, count_tokens(piece)) for piece in _split_oversized(text, budget)]
+        for piece, piece_tokens in pieces:
+            if current and current_tokens + piece_tokens > budget:
+                windows.append(current)
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        windows.append(current)
+    return windows
+
+
+def _call(generate: Generate, parts: List[str], work_dir: str, name: str) -> str:
+    """Run one LLM call over `parts` (written as ordered input files); returns its output text."""
+    input_dir = os.path.join(work_dir, name)
+    os.makedirs(input_dir)
+    for index, part in enumerate(parts):
+        with open(os.path.join(input_dir, f"part_{index:04d}.txt"), "w", encoding="utf-8") as f:
+            f.write(part)
+    output_path = os.path.join(work_dir, f"{name}.out.txt")
+    last_error: Optional[Exception] = None
+    for attempt in range(1, max(1, MAPREDUCE_CALL_RETRIES) + 1):
+        check_cancelled()
+        try:
+            with _inflight_calls:
+                check_cancelled()
+                succeeded = generate(input_dir, output_path)
+            if not succeeded or not os.path.isfile(output_path):
+                raise ValueError("the LLM call reported failure")
+            with open(output_path, "r", encoding="utf-8", errors="replace") as f:
+                return f.read()
+        except TaskCancelled:
+            raise
+        except Exception as e:
+            last_error = e
+            if attempt < MAPREDUCE_CALL_RETRIES:
+                delay = MAPREDUCE_RETRY_BASE_DELAY * (2 ** (attempt - 1)) * (0.5 + random.random())
+                logging.warning(f"Map-reduce: Chunk {name} attempt {attempt} failed ({e}); retrying in {delay:.1f}s.")
+                cancellation.sleep(delay)
+    raise ValueError(f"Chunk {name} failed after {MAPREDUCE_CALL_RETRIES} attempt(s): {last_error}")
+
+
+def _run_all(generate: Generate, windows: List[List[str]], work_dir: str, prefix: str) -> List[str]:
+    """
+    All calls of one level on a bounded pool; outputs in window order. The first failure
+    cancels the rest; a cancelled task stops waiting for the calls still in flight.
+    """
+    failed = threading.Event()
+
+    def call(window: List[str], name: str) -> str:
+        # A pool thread may pick up the next window before shutdown() cancels it
+        if failed.is_set():
+            raise ValueError(f"Chunk {name} skipped after an earlier chunk failed")
+        try:
+            return _call(generate, window, work_dir, name)
+        except Exception:
+            failed.set()
+            raise
+
+    executor = ThreadPoolExecutor(max_workers=max(1, MAPREDUCE_WORKERS), thread_name_prefix="mapreduce")
+    try:
+        futures = [
+            submit_with_context(executor, call, window, f"{prefix}_{index:04d}")
+            for index, window in enumerate(windows)
+        ]
+        return [cancellation.wait_for(future) for future in futures]
+    finally:
+        executor.shutdown(wait=not cancel_requested(), cancel_futures=True)
+
+
+def _write_output(output_path: str, text: str):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def chunked_wordforword(generate: Generate, transcripts_dir: str, output_path: str) -> bool:
+    """
+    Word-for-word text of long transcripts: every window is cleaned up by its own
+    (concurrent) call and the results are joined in order, so latency stays close to
+    that of a single window however long the recording is.
+    """
+    windows = token_windows(read_transcripts(transcripts_dir), MAPREDUCE_CHUNK_TOKENS)
+    logging.info(f"Map-reduce: Word-for-word in {len(windows)} chunk(s).")
+    work_dir = tempfile.mkdtemp(prefix=".chunks_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        outputs = _run_all(generate, windows, work_dir, "map")
+        _write_output(output_path, "\n\n".join(output.strip() for output in outputs) + "\n")
+        return True
+    except TaskCancelled:
+        raise
+    except Exception as e:
+        logging.error(f"Map-reduce: Word-for-word failed: {e}")
+        return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def chunked_memo(generate: Generate, transcripts_dir: str, output_path: str,
+                 reduce_generate: Optional[Generate] = None) -> bool:
+    """
+    Memo of long transcripts: a partial memo per window (map), then partial memos are
+    combined by further calls, MAPREDUCE_REDUCE_TOKENS worth at a time, until one is left
+    (reduce). Calls of one level run concurrently, so latency grows with the number of
+    levels (logarithmic in the length) rather than with the length itself.
+    """
+    reduce_generate = reduce_generate or generate
+    windows = token_windows(read_transcripts(transcripts_dir), MAPREDUCE_CHUNK_TOKENS)
+    work_dir = tempfile.mkdtemp(prefix=".chunks_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        partials = _run_all(generate, windows, work_dir, "map")
+        logging.info(f"Map-reduce: Memo mapped over {len(windows)} chunk(s).")
+        level = 0
+        while len(partials) > 1:
+            level += 1
+            groups = token_windows(partials, MAPREDUCE_REDUCE_TOKENS, split=False)
+            if len(groups) == len(partials):
+                # Every partial memo fills a budget on its own: combine pairs so the reduction still converges
+                groups = [partials[i:i + 2] for i in range(0, len(partials), 2)]
+            # A group holding a single partial memo is carried over to the next level as it is
+            merged = iter(_run_all(reduce_generate, [g for g in groups if len(g) > 1], work_dir, f"reduce{level}"))
+            partials = [next(merged) if len(group) > 1 else group[0] for group in groups]
+            logging.info(f"Map-reduce: Memo reduce level {level} left {len(partials)} partial memo(s).")
+        _write_output(output_path, partials[0])
+        return True
+    except TaskCancelled:
+        raise
+    except Exception as e:
+        logging.error(f"Map-reduce: Memo failed: {e}")
+        return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
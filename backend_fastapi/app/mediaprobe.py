@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import subprocess
+from typing import Dict, Optional
+
+# ffprobe only parses container headers (up to MEDIA_PROBE_SIZE bytes), it doesn't decode the audio
+FFPROBE_BINARY = os.environ.get("FFPROBE_BINARY", "ffprobe")
+MEDIA_PROBE_ENABLED = os.environ.get("MEDIA_PROBE_ENABLED", "true").lower() in ("1", "true", "yes")
+MEDIA_PROBE_TIMEOUT = float(os.environ.get("MEDIA_PROBE_TIMEOUT", "30"))
+MEDIA_PROBE_SIZE = int(os.environ.get("MEDIA_PROBE_SIZE", str(5 * 1024 * 1024)))
+
+_ffprobe_missing_logged = False
+
+
+class MediaProbeError(ValueError):
+    """The file is not a readable audio (or audio/video) file."""
+
+
+def _container_name(format_name: str, file_path: str) -> str:
+    # ffprobe reports demuxer aliases ("mov,mp4,m4a,3gp,3g2,mj2"); prefer the one matching the extension
+    names = [name for name in format_name.split(",") if name]
+    extension = os.path.splitext(file_path)[1].lstrip(".").lower()
+    return extension if extension in names else (names[0] if names else extension)
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def probe_media(file_path: str) -> Optional[Dict]:
+    """
+    Read duration, codec, sample rate and channels of the first audio stream.
+
+    Returns None when probing is disabled or ffprobe is not installed (the file is then
+    accepted unchecked, as before); raises MediaProbeError for corrupt or unsupported files.
+    """
+    global _ffprobe_missing_logged
+    if not MEDIA_PROBE_ENABLED:
+        return None
+    command = [
+        FFPROBE_BINARY, "-v", "error", "-hide_banner",
+        "-probesize", str(MEDIA_PROBE_SIZE),
+        "-print_format", "json", "-show_format", "-show_streams", "-select_streams", "a",
+        file_path,
+    ]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=MEDIA_PROBE_TIMEOUT)
+    except FileNotFoundError:
+        if not _ffprobe_missing_logged:
+            logging.warning(f"Media probe: '{FFPROBE_BINARY}' not found; uploads are accepted without probing.")
+            _ffprobe_missing_logged = True
+        return None
+    except subprocess.TimeoutExpired:
+        raise MediaProbeError(f"Could not read the media headers within {MEDIA_PROBE_TIMEOUT:.0f}s.")
+
+    if completed.returncode != 0:
+        # The message is returned to the client, so don't expose the server-side path
+        details = completed.stderr.replace(file_path, os.path.basename(file_path)).strip()[:500]
+        raise MediaProbeError(f"Unreadable or corrupt media file: {details or 'ffprobe failed'}")
+    try:
+        result = json.loads(completed.stdout or "{}")
+    except json.JSONDecodeError:
+        raise MediaProbeError("Unreadable media file: could not parse ffprobe output.")
+
+    streams = result.get("streams") or []
+    if not streams:
+        raise MediaProbeError("The file contains no audio stream.")
+    stream = streams[0]
+    container = result.get("format") or {}
+    # Container duration first; some formats only carry it on the stream
+    duration = _to_float(container.get("duration")) or _to_float(stream.get("duration"))
+    if duration is not None and duration <= 0:
+        raise MediaProbeError("The audio stream is empty.")
+    return {
+        "container": _container_name(container.get("format_name", ""), file_path),
+        "duration": duration,
+        "codec": stream.get("codec_name"),
+        "sample_rate": _to_int(stream.get("sample_rate")),
+        "channels": _to_int(stream.get("channels")),
+        "bit_rate": _to_int(container.get("bit_rate")) or _to_int(stream.get("bit_rate")),
+    }
@@ -0,0 +1,201 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from prometheus_client import Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+from sqlalchemy import func
+
+from .cancellation import TaskCancelled
+from .db import Task, TaskStageMetric, ACTIVE_STATUSES, session_scope, engine, async_engine, api_pool_metrics, worker_pool_metrics
+
+# Stage durations span seconds (document) to hours (transcribing a long recording)
+_DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+_CALL_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+_BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(12)) # 1 KiB .. 4 GiB
+
+STAGE_DURATION = Histogram("audio2memo_stage_duration_seconds", "Wall-clock time of a pipeline stage",
+                           ["stage", "outcome"], buckets=_DURATION_BUCKETS)
+STAGE_BYTES = Histogram("audio2memo_stage_bytes", "Bytes read (in) and written (out) by a pipeline stage",
+                        ["stage", "direction"], buckets=_BYTES_BUCKETS)
+EXTERNAL_CALL_DURATION = Histogram("audio2memo_external_call_duration_seconds",
+                                   "Latency of calls to transcription and LLM APIs",
+                                   ["stage", "call", "outcome"], buckets=_CALL_BUCKETS)
+TASK_QUEUE_WAIT = Histogram("audio2memo_task_queue_wait_seconds", "Time from submission until a worker starts the task",
+                            buckets=_DURATION_BUCKETS)
+TASK_PROCESSING_TIME = Histogram("audio2memo_task_processing_seconds", "Time from submission until the task finished",
+                                 ["status"], buckets=_DURATION_BUCKETS)
+
+
+def total_size(paths: Iterable[Optional[str]]) -> int:
+    """Combined size of the given files; missing paths count as 0."""
+    return sum(os.path.getsize(path) for path in paths if path and os.path.isfile(path))
+
+
+class StageMetrics:
+    """
+    Start/end times, bytes in/out and external-call stats of one pipeline run.
+
+    Each stage gets one `task_stage_metrics` row, written when the stage ends (also when it
+    fails), and its values are observed in the Prometheus histograms. Stages of one task run
+    on different threads, so every update goes through a lock.
+    """
+
+    def __init__(self, task_id: str, attempt: Optional[int] = None):
+        self.task_id = task_id
+        self.attempt = attempt
+        self._records: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _record(self, stage: str) -> Dict[str, Any]:
+        return self._records.setdefault(stage, {
+            "reused": False, "bytes_in": None, "bytes_out": None,
+            "external_calls": 0, "external_call_errors": 0, "external_call_seconds": 0.0,
+        })
+
+    def instrument(self, stage: str, run: Callable[[Dict[str, Any]], Any]) -> Callable[[Dict[str, Any]], Any]:
+        """Wrap a Stage.run function so its timing is recorded."""
+        def timed_run(results):
+            started_at = datetime.now()
+            start = time.perf_counter()
+            outcome = "failed"
+            try:
+                result = run(results)
+                outcome = "completed"
+                return result
+            except TaskCancelled:
+                outcome = "cancelled"
+                raise
+            finally:
+                self._finish(stage, started_at, time.perf_counter() - start, outcome)
+        return timed_run
+
+    def reused(self, stage: str):
+        """The stage's output came from the manifest or the content store instead of being computed."""
+        with self._lock:
+            self._record(stage)["reused"] = True
+
+    def add_bytes(self, stage: str, bytes_in: Optional[int] = None, bytes_out: Optional[int] = None):
+        with self._lock:
+            record = self._record(stage)
+            if bytes_in is not None:
+                record["bytes_in"] = (record["bytes_in"] or 0) + bytes_in
+            if bytes_out is not None:
+                record["bytes_out"] = (record["bytes_out"] or 0) + bytes_out
+
+    def timed_call(self, stage: str, call: str, fn: Callable[..., Any],
+                   check: Optional[Callable[[Any], bool]] = None) -> Callable[..., Any]:
+        """
+        `fn` wrapped so every invocation counts as an external call of `stage`. `check`
+        decides whether a returned value means success (audio2memo reports most failures
+        through its return value rather than by raising).
+        """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            succeeded = False
+            try:
+                result = fn(*args, **kwargs)
+                succeeded = check(result) if check else True
+                return result
+            finally:
+                self._observe_call(stage, call, time.perf_counter() - start, succeeded)
+        return wrapper
+
+    def _observe_call(self, stage: str, call: str, seconds: float, succeeded: bool):
+        EXTERNAL_CALL_DURATION.labels(stage, call, "ok" if succeeded else "error").observe(seconds)
+        with self._lock:
+            record = self._record(stage)
+            record["external_calls"] += 1
+            record["external_call_errors"] += 0 if succeeded else 1
+            record["external_call_seconds"] += seconds
+
+    def _finish(self, stage: str, started_at: datetime, seconds: float, outcome: str):
+        with self._lock:
+            record = dict(self._record(stage))
+        if outcome == "completed" and record["reused"]:
+            outcome = "reused"
+        STAGE_DURATION.labels(stage, outcome).observe(seconds)
+        for direction in ("in", "out"):
+            if record[f"bytes_{direction}"] is not None:
+                STAGE_BYTES.labels(stage, direction).observe(record[f"bytes_{direction}"])
+        try:
+            with session_scope() as db:
+                db.add(TaskStageMetric(
+                    task_id=self.task_id,
+                    attempt=self.attempt,
+                    stage=stage,
+                    outcome=outcome,
+                    started_at=started_at,
+                    finished_at=datetime.now(),
+                    duration_seconds=seconds,
+                    bytes_in=record["bytes_in"],
+                    bytes_out=record["bytes_out"],
+                    external_calls=record["external_calls"],
+                    external_call_errors=record["external_call_errors"],
+                    external_call_seconds=record["external_call_seconds"],
+                ))
+        except Exception as e:
+            # Metrics must never fail the task
+            logging.error(f"Task {self.task_id}: Failed to store metrics of stage '{stage}': {e}")
+
+
+def observe_task_started(task: Task):
+    # Only the first run: retries and recoveries would count the earlier processing time as waiting
+    if task.submit_time and (task.attempts or 0) <= 1:
+        TASK_QUEUE_WAIT.observe(max(0.0, (datetime.now() - task.submit_time).total_seconds()))
+
+
+def observe_task_finished(task: Optional[Task]):
+    if task is not None and task.processing_time is not None:
+        TASK_PROCESSING_TIME.labels(task.status).observe(task.processing_time)
+
+
+class _StateCollector:
+    """Gauges read at scrape time: queue depth, unfinished tasks per status and DB pool usage."""
+
+    def describe(self):
+        # Without describe() the registry calls collect() on registration, querying the database on import
+        return []
+
+    def collect(self):
+        try:
+            with session_scope() as db:
+                per_status = dict(db.query(Task.status, func.count(Task.task_id)).filter(
+                    Task.status.in_(ACTIVE_STATUSES)
+                ).group_by(Task.status).all())
+                queue_depth = db.query(func.count(Task.task_id)).filter(
+                    Task.status == "submitted", Task.worker_id.is_(None)
+                ).scalar()
+        except Exception as e:
+            logging.error(f"Metrics: Failed to read task counts: {e}")
+        else:
+            depth = GaugeMetricFamily("audio2memo_queue_depth", "Submitted tasks waiting for a worker")
+            depth.add_metric([], queue_depth or 0)
+            yield depth
+            tasks = GaugeMetricFamily("audio2memo_tasks", "Unfinished tasks per status", labels=["status"])
+            for status in ACTIVE_STATUSES:
+                tasks.add_metric([status], per_status.get(status, 0))
+            yield tasks
+
+        size = GaugeMetricFamily("audio2memo_db_pool_size", "Configured pool size", labels=["pool"])
+        checked_out = GaugeMetricFamily("audio2memo_db_pool_checked_out", "Connections in use", labels=["pool"])
+        overflow = GaugeMetricFamily("audio2memo_db_pool_overflow", "Connections open beyond the pool size", labels=["pool"])
+        timeouts = CounterMetricFamily("audio2memo_db_pool_checkout_timeouts", "Checkouts that hit DB_POOL_TIMEOUT", labels=["pool"])
+        wait = HistogramMetricFamily("audio2memo_db_pool_checkout_wait_seconds", "Time spent waiting for a pool connection", labels=["pool"])
+        for name, pool_metrics, pool in (("api", api_pool_metrics, async_engine.pool), ("worker", worker_pool_metrics, engine.pool)):
+            stats = pool_metrics.snapshot(pool)
+            if "size" in stats:
+                size.add_metric([name], stats["size"])
+                checked_out.add_metric([name], stats["checked_out"])
+                overflow.add_metric([name], stats["overflow"])
+            timeouts.add_metric([name], stats["checkout_timeouts"])
+            # PoolMetrics buckets are already cumulative
+            buckets = list(stats["checkout_wait_buckets"].items()) + [("+Inf", stats["checkouts"])]
+            wait.add_metric([name], buckets, sum_value=stats["checkout_wait_seconds_total"])
+        yield from (size, checked_out, overflow, timeouts, wait)
+
+
+REGISTRY.register(_StateCollector())
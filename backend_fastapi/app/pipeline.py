@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from .cancellation import CANCEL_CHECK_INTERVAL, TaskCancelled, cancel_reason, cancel_requested, check_cancelled
+from .tasklog import stage_log_context, submit_with_context
+
+# Upper bound on stages of one task running at the same time
+PIPELINE_MAX_PARALLEL_STAGES = int(os.environ.get("PIPELINE_MAX_PARALLEL_STAGES", "2"))
+# Task.status while more than one stage is active; the stages themselves are listed in Task.active_stages
+PARALLEL_STATUS = "processing_parallel"
+
+
+class Stage:
+    """
+    One step of the audio2memo pipeline.
+
+    `run` receives the results of all finished stages (keyed by stage name) and returns this
+    stage's result. `status` is the Task.status reported while the stage is running.
+    """
+
+    def __init__(self, name: str, status: str, run: Callable[[Dict[str, Any]], Any],
+                 depends_on: Optional[List[str]] = None):
+        self.name = name
+        self.status = status
+        self.run = run
+        self.depends_on = list(depends_on or [])
+
+
+class StageGraph:
+    """
+    Runs stages as soon as all of their dependencies have finished.
+
+    Independent stages (e.g. word-for-word and memo draft, which both only read the
+    transcripts) therefore run concurrently. `on_active_change` is called with the
+    statuses of the running stages whenever that set changes; calls are serialized,
+    so it may safely write to a single DB session.
+    """
+
+    def __init__(self, stages: List[Stage], on_active_change: Optional[Callable[[List[str]], None]] = None,
+                 max_parallel: int = PIPELINE_MAX_PARALLEL_STAGES):
+        self.stages = {stage.name: stage for stage in stages}
+        self._on_active_change = on_active_change
+        self._max_parallel = max(1, max_parallel)
+        self._active: List[str] = []
+        self._active_lock = threading.Lock()
+        for stage in stages:
+            for dep in stage.depends_on:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dep}'.")
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visiting, done = set(), set()
+
+        def visit(name: str):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage graph has a cycle through '{name}'.")
+            visiting.add(name)
+            for dep in self.stages[name].depends_on:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _set_active(self, stage: Stage, active: bool):
+        with self._active_lock:
+            if active:
+                self._active.append(stage.status)
+            else:
+                self._active.remove(stage.status)
+            if self._on_active_change and self._active:
+                self._on_active_change(list(self._active))
+
+    def _run_stage(self, stage: Stage, results: Dict[str, Any]) -> Any:
+        check_cancelled() # Queued behind another stage while the task was cancelled
+        with stage_log_context(stage.name):
+            self._set_active(stage, True)
+            try:
+                return stage.run(results)
+            finally:
+                self._set_active(stage, False)
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Run every stage; the first stage error is re-raised after running stages have finished.
+        When the task is cancelled, TaskCancelled is raised right away (also while stages are
+        still being waited for after a failure): running stages are abandoned rather than
+        waited for, so the worker slot is free for the next task.
+        """
+        results: Dict[str, Any] = {}
+        remaining = dict(self.stages)
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=self._max_parallel, thread_name_prefix="stage")
+        cancelled = False
+        try:
+            while remaining or running:
+                check_cancelled()
+                ready = [s for s in remaining.values() if all(dep in results for dep in s.depends_on)]
+                for stage in ready[:max(0, self._max_parallel - len(running))]:
+                    del remaining[stage.name]
+                    # Each stage sees a snapshot, so concurrent stages never share a mutating dict
+                    running[submit_with_context(executor, self._run_stage, stage, dict(results))] = stage
+                if not running:
+                    raise RuntimeError(f"Stage graph stalled with stages left: {list(remaining)}")
+
+                finished, _ = wait(running, timeout=CANCEL_CHECK_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        if running and not isinstance(error, TaskCancelled):
+                            logging.info(f"Stage '{stage.name}' failed; waiting for {len(running)} running stage(s) to finish.")
+                            while running:
+                                # Still abandoned at once when the task is cancelled meanwhile
+                                check_cancelled()
+                                for sibling in wait(running, timeout=CANCEL_CHECK_INTERVAL).done:
+                                    running.pop(sibling)
+                        raise error
+                    results[stage.name] = future.result()
+        except TaskCancelled as e:
+            cancelled = True
+            logging.info(f"Task cancelled; abandoning {len(running)} running stage(s).")
+            raise TaskCancelled(str(e), pending=list(running) + e.pending) from None
+        except Exception:
+            # A stage that failed because of the cancellation (e.g. its input was cut short)
+            if cancel_requested():
+                cancelled = True
+                raise TaskCancelled(cancel_reason(), pending=list(running)) from None
+            raise
+        finally:
+            executor.shutdown(wait=not cancelled, cancel_futures=cancelled)
+        return results
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy.exc import IntegrityError
+
+from . import cancellation
+from .db import SessionLocal, RateLimitBucket
+
+# "local": buckets live in this process (one uvicorn worker / node)
+# "database": buckets live in the rate_limit_buckets table and are shared by every node
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "local")
+# Default quotas per transcription model; 0 disables that limit
+TRANSCRIBE_DEFAULT_RPM = float(os.environ.get("TRANSCRIBE_DEFAULT_RPM", "50"))
+TRANSCRIBE_DEFAULT_BYTES_PER_MINUTE = float(os.environ.get("TRANSCRIBE_DEFAULT_BYTES_PER_MINUTE", "0"))
+# Per-model overrides, e.g. {"whisper-1": {"requests_per_minute": 50, "bytes_per_minute": 500000000}}
+TRANSCRIBE_RATE_LIMITS = os.environ.get("TRANSCRIBE_RATE_LIMITS", "")
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled continuously at `rate_per_second` up to `capacity`."""
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _try_take(self, cost: float) -> float:
+        """Take `cost` tokens if available; otherwise return the seconds to wait for them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return 0.0
+            return (cost - self._tokens) / self.rate
+
+    def acquire(self, cost: float = 1.0, timeout: Optional[float] = None) -> bool:
+        # A request larger than the whole bucket could never be served; let it through on a full bucket
+        cost = min(cost, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait_seconds = self._try_take(cost)
+            if wait_seconds == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait_seconds > deadline:
+                return False
+            # Ends early (TaskCancelled) when the waiting task is cancelled
+            cancellation.sleep(min(wait_seconds, 1.0))
+
+
+class DatabaseTokenBucket:
+    """Token bucket stored in the rate_limit_buckets table, so all nodes draw from the same quota."""
+
+    def __init__(self, key: str, rate_per_second: float, capacity: float):
+        self.key = key
+        self.rate = rate_per_second
+        self.capacity = capacity
+
+    def _try_take(self, cost: float) -> float:
+        db = SessionLocal()
+        try:
+            bucket = db.query(RateLimitBucket).filter(RateLimitBucket.key == self.key).with_for_update().first()
+            now = datetime.now()
+            if bucket is None:
+                bucket = RateLimitBucket(key=self.key, tokens=self.capacity, updated_at=now)
+                db.add(bucket)
+            else:
+                elapsed = max(0.0, (now - bucket.updated_at).total_seconds())
+                bucket.tokens = min(self.capacity, bucket.tokens + elapsed * self.rate)
+                bucket.updated_at = now
+            if bucket.tokens >= cost:
+                bucket.tokens -= cost
+                wait_seconds = 0.0
+            else:
+                wait_seconds = (cost - bucket.tokens) / self.rate
+            db.commit()
+            return wait_seconds
+        except IntegrityError:
+            # Another node created the row first; just try again
+            db.rollback()
+            return 0.05
+        finally:
+            db.close()
+
+    def acquire(self, cost: float = 1.0, timeout: Optional[float] = None) -> bool:
+        cost = min(cost, self.capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait_seconds = self._try_take(cost)
+            if wait_seconds == 0.0:
+                return True
+            if deadline is not None and time.monotonic() + wait_seconds > deadline:
+                return False
+            cancellation.sleep(min(wait_seconds, 1.0))
+
+
+def _make_bucket(key: str, per_minute: float):
+    rate = per_minute / 60.0
+    if RATE_LIMIT_BACKEND == "database":
+        return DatabaseTokenBucket(key, rate, per_minute)
+    return TokenBucket(rate, per_minute)
+
+
+class ApiRateLimiter:
+    """
+    Request and byte quotas per external model, shared by every task in the process
+    (and by every node with RATE_LIMIT_BACKEND=database).
+    """
+
+    def __init__(self, overrides: Optional[Dict[str, Dict[str, float]]] = None):
+        self._overrides = overrides or {}
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def _buckets_for(self, model_name: str) -> list:
+        with self._lock:
+            if model_name not in self._buckets:
+                limits = self._overrides.get(model_name, {})
+                rpm = float(limits.get("requests_per_minute", TRANSCRIBE_DEFAULT_RPM))
+                bpm = float(limits.get("bytes_per_minute", TRANSCRIBE_DEFAULT_BYTES_PER_MINUTE))
+                buckets = []
+                if rpm > 0:
+                    buckets.append(("requests", _make_bucket(f"{model_name}:requests", rpm)))
+                if bpm > 0:
+                    buckets.append(("bytes", _make_bucket(f"{model_name}:bytes", bpm)))
+                self._buckets[model_name] = buckets
+            return self._buckets[model_name]
+
+    def acquire(self, model_name: str, payload_bytes: int = 0, timeout: Optional[float] = None) -> bool:
+        """Block until one request of `payload_bytes` to `model_name` fits in the quota."""
+        for kind, bucket in self._buckets_for(model_name):
+            cost = 1.0 if kind == "requests" else float(payload_bytes)
+            if cost and not bucket.acquire(cost, timeout=timeout):
+                return False
+        return True
+
+
+def _load_overrides() -> Dict[str, Dict[str, float]]:
+    if not TRANSCRIBE_RATE_LIMITS:
+        return {}
+    try:
+        return json.loads(TRANSCRIBE_RATE_LIMITS)
+    except json.JSONDecodeError as e:
+        logging.error(f"TRANSCRIBE_RATE_LIMITS is not valid JSON, using default quotas: {e}")
+        return {}
+
+
+# Process-wide limiter shared by all tasks and worker threads
+transcription_rate_limiter = ApiRateLimiter(_load_overrides())
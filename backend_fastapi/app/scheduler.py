@@ -0,0 +1,376 @@
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import func, or_, and_
+
+from .cancellation import LEASE_LOST, request_cancel
+from .changefeed import next_version
+from .db import SessionLocal, Task, ACTIVE_STATUSES, PROCESSING_STATUSES
+
+# --- Scheduler Configuration ---
+SCHEDULER_WORKER_SLOTS = int(os.environ.get("SCHEDULER_WORKER_SLOTS", "2"))
+# Fallback polling interval (seconds); new submissions wake the workers immediately via notify()
+SCHEDULER_POLL_INTERVAL = float(os.environ.get("SCHEDULER_POLL_INTERVAL", "10"))
+# Stable per-node identity; keep it fixed across restarts so a node can take back its own tasks at once
+SCHEDULER_WORKER_ID = os.environ.get("SCHEDULER_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# A claimed task belongs to its worker until lease_expires_at; heartbeats keep extending it
+SCHEDULER_LEASE_SECONDS = float(os.environ.get("SCHEDULER_LEASE_SECONDS", "120"))
+SCHEDULER_HEARTBEAT_INTERVAL = float(os.environ.get("SCHEDULER_HEARTBEAT_INTERVAL", "30"))
+# How often (seconds) tasks running here are checked for cancel requests made through other nodes
+SCHEDULER_CANCEL_POLL_INTERVAL = float(os.environ.get("SCHEDULER_CANCEL_POLL_INTERVAL", "2"))
+# A task whose lease expired this many times is marked 'timed_out' instead of being retried again
+SCHEDULER_MAX_ATTEMPTS = int(os.environ.get("SCHEDULER_MAX_ATTEMPTS", "3"))
+
+
+def submitter_key(task_user_id: Optional[str], task_to_email: Optional[str]) -> str:
+    """Identity used for per-submitter fairness: user_id when known, otherwise the To email."""
+    return task_user_id or task_to_email or "anonymous"
+
+
+class TaskScheduler:
+    """
+    Runs `submitted` rows from the `tasks` table on a fixed number of worker threads.
+
+    The table itself is the queue, so anything not yet finished survives a restart.
+    Tasks are picked by priority first, then by how many tasks their submitter already
+    has running, then by submit time, so one large upload batch cannot starve other users.
+
+    Several nodes can share one database: a task is claimed with a conditional UPDATE that
+    records worker_id and lease_expires_at, and only one node's UPDATE can match. Heartbeats
+    extend the lease while the pipeline runs; when a node dies its leases expire and any node
+    puts the task back into the queue, or marks it 'timed_out' after SCHEDULER_MAX_ATTEMPTS.
+    Tasks running here are also polled for Task.cancel_requested_at and cancelled when it is set.
+    A run whose lease was reclaimed by another node is stopped the same way (see `lease_lost`);
+    its terminal writes are conditional on worker_id, so it can't overwrite the new owner's.
+    """
+
+    def __init__(self, runner: Callable[[str], None], worker_slots: int = SCHEDULER_WORKER_SLOTS,
+                 poll_interval: float = SCHEDULER_POLL_INTERVAL, worker_id: str = SCHEDULER_WORKER_ID,
+                 lease_seconds: float = SCHEDULER_LEASE_SECONDS,
+                 heartbeat_interval: float = SCHEDULER_HEARTBEAT_INTERVAL,
+                 max_attempts: int = SCHEDULER_MAX_ATTEMPTS,
+                 cancel_poll_interval: float = SCHEDULER_CANCEL_POLL_INTERVAL,
+                 on_timed_out: Optional[Callable[[str], None]] = None):
+        self._runner = runner
+        self._on_timed_out = on_timed_out # Called (after commit) for every task marked 'timed_out'
+        self._worker_slots = max(1, worker_slots)
+        self._poll_interval = poll_interval
+        self.worker_id = worker_id
+        self._lease = timedelta(seconds=lease_seconds)
+        self._heartbeat_interval = heartbeat_interval
+        self._cancel_poll_interval = cancel_poll_interval
+        self._max_attempts = max(1, max_attempts)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock() # Serializes claiming between this node's workers
+        self._running: Dict[str, str] = {} # task_id -> submitter key
+        self._lost_leases: Set[str] = set()
+        self._threads: List[threading.Thread] = []
+
+    # --- Lifecycle ---
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        self.recover_unfinished_tasks()
+        for slot in range(self._worker_slots):
+            thread = threading.Thread(target=self._worker_loop, name=f"task-worker-{slot}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name="task-heartbeat", daemon=True)
+        heartbeat.start()
+        self._threads.append(heartbeat)
+        logging.info(f"Scheduler: Worker '{self.worker_id}' started with {self._worker_slots} worker slot(s).")
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+        logging.info("Scheduler: Stopped. Unfinished tasks will be resumed when their leases are reclaimed.")
+
+    def notify(self):
+        """Wake idle workers, e.g. right after a new task row was committed."""
+        self._wakeup.set()
+
+    def is_running(self) -> bool:
+        return bool(self._threads)
+
+    def running_tasks(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._running)
+
+    def lease_lost(self, task_id: str) -> bool:
+        """True when another node has reclaimed a task this node is still running."""
+        with self._lock:
+            return task_id in self._lost_leases
+
+    # --- Recovery ---
+    def recover_unfinished_tasks(self) -> int:
+        """
+        Put tasks interrupted on this node back into the queue right away.
+
+        Tasks held by this worker_id (a restart of the same node) and in-progress rows
+        without any lease are requeued immediately; leases of other nodes are left to expire.
+        """
+        db = SessionLocal()
+        try:
+            interrupted = db.query(Task).filter(
+                Task.status.in_(ACTIVE_STATUSES),
+                or_(
+                    Task.worker_id == self.worker_id,
+                    and_(Task.worker_id.is_(None), Task.status.in_(PROCESSING_STATUSES)),
+                )
+            ).all()
+            for task in interrupted:
+                logging.info(f"Task {task.task_id}: Interrupted in '{task.status}', re-enqueueing.")
+                self._requeue_or_time_out(task, reason="interrupted by restart")
+            db.commit()
+            self._report_timed_out(interrupted)
+            reclaimed = self.reclaim_expired_leases()
+            pending = db.query(func.count(Task.task_id)).filter(
+                Task.status == "submitted", Task.worker_id.is_(None)
+            ).scalar()
+            logging.info(f"Scheduler: Re-enqueued {len(interrupted) + reclaimed} interrupted task(s); {pending} task(s) pending.")
+            return len(interrupted) + reclaimed
+        except Exception as e:
+            logging.error(f"Scheduler: Failed to recover unfinished tasks: {e}", exc_info=True)
+            db.rollback()
+            return 0
+        finally:
+            db.close()
+
+    def reclaim_expired_leases(self) -> int:
+        """Requeue (or time out) tasks whose worker stopped heartbeating."""
+        db = SessionLocal()
+        try:
+            now = datetime.now()
+            expired = db.query(Task).filter(
+                Task.worker_id.isnot(None),
+                Task.lease_expires_at < now,
+                Task.status.in_(ACTIVE_STATUSES),
+            ).with_for_update(skip_locked=True).all()
+            # This node's own runs whose heartbeats fell behind lose their tasks like anyone else's
+            own = [task.task_id for task in expired if task.worker_id == self.worker_id]
+            for task in expired:
+                logging.warning(f"Task {task.task_id}: Lease held by '{task.worker_id}' expired at {task.lease_expires_at}.")
+                self._requeue_or_time_out(task, reason=f"lease held by worker '{task.worker_id}' expired")
+            db.commit()
+            self._mark_lease_lost(own)
+            self._report_timed_out(expired)
+            if expired:
+                self._wakeup.set()
+            return len(expired)
+        except Exception as e:
+            logging.error(f"Scheduler: Failed to reclaim expired leases: {e}", exc_info=True)
+            db.rollback()
+            return 0
+        finally:
+            db.close()
+
+    def _requeue_or_time_out(self, task: Task, reason: str):
+        task.worker_id = None
+        task.lease_expires_at = None
+        task.last_update_time = datetime.now()
+        if (task.attempts or 0) >= self._max_attempts:
+            task.status = "timed_out"
+            task.error = f"Gave up after {task.attempts} attempt(s): {reason}."
+            if task.submit_time:
+                task.processing_time = (task.last_update_time - task.submit_time).total_seconds()
+            logging.error(f"Task {task.task_id}: Marked timed_out after {task.attempts} attempt(s).")
+        else:
+            task.status = "submitted"
+
+    def _report_timed_out(self, tasks: List[Task]):
+        if self._on_timed_out is None:
+            return
+        for task in tasks:
+            if task.status != "timed_out":
+                continue
+            try:
+                self._on_timed_out(task.task_id)
+            except Exception as e:
+                logging.error(f"Task {task.task_id}: Timed-out callback failed: {e}", exc_info=True)
+
+    # --- Claiming ---
+    def _claim_next(self) -> Optional[str]:
+        with self._lock:
+            db = SessionLocal()
+            try:
+                # Same identity as submitter_key(), so the running counts below match the heads
+                submitter = func.coalesce(func.nullif(Task.user_id, ""), func.nullif(Task.to_email, ""), "anonymous")
+                # Head of each submitter's queue: highest priority, then oldest
+                ranked = db.query(
+                    Task.task_id.label("task_id"),
+                    Task.user_id.label("user_id"),
+                    Task.to_email.label("to_email"),
+                    Task.priority.label("priority"),
+                    Task.submit_time.label("submit_time"),
+                    func.row_number().over(
+                        partition_by=submitter,
+                        order_by=(func.coalesce(Task.priority, 0).desc(), Task.submit_time.asc())
+                    ).label("rank"),
+                ).filter(Task.status == "submitted", Task.worker_id.is_(None)).subquery()
+                heads = db.query(ranked).filter(ranked.c.rank == 1).all()
+                if not heads:
+                    return None
+
+                # Running counts across all nodes, not just this one
+                running_per_submitter: Dict[str, int] = {
+                    key: count for key, count in db.query(submitter, func.count(Task.task_id)).filter(
+                        Task.worker_id.isnot(None), Task.status.in_(ACTIVE_STATUSES)
+                    ).group_by(submitter).all()
+                }
+
+                def sort_key(row):
+                    return (
+                        -(row.priority or 0),
+                        running_per_submitter.get(submitter_key(row.user_id, row.to_email), 0),
+                        row.submit_time or datetime.min,
+                    )
+
+                for candidate in sorted(heads, key=sort_key):
+                    if candidate.task_id in self._running:
+                        continue # Requeued while its abandoned run here is still winding down
+                    # Atomic claim: only one node's UPDATE can still see worker_id IS NULL
+                    claimed = db.query(Task).filter(
+                        Task.task_id == candidate.task_id,
+                        Task.status == "submitted",
+                        Task.worker_id.is_(None),
+                    ).update({
+                        Task.worker_id: self.worker_id,
+                        Task.lease_expires_at: datetime.now() + self._lease,
+                        Task.attempts: func.coalesce(Task.attempts, 0) + 1,
+                        Task.start_time: datetime.now(),
+                        Task.last_update_time: datetime.now(),
+                        Task.version: next_version(db.connection()),
+                    }, synchronize_session=False)
+                    db.commit()
+                    if claimed == 1:
+                        self._running[candidate.task_id] = submitter_key(candidate.user_id, candidate.to_email)
+                        self._lost_leases.discard(candidate.task_id)
+                        return candidate.task_id
+                    logging.info(f"Task {candidate.task_id}: Claimed by another worker first, trying next candidate.")
+                return None
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def _release(self, task_id: str):
+        db = SessionLocal()
+        try:
+            task = db.query(Task).filter(Task.task_id == task_id, Task.worker_id == self.worker_id).first()
+            if task:
+                if task.status == "submitted":
+                    # The run ended without ever starting the pipeline; don't let it loop forever
+                    self._requeue_or_time_out(task, reason="run ended before processing started")
+                else:
+                    task.worker_id = None
+                    task.lease_expires_at = None
+                db.commit()
+        except Exception as e:
+            logging.error(f"Task {task_id}: Failed to release lease: {e}", exc_info=True)
+            db.rollback()
+        finally:
+            db.close()
+        with self._lock:
+            self._running.pop(task_id, None)
+            self._lost_leases.discard(task_id)
+        # A finished slot may unblock another submitter's task
+        self._wakeup.set()
+
+    # --- Heartbeat ---
+    def _heartbeat(self):
+        held = list(self.running_tasks().keys())
+        if not held:
+            return
+        lost = []
+        db = SessionLocal()
+        try:
+            now = datetime.now()
+            version = next_version(db.connection()) # last_update_time moves, so change-feed clients must see it
+            for task_id in held:
+                renewed = db.query(Task).filter(
+                    Task.task_id == task_id, Task.worker_id == self.worker_id
+                ).update({
+                    Task.lease_expires_at: now + self._lease,
+                    Task.last_update_time: now,
+                    Task.version: version,
+                }, synchronize_session=False)
+                if renewed == 0:
+                    lost.append(task_id)
+            db.commit()
+        except Exception as e:
+            logging.error(f"Scheduler: Heartbeat failed: {e}", exc_info=True)
+            db.rollback()
+        finally:
+            db.close()
+        self._mark_lease_lost(lost)
+
+    def _mark_lease_lost(self, task_ids: List[str]):
+        # The task is queued again or runs elsewhere: stop spending API quota on it and writing its status
+        for task_id in task_ids:
+            with self._lock:
+                if task_id not in self._running:
+                    continue # Finished and released in the meantime
+                if task_id not in self._lost_leases:
+                    logging.warning(f"Task {task_id}: Lease lost to another worker; abandoning this run.")
+                self._lost_leases.add(task_id)
+            request_cancel(task_id, reason=LEASE_LOST)
+
+    def _check_cancellations(self):
+        held = list(self.running_tasks().keys())
+        if not held:
+            return
+        db = SessionLocal()
+        try:
+            flagged = [task_id for (task_id,) in db.query(Task.task_id).filter(
+                Task.task_id.in_(held), Task.cancel_requested_at.isnot(None)
+            ).all()]
+        except Exception as e:
+            logging.error(f"Scheduler: Failed to check for cancel requests: {e}", exc_info=True)
+            return
+        finally:
+            db.close()
+        for task_id in flagged:
+            request_cancel(task_id)
+
+    def _heartbeat_loop(self):
+        # Ticks at the (shorter) cancel poll interval; leases are renewed every heartbeat interval
+        next_heartbeat = time.monotonic() + self._heartbeat_interval
+        while not self._stop.wait(timeout=min(self._cancel_poll_interval, self._heartbeat_interval)):
+            self._check_cancellations()
+            if time.monotonic() >= next_heartbeat:
+                next_heartbeat = time.monotonic() + self._heartbeat_interval
+                self._heartbeat()
+                self.reclaim_expired_leases()
+
+    # --- Worker ---
+    def _worker_loop(self):
+        while not self._stop.is_set():
+            try:
+                task_id = self._claim_next()
+            except Exception as e:
+                logging.error(f"Scheduler: Failed to claim next task: {e}", exc_info=True)
+                task_id = None
+
+            if task_id is None:
+                self._wakeup.wait(timeout=self._poll_interval)
+                self._wakeup.clear()
+                continue
+
+            logging.info(f"Task {task_id}: Claimed by '{self.worker_id}' ({threading.current_thread().name}).")
+            try:
+                self._runner(task_id)
+            except Exception as e:
+                logging.error(f"Task {task_id}: Unhandled error in scheduled run: {e}", exc_info=True)
+            finally:
+                self._release(task_id)
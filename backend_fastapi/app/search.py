@@ -0,0 +1,85 @@
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Dict, List
+
+from sqlalchemy import func, literal_column, select, text
+
+from .db import TaskDocument, TASK_SEARCH_TS_CONFIG
+
+# Longest text kept per document; transcripts of very long recordings are truncated. PostgreSQL
+# rejects tsvectors over 1 MB, and a document that fails to index drops out of search, so the
+# default (at most ~800 KB of UTF-8, usually far less) leaves room for lexeme positions
+TASK_SEARCH_MAX_CHARS = int(os.getenv("TASK_SEARCH_MAX_CHARS", "200000"))
+_SQLITE_FTS_TABLE = "task_documents_fts"
+# The trigram tokenizer matches any substring of 3+ characters, which also covers Chinese text
+_SQLITE_FTS_MIN_QUERY_CHARS = 3
+
+_sqlite_fts_ready = False
+
+
+def _dialect(db) -> str:
+    return db.get_bind().dialect.name
+
+
+def _ts_config():
+    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_.]*", TASK_SEARCH_TS_CONFIG):
+        raise ValueError(f"Invalid TASK_SEARCH_TS_CONFIG: {TASK_SEARCH_TS_CONFIG!r}")
+    # A literal (not a bound parameter), so the expression matches the index definition
+    return literal_column(f"'{TASK_SEARCH_TS_CONFIG}'::regconfig")
+
+
+def _ensure_sqlite_fts(db):
+    """SQLite stand-in for the tsvector index (local runs and tests)."""
+    global _sqlite_fts_ready
+    if not _sqlite_fts_ready:
+        db.execute(text(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {_SQLITE_FTS_TABLE} "
+            "USING fts5(task_id UNINDEXED, kind UNINDEXED, content, tokenize='trigram')"
+        ))
+        _sqlite_fts_ready = True
+
+
+def _read_text(paths: List[str]) -> str:
+    parts = []
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                parts.append(f.read())
+    return "\n".join(parts)[:TASK_SEARCH_MAX_CHARS]
+
+
+def index_task_documents(db, task_id: str, documents: Dict[str, List[str]]):
+    """Store the text of a task's outputs ({kind: [file paths]}) for full-text search."""
+    is_sqlite = _dialect(db) == "sqlite"
+    if is_sqlite:
+        _ensure_sqlite_fts(db)
+    for kind, paths in documents.items():
+        content = _read_text(paths)
+        db.merge(TaskDocument(task_id=task_id, kind=kind, content=content, updated_at=datetime.now()))
+        if is_sqlite:
+            db.execute(text(f"DELETE FROM {_SQLITE_FTS_TABLE} WHERE task_id = :task_id AND kind = :kind"),
+                       {"task_id": task_id, "kind": kind})
+            db.execute(text(f"INSERT INTO {_SQLITE_FTS_TABLE} (task_id, kind, content) VALUES (:task_id, :kind, :content)"),
+                       {"task_id": task_id, "kind": kind, "content": content})
+    db.commit()
+    logging.info(f"Task {task_id}: Indexed {len(documents)} document(s) for search.")
+
+
+def matching_task_ids(db, query: str):
+    """Subquery of task_ids whose transcript, word-for-word or memo draft matches `query`."""
+    dialect = _dialect(db)
+    if dialect == "postgresql":
+        config = _ts_config()
+        return select(TaskDocument.task_id).where(
+            func.to_tsvector(config, TaskDocument.content).op("@@")(func.plainto_tsquery(config, query))
+        ).distinct()
+    if dialect == "sqlite" and len(query) >= _SQLITE_FTS_MIN_QUERY_CHARS:
+        _ensure_sqlite_fts(db)
+        phrase = '"' + query.replace('"', '""') + '"'
+        return select(literal_column("task_id")).select_from(text(_SQLITE_FTS_TABLE)).where(
+            text(f"{_SQLITE_FTS_TABLE} MATCH :fts_query").bindparams(fts_query=phrase)
+        ).distinct()
+    # Too short for trigrams (or another database): unindexed substring match
+    return select(TaskDocument.task_id).where(TaskDocument.content.contains(query, autoescape=True)).distinct()
@@ -0,0 +1,142 @@
+import logging
+import os
+import subprocess
+import tempfile
+from typing import Iterator
+
+from .cancellation import CANCEL_CHECK_INTERVAL, check_cancelled
+
+# Split with ffmpeg's segment muxer and hand each segment to transcription as soon as it is
+# written, instead of waiting for process_audio.split_audio to decode the whole recording.
+PIPELINE_STREAMING_SPLIT = os.environ.get("PIPELINE_STREAMING_SPLIT", "true").lower() in ("1", "true", "yes")
+FFMPEG_BINARY = os.environ.get("FFMPEG_BINARY", "ffmpeg")
+SEGMENT_SECONDS = int(os.environ.get("SEGMENT_SECONDS", "600"))
+SEGMENT_BITRATE = os.environ.get("SEGMENT_BITRATE", "64k")
+
+# Optional normalization stage: transcode the upload once to compact mono speech audio, so
+# segmentation reads less data and the segments sent to the transcription API are smaller
+PIPELINE_TRANSCODE = os.environ.get("PIPELINE_TRANSCODE", "false").lower() in ("1", "true", "yes")
+TRANSCODE_CODEC = os.environ.get("TRANSCODE_CODEC", "libmp3lame")
+TRANSCODE_BITRATE = os.environ.get("TRANSCODE_BITRATE", "32k")
+TRANSCODE_SAMPLE_RATE = int(os.environ.get("TRANSCODE_SAMPLE_RATE", "16000"))
+# Trim leading silence and shorten pauses (also the trailing one) to TRANSCODE_SILENCE_KEEP_SECONDS
+TRANSCODE_TRIM_SILENCE = os.environ.get("TRANSCODE_TRIM_SILENCE", "false").lower() in ("1", "true", "yes")
+TRANSCODE_SILENCE_THRESHOLD = os.environ.get("TRANSCODE_SILENCE_THRESHOLD", "-50dB")
+TRANSCODE_SILENCE_SECONDS = float(os.environ.get("TRANSCODE_SILENCE_SECONDS", "2.0"))
+TRANSCODE_SILENCE_KEEP_SECONDS = float(os.environ.get("TRANSCODE_SILENCE_KEEP_SECONDS", "0.5"))
+
+# Container for each supported codec; all of them accepted by the transcription API
+_CODEC_EXTENSIONS = {
+    "libmp3lame": ".mp3", "mp3": ".mp3",
+    "libopus": ".ogg", "opus": ".ogg", "libvorbis": ".ogg",
+    "aac": ".m4a",
+    "flac": ".flac",
+    "pcm_s16le": ".wav",
+}
+_LOSSLESS_CODECS = ("flac", "pcm_s16le")
+
+
+def transcoded_extension(codec: str = TRANSCODE_CODEC) -> str:
+    if codec not in _CODEC_EXTENSIONS:
+        raise ValueError(f"Unsupported TRANSCODE_CODEC '{codec}'; use one of {sorted(_CODEC_EXTENSIONS)}.")
+    return _CODEC_EXTENSIONS[codec]
+
+
+def transcode_audio(input_file_path: str, output_file_path: str) -> str:
+    """
+    Transcode the first audio stream to mono TRANSCODE_SAMPLE_RATE audio in TRANSCODE_CODEC
+    (optionally with silence trimmed). Written next to the target and renamed on success,
+    so an interrupted run never leaves a truncated file behind. ffmpeg is killed as soon
+    as the task is cancelled, raising TaskCancelled.
+    """
+    base, extension = os.path.splitext(output_file_path)
+    partial_path = f"{base}.part{extension}"
+    command = [
+        FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+        "-i", input_file_path,
+        "-map", "0:a:0", "-vn", "-ac", "1", "-ar", str(TRANSCODE_SAMPLE_RATE),
+    ]
+    if TRANSCODE_TRIM_SILENCE:
+        # A single streaming pass: unlike the areverse trick for trailing silence, this never
+        # holds the whole recording in memory
+        command += ["-af", (
+            f"silenceremove=start_periods=1:start_threshold={TRANSCODE_SILENCE_THRESHOLD}"
+            f":stop_periods=-1:stop_threshold={TRANSCODE_SILENCE_THRESHOLD}"
+            f":stop_duration={TRANSCODE_SILENCE_SECONDS}:stop_silence={TRANSCODE_SILENCE_KEEP_SECONDS}"
+        )]
+    command += ["-c:a", TRANSCODE_CODEC]
+    if TRANSCODE_CODEC not in _LOSSLESS_CODECS:
+        command += ["-b:a", TRANSCODE_BITRATE]
+    command.append(partial_path)
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    try:
+        while True:
+            try:
+                _, stderr_output = process.communicate(timeout=CANCEL_CHECK_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                check_cancelled()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg transcode failed (exit {process.returncode}): {stderr_output.strip()[:1000]}")
+    except BaseException:
+        if process.poll() is None:
+            # Cancelled while ffmpeg was still encoding
+            logging.info(f"Stopping ffmpeg transcode of {input_file_path}.")
+            process.kill()
+            process.communicate()
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, output_file_path)
+    return output_file_path
+
+
+def stream_split_audio(input_file_path: str, output_dir_path: str,
+                       segment_seconds: int = SEGMENT_SECONDS, copy_codec: bool = False) -> Iterator[str]:
+    """
+    Yield segment paths (in order) as ffmpeg finishes writing each one.
+
+    Segments are re-encoded to mono MP3 unless `copy_codec` is set, which cuts the input
+    (e.g. the output of transcode_audio, already compact) without decoding it.
+    ffmpeg reports every closed segment on its segment list, which is pointed at stdout,
+    so a segment is only yielded once it is complete on disk.
+    """
+    os.makedirs(output_dir_path, exist_ok=True)
+    if copy_codec:
+        codec_options = ["-c:a", "copy"]
+        extension = os.path.splitext(input_file_path)[1] or ".mp3"
+    else:
+        codec_options = ["-ac", "1", "-c:a", "libmp3lame", "-b:a", SEGMENT_BITRATE]
+        extension = ".mp3"
+    command = [
+        FFMPEG_BINARY, "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+        "-i", input_file_path,
+        "-vn", *codec_options,
+        "-f", "segment", "-segment_time", str(segment_seconds), "-reset_timestamps", "1",
+        "-segment_list", "pipe:1", "-segment_list_type", "flat",
+        os.path.join(output_dir_path, f"segment_%05d{extension}"),
+    ]
+    # stderr goes to a file: a pipe only read after stdout ends would block ffmpeg once it filled up
+    stderr_file = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+    except BaseException:
+        stderr_file.close()
+        raise
+    try:
+        for line in process.stdout:
+            segment_name = line.strip()
+            if segment_name:
+                yield os.path.join(output_dir_path, os.path.basename(segment_name))
+        if process.wait() != 0:
+            stderr_file.seek(0)
+            stderr_output = stderr_file.read().decode(errors="replace")
+            raise RuntimeError(f"ffmpeg segmentation failed (exit {process.returncode}): {stderr_output.strip()[:1000]}")
+    finally:
+        if process.poll() is None:
+            # Consumer stopped early (e.g. the task failed); don't leave ffmpeg running
+            logging.info(f"Stopping ffmpeg segmentation of {input_file_path}.")
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        stderr_file.close()
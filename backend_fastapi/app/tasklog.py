@@ -0,0 +1,199 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+
+from .db import Task, session_scope
+
+# --- Logging Configuration ---
+LOG_FILE = os.environ.get("LOG_FILE", "transcribe.log")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "json": one JSON object per line; "text": the previous human-readable format
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+# Records buffered per task before an early write to Task.log (normally written when a stage ends)
+TASK_LOG_BATCH_RECORDS = int(os.environ.get("TASK_LOG_BATCH_RECORDS", "500"))
+# Task.log stops growing past this size; the full history stays in LOG_FILE
+TASK_LOG_MAX_CHARS = int(os.environ.get("TASK_LOG_MAX_CHARS", str(1024 * 1024)))
+
+_task_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("task_id", default=None)
+_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("stage", default=None)
+
+_listener: Optional["_TaskLogListener"] = None
+
+
+class TaskContextFilter(logging.Filter):
+    """Tags records with the task and stage of the code that logged them (runs on the calling thread)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.task_id = getattr(record, "task_id", None) or _task_id.get()
+        record.stage = getattr(record, "stage", None) or _stage.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "task_id": getattr(record, "task_id", None),
+            "stage": getattr(record, "stage", None),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TaskLogCapture(logging.Handler):
+    """
+    Collects the records of each task and appends them to Task.log in batches.
+
+    Runs on the listener thread only, so the buffers need no lock and the DB writes never
+    happen on a request or pipeline thread.
+    """
+
+    def __init__(self, batch_records: int = TASK_LOG_BATCH_RECORDS, max_chars: int = TASK_LOG_MAX_CHARS):
+        super().__init__()
+        self._batch_records = batch_records
+        self._max_chars = max_chars
+        self._buffers: Dict[str, List[str]] = {}
+        self._written: Dict[str, int] = {}
+
+    def emit(self, record: logging.LogRecord):
+        task_id = getattr(record, "task_id", None)
+        if not task_id:
+            return
+        buffer = self._buffers.setdefault(task_id, [])
+        buffer.append(self.format(record))
+        if len(buffer) >= self._batch_records:
+            self.flush_task(task_id)
+
+    def flush_task(self, task_id: str):
+        lines = self._buffers.pop(task_id, None)
+        if not lines:
+            return
+        written = self._written.get(task_id, 0)
+        if written >= self._max_chars:
+            return
+        chunk = "\n".join(lines) + "\n"
+        if written + len(chunk) > self._max_chars:
+            chunk = chunk[:self._max_chars - written] + "\n[... truncated, see the log file ...]\n"
+        try:
+            with session_scope() as db:
+                # Bulk UPDATE with SQL concatenation: no read of the existing log, and it doesn't
+                # move the task change feed (log lines are not a status change)
+                db.query(Task).filter(Task.task_id == task_id).update(
+                    {Task.log: func.coalesce(Task.log, "") + chunk}, synchronize_session=False
+                )
+            self._written[task_id] = written + len(chunk)
+        except Exception:
+            self.handleError(logging.makeLogRecord({"msg": f"Failed to write log of task {task_id}"}))
+
+    def flush(self):
+        for task_id in list(self._buffers):
+            self.flush_task(task_id)
+
+
+class _FlushRequest:
+    """Queued behind a task's records, so they are all captured before Task.log is written."""
+
+    def __init__(self, task_id: str, forget: bool = False):
+        self.task_id = task_id
+        self.forget = forget
+
+
+class _TaskLogListener(logging.handlers.QueueListener):
+    def __init__(self, log_queue: queue.Queue, capture: TaskLogCapture, *handlers: logging.Handler):
+        super().__init__(log_queue, capture, *handlers, respect_handler_level=True)
+        self.capture = capture
+
+    def handle(self, record):
+        if isinstance(record, _FlushRequest):
+            self.capture.flush_task(record.task_id)
+            if record.forget:
+                self.capture._written.pop(record.task_id, None)
+            return
+        super().handle(record)
+
+    def stop(self):
+        super().stop()
+        self.capture.flush()
+
+
+def configure_logging():
+    """
+    Route all logging through a queue: callers only enqueue the record, and a listener
+    thread writes the rotating log file and the per-task capture into Task.log.
+    """
+    global _listener
+    if _listener is not None:
+        return
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    file_handler.setFormatter(formatter)
+    capture = TaskLogCapture()
+    capture.setFormatter(JsonFormatter())
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TaskContextFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+
+    _listener = _TaskLogListener(log_queue, capture, file_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def _request_flush(task_id: str, forget: bool = False):
+    if _listener is not None:
+        _listener.queue.put_nowait(_FlushRequest(task_id, forget))
+
+
+@contextmanager
+def task_log_context(task_id: str):
+    """Tag everything logged inside (also by stage threads started from here) with `task_id`."""
+    token = _task_id.set(task_id)
+    try:
+        yield
+    finally:
+        _task_id.reset(token)
+        _request_flush(task_id, forget=True)
+
+
+@contextmanager
+def stage_log_context(stage: str):
+    """Tag records with `stage`; the task's captured records are written to Task.log when it ends."""
+    token = _stage.set(stage)
+    try:
+        yield
+    finally:
+        _stage.reset(token)
+        task_id = _task_id.get()
+        if task_id:
+            _request_flush(task_id)
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """executor.submit() that keeps the caller's task/stage tags in the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
@@ -0,0 +1,148 @@
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+from . import cancellation
+from .cancellation import TaskCancelled, check_cancelled
+from .ratelimit import ApiRateLimiter, transcription_rate_limiter
+from .tasklog import submit_with_context
+
+# Segments of one task transcribed in parallel
+TRANSCRIBE_SEGMENT_WORKERS = int(os.environ.get("TRANSCRIBE_SEGMENT_WORKERS", "4"))
+# Cap on in-flight transcription calls across all tasks in this process
+TRANSCRIBE_MAX_CONCURRENT_CALLS = int(os.environ.get("TRANSCRIBE_MAX_CONCURRENT_CALLS", "8"))
+TRANSCRIBE_SEGMENT_RETRIES = int(os.environ.get("TRANSCRIBE_SEGMENT_RETRIES", "3"))
+TRANSCRIBE_RETRY_BASE_DELAY = float(os.environ.get("TRANSCRIBE_RETRY_BASE_DELAY", "2"))
+
+_inflight_calls = threading.BoundedSemaphore(max(1, TRANSCRIBE_MAX_CONCURRENT_CALLS))
+
+
+def transcribe_segment(
+    segment_path: str,
+    transcripts_dir: str,
+    model_name: str,
+    transcribe_directory: Callable[..., dict],
+) -> List[str]:
+    """
+    Transcribe a single audio segment and return the transcript file(s) it produced.
+
+    audio2memo only exposes a directory-level entry point, so the segment is linked into
+    a private staging directory and the outputs are moved into `transcripts_dir` afterwards.
+    """
+    # Stage next to (not inside) transcripts_dir so later stages never see half-finished files
+    staging_root = tempfile.mkdtemp(prefix=".segment_", dir=os.path.dirname(os.path.abspath(transcripts_dir)))
+    try:
+        staging_audio_dir = os.path.join(staging_root, "audio")
+        staging_output_dir = os.path.join(staging_root, "transcripts")
+        os.makedirs(staging_audio_dir)
+        os.makedirs(staging_output_dir)
+
+        staged_segment = os.path.join(staging_audio_dir, os.path.basename(segment_path))
+        try:
+            os.link(segment_path, staged_segment)
+        except OSError:
+            shutil.copy2(segment_path, staged_segment)
+
+        summary = transcribe_directory(
+            input_audio_segments_dir=staging_audio_dir,
+            output_transcripts_dir=staging_output_dir,
+            model_name=model_name,
+        )
+        check_cancelled() # Don't move results of an abandoned call into a task being cleaned up
+        if not summary or summary.get("successful_count", 0) == 0:
+            raise ValueError(f"Transcription of segment '{os.path.basename(segment_path)}' failed. Summary: {summary}")
+
+        transcript_paths = []
+        for name in sorted(os.listdir(staging_output_dir)):
+            target = os.path.join(transcripts_dir, name)
+            os.replace(os.path.join(staging_output_dir, name), target)
+            transcript_paths.append(target)
+        if not transcript_paths:
+            raise ValueError(f"Transcription of segment '{os.path.basename(segment_path)}' produced no output.")
+        return transcript_paths
+    finally:
+        shutil.rmtree(staging_root, ignore_errors=True)
+
+
+def transcribe_segments(
+    segment_paths: Iterable[str],
+    transcripts_dir: str,
+    model_name: str,
+    transcribe_directory: Callable[..., dict],
+    on_segment_done: Optional[Callable[[str, str, List[str], Optional[str], int], None]] = None,
+    max_workers: int = TRANSCRIBE_SEGMENT_WORKERS,
+    max_attempts: int = TRANSCRIBE_SEGMENT_RETRIES,
+    rate_limiter: ApiRateLimiter = transcription_rate_limiter,
+) -> Dict[str, Optional[List[str]]]:
+    """
+    Transcribe segments on a bounded thread pool, retrying each failed segment with backoff.
+
+    `segment_paths` may be a generator: each segment is submitted as soon as it is yielded,
+    so transcription overlaps with splitting. Every call first passes the shared rate limiter
+    (one request plus the segment's bytes) and the process-wide in-flight cap.
+    `on_segment_done(segment_path, status, transcripts, error, attempts)` is called once per
+    segment, in segment order regardless of completion order. Returns segment_path ->
+    transcript paths, or None for segments that failed every attempt. A cancelled task
+    raises TaskCancelled without waiting for the calls still in flight.
+    """
+    next_to_report = [0]
+    finished: Dict[int, tuple] = {}
+    report_lock = threading.Lock()
+
+    def report(index: int, outcome: tuple):
+        # Hold back outcomes until all earlier segments are reported
+        with report_lock:
+            finished[index] = outcome
+            while next_to_report[0] in finished:
+                ready = finished.pop(next_to_report[0])
+                if on_segment_done:
+                    on_segment_done(*ready)
+                next_to_report[0] += 1
+
+    def run_one(index: int, segment_path: str) -> Optional[List[str]]:
+        segment_name = os.path.basename(segment_path)
+        payload_bytes = os.path.getsize(segment_path)
+        last_error = None
+        for attempt in range(1, max(1, max_attempts) + 1):
+            check_cancelled()
+            try:
+                rate_limiter.acquire(model_name, payload_bytes)
+                with _inflight_calls:
+                    check_cancelled() # May have waited a while for the slot
+                    transcript_paths = transcribe_segment(segment_path, transcripts_dir, model_name, transcribe_directory)
+                report(index, (segment_path, "completed", transcript_paths, None, attempt))
+                return transcript_paths
+            except TaskCancelled:
+                raise
+            except Exception as e:
+                last_error = e
+                if attempt < max_attempts:
+                    # Exponential backoff with jitter so retries of many segments don't arrive together
+                    delay = TRANSCRIBE_RETRY_BASE_DELAY * (2 ** (attempt - 1)) * (0.5 + random.random())
+                    logging.warning(f"Segment {segment_name}: Attempt {attempt} failed ({e}); retrying in {delay:.1f}s.")
+                    cancellation.sleep(delay)
+        logging.error(f"Segment {segment_name}: Failed after {max_attempts} attempt(s): {last_error}")
+        report(index, (segment_path, "failed", [], str(last_error)[:500], max_attempts))
+        return None
+
+    results: Dict[str, Optional[List[str]]] = {}
+    futures = []
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="transcribe")
+    cancelled = False
+    try:
+        for index, segment_path in enumerate(segment_paths):
+            check_cancelled()
+            futures.append((segment_path, submit_with_context(executor, run_one, index, segment_path)))
+        for segment_path, future in futures:
+            results[segment_path] = cancellation.wait_for(future)
+    except TaskCancelled as e:
+        cancelled = True
+        raise TaskCancelled(str(e), pending=[future for _, future in futures if not future.done()]) from None
+    finally:
+        executor.shutdown(wait=not cancelled, cancel_futures=cancelled)
+    return results
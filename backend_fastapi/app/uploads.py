@@ -0,0 +1,311 @@
+import hashlib
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterator, BinaryIO, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import or_
+from starlette.concurrency import run_in_threadpool
+
+from .db import SessionLocal, UploadSession
+
+# Largest accepted recording; enforced from Content-Length before the body is read when possible
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(2 * 1024 ** 3)))
+# Uploads are written (and hashed) in chunks of this size, which bounds memory per upload
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+# Room for multipart boundaries and form fields on top of the file itself
+MULTIPART_OVERHEAD_BYTES = 1024 * 1024
+
+# A chunk request holds its session through the database (append_token) and renews the claim
+# while it writes; a claim not renewed for this long belongs to a request that died
+UPLOAD_APPEND_TIMEOUT_SECONDS = float(os.environ.get("UPLOAD_APPEND_TIMEOUT_SECONDS", "60"))
+
+# Running hashes of open upload sessions with the byte count they consumed, so resumed chunks
+# continue the same digest. Only kept for offsets this process recorded; when the session's
+# offset differs (restart, another worker or node appended) the received prefix is re-hashed.
+_session_hashers: Dict[str, Tuple["hashlib._Hash", int]] = {}
+
+class UploadSizeLimitMiddleware:
+    """
+    Rejects oversized request bodies on upload routes: immediately from Content-Length,
+    or with 413 as soon as a chunked body passes the limit, before it is spooled to disk.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES, path_prefixes=("/api/transcribe", "/api/uploads")):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_prefixes = path_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefixes):
+            return await self.app(scope, receive, send)
+
+        limit = self.max_bytes + MULTIPART_OVERHEAD_BYTES
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            await self._reject(send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=f"Upload exceeds the limit of {self.max_bytes} bytes.")
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def _reject(self, send):
+        body = f'{{"detail":"Upload exceeds the limit of {self.max_bytes} bytes."}}'.encode()
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def copy_and_hash(source: BinaryIO, target_path: str, max_bytes: int) -> Tuple[int, str]:
+    hasher = hashlib.sha256()
+    size = 0
+    with open(target_path, "wb") as target:
+        for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds the limit of {max_bytes} bytes.")
+            hasher.update(chunk)
+            target.write(chunk)
+    return size, hasher.hexdigest()
+
+
+async def save_upload_file(source: BinaryIO, target_path: str, max_bytes: int = MAX_UPLOAD_BYTES) -> Tuple[int, str]:
+    """Copy an uploaded file to target_path in chunks on a worker thread; returns (size, sha256)."""
+    return await run_in_threadpool(copy_and_hash, source, target_path, max_bytes)
+
+
+# --- Resumable upload sessions ---
+def uploads_dir(audio_target_dir: str) -> str:
+    return os.path.join(audio_target_dir, "_uploads")
+
+
+def _session_to_dict(session: UploadSession) -> Dict:
+    return {
+        "upload_id": session.upload_id,
+        "file_name": session.file_name,
+        "total_size": session.total_size,
+        "offset": session.received_bytes,
+        "status": session.status,
+        "sha256": session.sha256,
+        "part_path": session.part_path,
+    }
+
+
+def create_upload_session(audio_target_dir: str, file_name: str, total_size: Optional[int]) -> Dict:
+    if total_size is not None and total_size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds the limit of {MAX_UPLOAD_BYTES} bytes.")
+    upload_id = str(uuid.uuid4())
+    os.makedirs(uploads_dir(audio_target_dir), exist_ok=True)
+    part_path = os.path.join(uploads_dir(audio_target_dir), f"{upload_id}.part")
+    open(part_path, "wb").close()
+    db = SessionLocal()
+    try:
+        session = UploadSession(
+            upload_id=upload_id,
+            file_name=os.path.basename(file_name),
+            total_size=total_size,
+            received_bytes=0,
+            part_path=part_path,
+            status="open",
+            created_at=datetime.now(),
+            updated_at=datetime.now(),
+        )
+        db.add(session)
+        db.commit()
+        _session_hashers[upload_id] = (hashlib.sha256(), 0)
+        logging.info(f"Upload {upload_id}: Session created for '{file_name}' ({total_size} bytes declared).")
+        return _session_to_dict(session)
+    finally:
+        db.close()
+
+
+def get_upload_session(upload_id: str) -> Dict:
+    db = SessionLocal()
+    try:
+        session = db.query(UploadSession).filter(UploadSession.upload_id == upload_id).first()
+        if not session:
+            raise HTTPException(status_code=404, detail="Upload session not found")
+        return _session_to_dict(session)
+    finally:
+        db.close()
+
+
+def _update_session(upload_id: str, *conditions, **fields) -> int:
+    """Update the session if it matches all `conditions`; returns the number of rows changed."""
+    db = SessionLocal()
+    try:
+        updated = db.query(UploadSession).filter(UploadSession.upload_id == upload_id, *conditions).update(
+            dict(fields, updated_at=datetime.now()), synchronize_session=False
+        )
+        db.commit()
+        return updated
+    finally:
+        db.close()
+
+
+def _hasher_for(upload_id: str, part_path: str, offset: int):
+    """sha256 state of the first `offset` bytes of the part file, as a copy the caller may extend."""
+    cached = _session_hashers.get(upload_id)
+    if cached is not None and cached[1] == offset:
+        return cached[0].copy()
+    # No digest for this offset here: hash the part already on disk once
+    hasher = hashlib.sha256()
+    with open(part_path, "rb") as f:
+        remaining = offset
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise HTTPException(status_code=500, detail=f"Upload {upload_id}: only {offset - remaining} of {offset} received bytes are on disk.")
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    _session_hashers[upload_id] = (hasher, offset)
+    return hasher.copy()
+
+
+def _claim_append(upload_id: str, offset: int) -> str:
+    """
+    Take the session for one chunk request. The conditional UPDATE only matches an open session
+    at `offset` that no live request holds, so appenders on any worker or node never interleave.
+    """
+    token = uuid.uuid4().hex
+    stale_before = datetime.now() - timedelta(seconds=UPLOAD_APPEND_TIMEOUT_SECONDS)
+    claimed = _update_session(
+        upload_id,
+        UploadSession.status == "open",
+        UploadSession.received_bytes == offset,
+        or_(UploadSession.append_token.is_(None), UploadSession.updated_at < stale_before),
+        append_token=token,
+    )
+    if claimed == 1:
+        return token
+    session = get_upload_session(upload_id)
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail=f"Upload is already {session['status']}.")
+    if offset != session["offset"]:
+        raise HTTPException(status_code=409, detail=f"Offset mismatch: expected {session['offset']}, got {offset}.")
+    raise HTTPException(status_code=409, detail="Another chunk for this upload is still being received.")
+
+
+async def append_to_upload_session(upload_id: str, offset: int, stream: AsyncIterator[bytes]) -> Dict:
+    """
+    Append a request body to an open session, starting at `offset` (must equal the bytes
+    already received). Whatever arrived before a disconnect is kept, so the client can ask
+    for the current offset and continue from there.
+    """
+    token = await run_in_threadpool(_claim_append, upload_id, offset)
+    written = offset
+    hasher = part_file = None
+    buffer = bytearray()
+    renewed_at = time.monotonic()
+    committed = False
+
+    def flush(data: bytes):
+        nonlocal written, renewed_at
+        if time.monotonic() - renewed_at > UPLOAD_APPEND_TIMEOUT_SECONDS / 4:
+            # Stop writing once the claim went stale and another request took the session over
+            if not _update_session(upload_id, UploadSession.append_token == token):
+                raise HTTPException(status_code=409, detail="Upload was taken over by another request; ask for the current offset.")
+            renewed_at = time.monotonic()
+        part_file.write(data)
+        hasher.update(data)
+        written += len(data)
+
+    def rewind():
+        # Drop any bytes past the confirmed offset (e.g. from a write that was never recorded)
+        part_file.truncate(offset)
+        part_file.seek(offset)
+
+    try:
+        session = await run_in_threadpool(get_upload_session, upload_id)
+        limit = session["total_size"] if session["total_size"] is not None else MAX_UPLOAD_BYTES
+        hasher = await run_in_threadpool(_hasher_for, upload_id, session["part_path"], offset)
+        part_file = await run_in_threadpool(open, session["part_path"], "r+b")
+        await run_in_threadpool(rewind)
+        received = offset
+        async for chunk in stream:
+            if received + len(chunk) > limit:
+                raise HTTPException(status_code=413, detail=f"Upload exceeds the limit of {limit} bytes.")
+            received += len(chunk)
+            buffer += chunk
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                data, buffer = bytes(buffer), bytearray()
+                await run_in_threadpool(flush, data)
+    finally:
+        try:
+            # Keep everything that arrived, even if the client went away mid-chunk
+            if buffer and part_file is not None:
+                await run_in_threadpool(flush, bytes(buffer))
+        finally:
+            if part_file is not None:
+                await run_in_threadpool(part_file.close)
+            committed = await run_in_threadpool(
+                _update_session, upload_id, UploadSession.append_token == token, received_bytes=written, append_token=None
+            ) == 1
+            if committed and hasher is not None:
+                _session_hashers[upload_id] = (hasher, written)
+    if not committed:
+        raise HTTPException(status_code=409, detail="Upload was taken over by another request; ask for the current offset.")
+
+    session["offset"] = written
+    if session["total_size"] is not None and written == session["total_size"]:
+        session = await run_in_threadpool(complete_upload_session, upload_id)
+    return session
+
+
+def complete_upload_session(upload_id: str) -> Dict:
+    session = get_upload_session(upload_id)
+    if session["status"] == "complete":
+        return session
+    if session["status"] != "open":
+        raise HTTPException(status_code=409, detail=f"Upload is already {session['status']}.")
+    if session["total_size"] is not None and session["offset"] != session["total_size"]:
+        raise HTTPException(status_code=409, detail=f"Upload incomplete: {session['offset']} of {session['total_size']} bytes received.")
+    sha256 = _hasher_for(upload_id, session["part_path"], session["offset"]).hexdigest()
+    # Only if no chunk arrived meanwhile, so the digest matches the bytes that were hashed
+    completed = _update_session(
+        upload_id,
+        UploadSession.status == "open",
+        UploadSession.received_bytes == session["offset"],
+        UploadSession.append_token.is_(None),
+        status="complete", sha256=sha256, total_size=session["offset"],
+    )
+    if completed == 0:
+        session = get_upload_session(upload_id)
+        if session["status"] == "complete":
+            return session # Completed concurrently
+        raise HTTPException(status_code=409, detail="Upload changed while it was being completed; ask for the current offset.")
+    _session_hashers.pop(upload_id, None)
+    logging.info(f"Upload {upload_id}: Complete, {session['offset']} bytes, sha256 {sha256}.")
+    return get_upload_session(upload_id)
+
+
+def claim_completed_upload(upload_id: str, target_path: str) -> Tuple[Dict, int, str]:
+    """
+    Move a completed upload to target_path (a rename, no copy). The session is marked consumed
+    first by a conditional UPDATE, so of several tasks naming the same upload only one gets it.
+    """
+    session = get_upload_session(upload_id)
+    if _update_session(upload_id, UploadSession.status == "complete", status="consumed") == 0:
+        status = get_upload_session(upload_id)["status"]
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} is not complete (status: {status}).")
+    try:
+        os.replace(session["part_path"], target_path)
+    except OSError:
+        _update_session(upload_id, status="complete")
+        raise
+    _update_session(upload_id, part_path=target_path)
+    return session, session["offset"], session["sha256"]
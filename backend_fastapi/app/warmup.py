@@ -0,0 +1,157 @@
+"""
+Pipeline components loaded after startup instead of when the app is imported.
+
+The audio2memo modules pull in pydub, openai, google-generativeai, python-docx and tiktoken;
+importing them in main.py made every restart (or `uvicorn --reload`) wait for all of that
+before even /api/tasks was served. Components are registered with a loader and loaded on
+first use (`load`), or ahead of time by the warm-up: a background thread by default, so the
+API answers at once and the scheduler starts as soon as the required components are in.
+`GET /api/ready` reports the state of every component and how long it took to load.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+# "background": serve requests right away and load components on a thread
+# "eager": load everything before the app starts serving (the previous behaviour)
+PIPELINE_WARMUP = os.environ.get("PIPELINE_WARMUP", "background").lower()
+
+
+class ComponentUnavailable(RuntimeError):
+    """A component failed to load; raised by every later `load` of it."""
+
+
+class _Component:
+    def __init__(self, name: str, loader: Callable[[], Any], required: bool):
+        self.name = name
+        self.loader = loader
+        self.required = required
+        self.state = "pending" # pending / loading / ready / failed
+        self.value: Any = None
+        self.error: Optional[str] = None
+        self.seconds: Optional[float] = None
+        self.loaded_at: Optional[datetime] = None
+        self.lock = threading.Lock()
+
+
+class PipelineComponents:
+    """
+    Named components with their loaders. Each is loaded once, by whichever comes first: the
+    warm-up or a caller of `load`, which then waits for the load in progress. Required
+    components gate the scheduler; optional ones (caches, encodings) only speed up the
+    first task and are reported by the readiness check without blocking it.
+    """
+
+    def __init__(self, mode: str = PIPELINE_WARMUP):
+        self.mode = mode
+        self._components: Dict[str, _Component] = {}
+        self._lock = threading.Lock() # Serializes on_ready against stop()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.started_at: Optional[datetime] = None
+
+    def register(self, name: str, loader: Callable[[], Any], required: bool = True):
+        self._components[name] = _Component(name, loader, required)
+
+    def load(self, name: str) -> Any:
+        component = self._components[name]
+        with component.lock:
+            if component.state == "ready":
+                return component.value
+            if component.state == "failed":
+                raise ComponentUnavailable(f"{name} failed to load: {component.error}")
+            component.state = "loading"
+            start = time.perf_counter()
+            try:
+                component.value = component.loader()
+            except Exception as e:
+                component.state = "failed"
+                component.error = f"{type(e).__name__}: {e}"[:500]
+                logging.error(f"Warm-up: Failed to load {name}: {component.error}")
+                raise ComponentUnavailable(f"{name} failed to load: {component.error}") from e
+            finally:
+                component.seconds = time.perf_counter() - start
+                component.loaded_at = datetime.now()
+            component.state = "ready"
+            logging.info(f"Warm-up: Loaded {name} in {component.seconds:.2f}s.")
+            return component.value
+
+    def failed(self, names: Optional[List[str]] = None) -> List[str]:
+        """Components (by default the required ones) that could not be loaded."""
+        candidates = [self._components[name] for name in names] if names else \
+            [c for c in self._components.values() if c.required]
+        return [c.name for c in candidates if c.state == "failed"]
+
+    def ready(self) -> bool:
+        return all(c.state == "ready" for c in self._components.values() if c.required)
+
+    # --- Warm-up ---
+    def start(self, on_ready: Callable[[bool], None]):
+        """
+        Load every component, required ones first; `on_ready(ok)` is called once those are
+        done, with ok=False when one of them failed. Blocks in "eager" mode.
+        """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self.started_at = datetime.now()
+        if self.mode == "eager":
+            self._warm_up(on_ready)
+            return
+        self._thread = threading.Thread(target=self._warm_up, args=(on_ready,), name="pipeline-warmup", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def _warm_up(self, on_ready: Callable[[bool], None]):
+        ordered = sorted(self._components.values(), key=lambda c: not c.required)
+        notified = False
+        for component in ordered:
+            if not component.required and not notified:
+                notified = True
+                self._notify(on_ready)
+            if self._stop.is_set():
+                return
+            try:
+                self.load(component.name)
+            except ComponentUnavailable:
+                pass # Recorded on the component; reported by status()
+        if not notified:
+            self._notify(on_ready)
+        total = (datetime.now() - self.started_at).total_seconds()
+        logging.info(f"Warm-up: Finished in {total:.2f}s ({len(self.failed(list(self._components)))} component(s) failed).")
+
+    def _notify(self, on_ready: Callable[[bool], None]):
+        with self._lock:
+            if self._stop.is_set(): # Shutting down: don't start anything any more
+                return
+            try:
+                on_ready(not self.failed())
+            except Exception as e:
+                logging.error(f"Warm-up: Ready callback failed: {e}", exc_info=True)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready(),
+            "mode": self.mode,
+            "started_at": self.started_at,
+            "components": [{
+                "name": c.name,
+                "required": c.required,
+                "state": c.state,
+                "seconds": round(c.seconds, 3) if c.seconds is not None else None,
+                "loaded_at": c.loaded_at,
+                "error": c.error,
+            } for c in self._components.values()],
+        }
+
+
+pipeline_components = PipelineComponents()
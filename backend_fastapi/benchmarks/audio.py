@@ -0,0 +1,40 @@
+"""Synthetic WAV recordings of a given duration, cached between runs."""
+import os
+import wave
+
+SAMPLE_RATE = 16000
+_CHUNK_FRAMES = SAMPLE_RATE * 60
+
+
+def synthetic_wav(directory: str, name: str, duration_seconds: float, index: int = 0) -> str:
+    """
+    16 kHz mono 16-bit WAV of `duration_seconds`, written once and reused. The first
+    frames encode `name` and `index`, so every file has distinct content (and hash) and
+    the content store can't deduplicate the benchmark uploads.
+    """
+    path = os.path.join(directory, f"{name}.wav")
+    total_frames = int(duration_seconds * SAMPLE_RATE)
+    if os.path.exists(path):
+        try:
+            with wave.open(path, "rb") as f:
+                if f.getnframes() == total_frames:
+                    return path
+        except (wave.Error, EOFError):
+            pass
+    os.makedirs(directory, exist_ok=True)
+    marker = f"{name}:{index}".encode()
+    marker += b"\0" * (len(marker) % 2) # Whole 16-bit frames
+    tmp_path = f"{path}.tmp"
+    with wave.open(tmp_path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        written = min(total_frames, len(marker) // 2)
+        f.writeframes(marker[:written * 2])
+        silence = b"\0\0" * _CHUNK_FRAMES
+        while written < total_frames:
+            frames = min(_CHUNK_FRAMES, total_frames - written)
+            f.writeframes(silence[:frames * 2])
+            written += frames
+    os.replace(tmp_path, path)
+    return path
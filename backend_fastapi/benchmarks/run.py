@@ -0,0 +1,347 @@
+"""
+Load and latency benchmark of the service with stubbed audio2memo, a local database and a
+local SMTP sink. No external API is called.
+
+    cd backend_fastapi
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json    # exit code 1 on regression
+
+The app runs in-process under uvicorn and is driven over real HTTP:
+  0. time to import the app, to serve requests, and until /api/ready reports the pipeline loaded
+  1. end-to-end latency of --e2e-tasks recordings (submit -> completed, server clock)
+  2. submit throughput, with /api/tasks latency sampled as the number of active tasks
+     grows (the scheduler is paused meanwhile, so tasks stay queued)
+  3. /api/transcribe latency for large uploads
+and reports the peak RSS of the process. Use --db-url for a scratch Postgres database;
+by default a SQLite file in the work directory is used.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .audio import synthetic_wav
+from .smtp_sink import SmtpSink
+from .stubs import StubConfig, install
+
+FINISHED = ("completed", "failed", "timed_out")
+# Metrics where a larger value is better; all other latency/size metrics regress upwards
+HIGHER_IS_BETTER = ("submit_throughput_rps",)
+# Reported but not compared
+INFORMATIONAL = ("emails_sent", "e2e_tasks", "e2e_failed", "submit_errors", "large_upload_mb")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workdir", help="Audio cache, task files, database and logs (default: a temp dir)")
+    parser.add_argument("--db-url", help="Scratch database, e.g. postgresql+psycopg2://... (default: SQLite in workdir)")
+    parser.add_argument("--reset-db", action="store_true", help="Drop and recreate all tables first")
+    parser.add_argument("--worker-slots", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=16, help="Parallel clients for small submits")
+    parser.add_argument("--e2e-tasks", type=int, default=20)
+    parser.add_argument("--e2e-duration", type=float, default=1800, help="Seconds of audio per end-to-end task")
+    parser.add_argument("--submit-count", type=int, default=200)
+    parser.add_argument("--submit-duration", type=float, default=60)
+    parser.add_argument("--list-step", type=int, default=50, help="Sample /api/tasks after every this many submits")
+    parser.add_argument("--list-samples", type=int, default=20)
+    parser.add_argument("--large-count", type=int, default=6)
+    parser.add_argument("--large-duration", type=float, default=3600)
+    parser.add_argument("--large-concurrency", type=int, default=2)
+    parser.add_argument("--split-seconds-per-hour", type=float, default=0.5)
+    parser.add_argument("--transcribe-seconds", type=float, default=0.2)
+    parser.add_argument("--llm-seconds", type=float, default=0.3)
+    parser.add_argument("--docx-seconds", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=900, help="Give up waiting for tasks after this many seconds")
+    parser.add_argument("--save-baseline", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+# --- Statistics ---
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# --- Setup ---
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def configure_environment(args, workdir: str, smtp_port: int):
+    """Must run before the app is imported: the modules read their settings at import time."""
+    # Fresh task files and (unless a database is given) a fresh SQLite file; the audio cache is kept
+    tasks_dir = os.path.join(workdir, "tasks")
+    shutil.rmtree(tasks_dir, ignore_errors=True)
+    os.makedirs(tasks_dir)
+    if not args.db_url and os.path.exists(os.path.join(workdir, "bench.db")):
+        os.remove(os.path.join(workdir, "bench.db"))
+    os.environ.update({
+        "AUDIO_TARGET_DIR": tasks_dir,
+        "AUDIO_TASKS_DB_URL": args.db_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "LOG_FILE": os.path.join(workdir, "bench.log"),
+        "MAIL_SMTP_SERVER": "127.0.0.1",
+        "MAIL_SMTP_PORT": str(smtp_port),
+        "MAIL_USERNAME": "bench@localhost",
+        "MAIL_PASSWORD": "",
+        "MAIL_SMTP_STARTTLS": "false",
+        "SCHEDULER_WORKER_SLOTS": str(args.worker_slots),
+        "PIPELINE_STREAMING_SPLIT": "false", # The stub replaces process_audio.split_audio, not ffmpeg
+        "PIPELINE_TRANSCODE": "false",
+    })
+    # Tunables the caller may still override from the environment
+    for name, value in {
+        "SCHEDULER_POLL_INTERVAL": "0.5",
+        "MAIL_POLL_INTERVAL": "1",
+        "TRANSCRIBE_RETRY_BASE_DELAY": "0.1",
+        "LIFECYCLE_ENABLED": "false",
+        "STORAGE_MIN_FREE_BYTES": "0",
+        "LOG_LEVEL": "WARNING",
+    }.items():
+        os.environ.setdefault(name, value)
+
+
+def prepare_database(reset: bool):
+    from app import db
+    if reset:
+        db.Base.metadata.drop_all(bind=db.engine)
+    db.Base.metadata.create_all(bind=db.engine)
+    with db.session_scope() as session:
+        leftover = session.query(db.Task).filter(db.Task.status.in_(db.ACTIVE_STATUSES)).count()
+    if leftover:
+        raise SystemExit(f"The database already holds {leftover} unfinished task(s); use a scratch database or --reset-db.")
+
+
+def start_server(app, port: int):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, name="uvicorn", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise SystemExit("The app did not start; see the log file in the work directory.")
+        time.sleep(0.05)
+    return server, thread
+
+
+# --- Client helpers ---
+def submit(client, path: str, email: str = "bench@localhost") -> Tuple[float, Optional[str], int]:
+    with open(path, "rb") as f:
+        start = time.perf_counter()
+        response = client.post("/api/transcribe", files={"file": (os.path.basename(path), f, "audio/wav")},
+                               data={"to_email": email})
+        elapsed = time.perf_counter() - start
+    task_id = response.json().get("task_id") if response.status_code == 200 else None
+    return elapsed, task_id, response.status_code
+
+
+def wait_ready(client, timeout: float):
+    deadline = time.monotonic() + timeout
+    while client.get("/api/ready").status_code != 200:
+        if time.monotonic() > deadline:
+            raise SystemExit("The pipeline did not become ready; see /api/ready and the log file.")
+        time.sleep(0.05)
+
+
+def submit_all(client, paths: List[str], concurrency: int):
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        return list(executor.map(lambda path: submit(client, path), paths))
+
+
+def wait_finished(client, task_ids: List[str], timeout: float) -> Dict[str, dict]:
+    pending, finished = set(task_ids), {}
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        for task_id in list(pending):
+            status = client.get(f"/api/task_status/{task_id}").json()
+            if status["status"] in FINISHED:
+                finished[task_id] = status
+                pending.discard(task_id)
+        time.sleep(0.2)
+    if pending:
+        print(f"warning: {len(pending)} task(s) still unfinished after {timeout:.0f}s", file=sys.stderr)
+    return finished
+
+
+def sample_task_list(client, samples: int) -> Tuple[List[float], int]:
+    latencies, active = [], 0
+    for _ in range(samples):
+        start = time.perf_counter()
+        response = client.get("/api/tasks")
+        latencies.append(time.perf_counter() - start)
+        active = len(response.json()["tasks"])
+    return latencies, active
+
+
+# --- Scenarios ---
+def run_end_to_end(client, args, audio_dir: str, smtp: SmtpSink, results: Dict):
+    paths = [synthetic_wav(audio_dir, f"e2e_{i:04d}_{int(args.e2e_duration)}s", args.e2e_duration, i)
+             for i in range(args.e2e_tasks)]
+    task_ids = [task_id for _, task_id, _ in submit_all(client, paths, args.concurrency) if task_id]
+    finished = wait_finished(client, task_ids, args.timeout)
+    latencies = [s["processing_time"] for s in finished.values() if s["status"] == "completed" and s["processing_time"]]
+    results["e2e_tasks"] = len(task_ids)
+    results["e2e_failed"] = len(task_ids) - len(latencies)
+    results["e2e_p50_s"] = round(percentile(latencies, 50), 3) if latencies else None
+    results["e2e_p99_s"] = round(percentile(latencies, 99), 3) if latencies else None
+    time.sleep(2) # Let the outbox deliver the last notifications
+    results["emails_sent"] = smtp.messages
+
+
+def run_submit_and_list(client, args, audio_dir: str, results: Dict):
+    paths = [synthetic_wav(audio_dir, f"submit_{i:04d}_{int(args.submit_duration)}s", args.submit_duration, i)
+             for i in range(args.submit_count)]
+    latencies, submit_seconds, errors = [], 0.0, 0
+    for offset in range(0, len(paths), max(1, args.list_step)):
+        batch = paths[offset:offset + args.list_step]
+        start = time.perf_counter()
+        outcomes = submit_all(client, batch, args.concurrency)
+        submit_seconds += time.perf_counter() - start
+        latencies += [elapsed for elapsed, task_id, _ in outcomes if task_id]
+        errors += sum(1 for _, task_id, _ in outcomes if not task_id)
+        list_latencies, active = sample_task_list(client, args.list_samples)
+        results[f"tasks_list_p50_ms@{active}"] = _ms(percentile(list_latencies, 50))
+        results[f"tasks_list_p99_ms@{active}"] = _ms(percentile(list_latencies, 99))
+    results["submit_errors"] = errors
+    results["submit_throughput_rps"] = round(len(latencies) / submit_seconds, 2) if submit_seconds else None
+    results["submit_p50_ms"] = _ms(percentile(latencies, 50))
+    results["submit_p99_ms"] = _ms(percentile(latencies, 99))
+
+
+def run_large_uploads(client, args, audio_dir: str, results: Dict):
+    paths = [synthetic_wav(audio_dir, f"large_{i:04d}_{int(args.large_duration)}s", args.large_duration, i)
+             for i in range(args.large_count)]
+    outcomes = submit_all(client, paths, args.large_concurrency)
+    latencies = [elapsed for elapsed, task_id, _ in outcomes if task_id]
+    results["large_upload_mb"] = round(os.path.getsize(paths[0]) / 1024 ** 2, 1) if paths else None
+    results["large_upload_p50_ms"] = _ms(percentile(latencies, 50))
+    results["large_upload_p99_ms"] = _ms(percentile(latencies, 99))
+
+
+# --- Baseline ---
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    regressions = []
+    print(f"\n{'metric':<32}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if name in INFORMATIONAL or not isinstance(current, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if name in HIGHER_IS_BETTER else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        print(f"{name:<32}{previous:>14}{current:>14}{change:>+10.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="audio2memo-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    audio_dir = os.path.join(workdir, "audio")
+
+    smtp = SmtpSink().start()
+    configure_environment(args, workdir, smtp.port)
+    install(StubConfig(
+        split_seconds_per_hour=args.split_seconds_per_hour, transcribe_seconds=args.transcribe_seconds,
+        llm_seconds=args.llm_seconds, docx_seconds=args.docx_seconds, failure_rate=args.failure_rate, seed=args.seed,
+    ))
+    prepare_database(args.reset_db)
+    import httpx
+    results: Dict = {}
+    start = time.perf_counter()
+    from app import main as app_main
+    results["import_ms"] = _ms(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    server, thread = start_server(app_main.app, _free_port())
+    results["startup_ms"] = _ms(time.perf_counter() - start)
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{server.config.port}", timeout=args.timeout) as client:
+            # Requests are served before the pipeline is loaded; measure both
+            wait_ready(client, args.timeout)
+            results["ready_ms"] = _ms(time.perf_counter() - start)
+            print(f"End-to-end: {args.e2e_tasks} task(s) of {args.e2e_duration:.0f}s audio...")
+            run_end_to_end(client, args, audio_dir, smtp, results)
+            # Keep later uploads queued: only the API is measured from here on
+            app_main.scheduler.stop()
+            print(f"Submit throughput and /api/tasks latency: {args.submit_count} upload(s)...")
+            run_submit_and_list(client, args, audio_dir, results)
+            print(f"Large uploads: {args.large_count} x {args.large_duration:.0f}s...")
+            run_large_uploads(client, args, audio_dir, results)
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+        smtp.stop()
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": os.environ["AUDIO_TASKS_DB_URL"].split(":", 1)[0],
+            "args": {k: v for k, v in vars(args).items() if k not in ("save_baseline", "compare", "workdir", "tolerance")},
+        },
+        "results": results,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("args") != report["meta"]["args"]:
+            print("warning: the baseline was recorded with different arguments", file=sys.stderr)
+        regressions = compare(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Minimal local SMTP server that accepts and counts every message (no TLS, no auth).
+
+For tests it can also keep the received messages (dot-unstuffed, as the client meant them),
+answer the next messages with an error reply or by dropping the connection (`fail_next`),
+and drop every open session at once (`disconnect_all`), like a server closing idle clients.
+"""
+import socket
+import socketserver
+import threading
+from typing import List, Optional
+
+# Pass to fail_next(): close the connection after receiving the message instead of replying
+DROP = None
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line: str):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.server.opened(self.request)
+        try:
+            self._session()
+        finally:
+            self.server.closed(self.request)
+
+    def _session(self):
+        self._reply("220 bench-sink ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+            if command.startswith(("EHLO", "HELO")):
+                self.wfile.write(b"250-bench-sink\r\n250-8BITMIME\r\n250 SIZE 0\r\n")
+            elif command == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                for data_line in iter(self.rfile.readline, b""):
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                reply = self.server.record(b"".join(lines))
+                if reply is DROP:
+                    return
+                self._reply(reply)
+            elif command == "QUIT":
+                self._reply("221 Bye")
+                return
+            else: # MAIL, RCPT, RSET, NOOP
+                self._reply("250 OK")
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, keep_messages: bool = False):
+        super().__init__((host, port), _SmtpHandler)
+        self._lock = threading.Lock()
+        self.keep_messages = keep_messages
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0 # Sessions opened so far
+        self.received: List[bytes] = [] # Accepted messages, with keep_messages
+        self._failures: List[Optional[str]] = []
+        self._open_sockets = set()
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def fail_next(self, *replies: Optional[str]):
+        """Answer the next messages with these replies (e.g. "451 Try again later") or DROP."""
+        with self._lock:
+            self._failures.extend(replies)
+
+    def record(self, data: bytes) -> Optional[str]:
+        with self._lock:
+            if self._failures:
+                return self._failures.pop(0)
+            self.messages += 1
+            self.bytes += len(data)
+            if self.keep_messages:
+                self.received.append(data)
+            return "250 OK: queued"
+
+    def opened(self, sock: socket.socket):
+        with self._lock:
+            self.connections += 1
+            self._open_sockets.add(sock)
+
+    def closed(self, sock: socket.socket):
+        with self._lock:
+            self._open_sockets.discard(sock)
+
+    def disconnect_all(self):
+        with self._lock:
+            sockets = list(self._open_sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start(self) -> "SmtpSink":
+        self._thread = threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,137 @@
+"""
+Deterministic stand-ins for the audio2memo modules.
+
+`install()` registers fake `app.audio2memo.*` modules before `app.main` is imported, so
+the service runs its real scheduler, pipeline, database and mail code while the audio
+and LLM work is replaced by sleeps. Whether a call fails is derived from the seed and the
+content it processes (never from timing), so a run with the same inputs fails the same
+calls every time.
+"""
+import hashlib
+import os
+import sys
+import time
+import types
+import wave
+from dataclasses import dataclass
+from typing import List
+
+SEGMENT_SECONDS = 600
+
+
+@dataclass
+class StubConfig:
+    split_seconds_per_hour: float = 0.5     # Split latency per hour of audio
+    transcribe_seconds: float = 0.2         # Per segment
+    llm_seconds: float = 0.3                # Per word-for-word / memo call
+    docx_seconds: float = 0.05
+    failure_rate: float = 0.0               # Probability that a transcription or LLM call fails
+    segment_bytes_per_second: int = 8000    # Size of the fake segments (64 kbit/s)
+    seed: int = 0
+
+
+def _fails(config: StubConfig, call: str, key: bytes) -> bool:
+    if config.failure_rate <= 0:
+        return False
+    digest = hashlib.sha256(f"{config.seed}:{call}:".encode() + key).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 < config.failure_rate
+
+
+def audio_duration(path: str) -> float:
+    """Duration of a WAV file; other files are assumed to be 16 kHz mono 16-bit PCM."""
+    try:
+        with wave.open(path, "rb") as f:
+            return f.getnframes() / float(f.getframerate())
+    except (wave.Error, EOFError):
+        return os.path.getsize(path) / 32000.0
+
+
+def _dir_key(path: str) -> bytes:
+    # Content of the input files, so the outcome doesn't depend on (random) task directories
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(path)):
+        with open(os.path.join(path, name), "rb") as f:
+            digest.update(f.read(4096))
+    return digest.digest()
+
+
+def _module(name: str, **functions) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(functions)
+    return module
+
+
+def install(config: StubConfig) -> StubConfig:
+    """Register the fake modules; call before importing app.main."""
+
+    def split_audio(input_file_path: str, output_dir_path: str) -> List[str]:
+        duration = audio_duration(input_file_path)
+        time.sleep(config.split_seconds_per_hour * duration / 3600.0)
+        os.makedirs(output_dir_path, exist_ok=True)
+        with open(input_file_path, "rb") as f:
+            source_key = hashlib.sha256(f.read(65536)).hexdigest()[:16]
+        segment_paths = []
+        for index in range(max(1, int(-(-duration // SEGMENT_SECONDS)))):
+            seconds = min(SEGMENT_SECONDS, duration - index * SEGMENT_SECONDS) if duration else 1
+            path = os.path.join(output_dir_path, f"segment_{index:05d}.mp3")
+            header = f"{source_key}:{index}\n".encode()
+            with open(path, "wb") as f:
+                f.write(header)
+                f.write(b"\0" * max(0, int(seconds * config.segment_bytes_per_second) - len(header)))
+            segment_paths.append(path)
+        return segment_paths
+
+    def process_directory_of_audio_files(input_audio_segments_dir: str, output_transcripts_dir: str, model_name: str):
+        os.makedirs(output_transcripts_dir, exist_ok=True)
+        successful = failed = 0
+        for name in sorted(os.listdir(input_audio_segments_dir)):
+            with open(os.path.join(input_audio_segments_dir, name), "rb") as f:
+                key = f.readline()
+            time.sleep(config.transcribe_seconds)
+            if _fails(config, "transcribe", key):
+                failed += 1
+                continue
+            with open(os.path.join(output_transcripts_dir, os.path.splitext(name)[0] + ".txt"), "w", encoding="utf-8") as f:
+                f.write(f"[{key.decode(errors='replace').strip()}] " + "转录文本 " * 200 + "\n")
+            successful += 1
+        return {"successful_count": successful, "failed_count": failed}
+
+    def llm_call(call: str):
+        def generate(input_transcript_dir_path: str, prompt_template_path: str, **outputs) -> bool:
+            time.sleep(config.llm_seconds)
+            if _fails(config, call, _dir_key(input_transcript_dir_path)):
+                return False
+            output_path = next(iter(outputs.values()))
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(f"{call} of {len(os.listdir(input_transcript_dir_path))} file(s)\n")
+            return True
+        return generate
+
+    def combine_to_docx_and_markdown(project_name: str, summary_md_path: str, wordforword_md_path: str, output_dir_docx: str):
+        time.sleep(config.docx_seconds)
+        os.makedirs(output_dir_docx, exist_ok=True)
+        docx_path = os.path.join(output_dir_docx, f"{project_name}.docx")
+        with open(docx_path, "wb") as f:
+            for path in (summary_md_path, wordforword_md_path):
+                with open(path, "rb") as source:
+                    f.write(source.read())
+        return {"docx_path": docx_path}
+
+    package = _module("app.audio2memo")
+    package.__path__ = []
+    modules = {
+        "process_audio": _module("app.audio2memo.process_audio", split_audio=split_audio),
+        "audio2text": _module("app.audio2memo.audio2text",
+                              process_directory_of_audio_files=process_directory_of_audio_files),
+        "text_to_wordforword": _module("app.audio2memo.text_to_wordforword", generate_wordforword=llm_call("wordforword")),
+        "wordforword_to_memo": _module("app.audio2memo.wordforword_to_memo",
+                                       generate_memo_from_transcripts=llm_call("memo_draft")),
+        "combine_to_docx": _module("app.audio2memo.combine_to_docx",
+                                   combine_to_docx_and_markdown=combine_to_docx_and_markdown),
+    }
+    sys.modules["app.audio2memo"] = package
+    for name, module in modules.items():
+        setattr(package, name, module)
+        sys.modules[f"app.audio2memo.{name}"] = module
+    return config
@@ -0,0 +1,86 @@
+"""
+Minimal local stand-in for the OpenAI transcription endpoint (POST /v1/audio/transcriptions).
+
+Point OPENAI_BASE_URL at it (http://127.0.0.1:<port>/v1) to exercise the transcription path
+without calling the real API. The first `rate_limited` requests are answered with 429 and a
+Retry-After header, like the real API does when a quota is exhausted; every request is
+timestamped so callers can check how requests were spaced by the limiter and the backoff.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+
+class _TranscriptionHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass # Keep test and benchmark output clean
+
+    def _reply(self, status: int, body: dict, headers: dict = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        size = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(size)
+        if not self.path.rstrip("/").endswith("/audio/transcriptions"):
+            self._reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        number, limited = self.server.record(size)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if limited:
+            self._reply(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                        {"Retry-After": str(self.server.retry_after)})
+            return
+        self._reply(200, {"text": f"stub transcript {number}"})
+
+
+class TranscriptionStub(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, rate_limited: int = 0,
+                 retry_after: float = 1, latency: float = 0.0):
+        super().__init__((host, port), _TranscriptionHandler)
+        self.rate_limited = rate_limited # Answer this many requests with 429 before serving any
+        self.retry_after = retry_after
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.requests: List[float] = [] # monotonic() of every request
+        self.rejected = 0
+        self.bytes = 0
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def record(self, size: int):
+        with self._lock:
+            self.requests.append(time.monotonic())
+            self.bytes += size
+            limited = self.rejected < self.rate_limited
+            if limited:
+                self.rejected += 1
+            return len(self.requests), limited
+
+    def start(self) -> "TranscriptionStub":
+        self._thread = threading.Thread(target=self.serve_forever, name="transcription-stub", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
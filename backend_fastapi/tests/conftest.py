@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# The app modules create their engines at import time: point them at a throwaway SQLite database
+_workdir = tempfile.mkdtemp(prefix="a2m-tests-")
+os.environ.setdefault("AUDIO_TASKS_DB_URL", f"sqlite:///{_workdir}/tasks.db")
+os.environ.setdefault("AUDIO_TARGET_DIR", _workdir)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
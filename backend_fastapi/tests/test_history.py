@@ -0,0 +1,143 @@
+"""Task history: keyset pagination and full-text search through the SQLite FTS5 stand-in."""
+import os
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import db, main, search
+from app.search import index_task_documents, matching_task_ids
+
+START = datetime(2025, 3, 1, 9, 0)
+
+
+@pytest.fixture(scope="module")
+def client():
+    db.Base.metadata.create_all(bind=db.engine)
+    return TestClient(main.app) # No lifespan: the scheduler and background threads stay off
+
+
+@pytest.fixture
+def submitter():
+    """A submitter of its own, so each test only pages through the tasks it created."""
+    return f"{uuid.uuid4().hex[:8]}@example.com"
+
+
+def add_task(submitter: str, submit_time: datetime, status: str = "completed") -> str:
+    task_id = str(uuid.uuid4())
+    with db.session_scope() as session:
+        session.add(db.Task(task_id=task_id, status=status, submit_time=submit_time, last_update_time=submit_time,
+                            to_email=submitter, file_name=f"{task_id}.mp3"))
+    return task_id
+
+
+def pages(client, **params):
+    """Every page of /api/tasks/history, following next_cursor."""
+    result, cursor = [], None
+    while True:
+        response = client.get("/api/tasks/history", params=dict(params, **({"cursor": cursor} if cursor else {})))
+        assert response.status_code == 200
+        body = response.json()
+        result.append([task["task_id"] for task in body["tasks"]])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return result
+
+
+def index(task_id: str, **documents: str):
+    paths = {}
+    directory = tempfile.mkdtemp()
+    for kind, content in documents.items():
+        path = os.path.join(directory, f"{kind}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        paths[kind] = [path]
+    with db.session_scope() as session:
+        index_task_documents(session, task_id, paths)
+
+
+def matching(q: str) -> set:
+    with db.session_scope() as session:
+        return {row[0] for row in session.execute(matching_task_ids(session, q))}
+
+
+def test_pages_cover_every_task_once_in_order(client, submitter):
+    # Several tasks share a submit_time: task_id breaks the tie
+    times = [START, START, START + timedelta(minutes=1), START + timedelta(minutes=1), START + timedelta(minutes=1),
+             START + timedelta(minutes=2), START + timedelta(minutes=3)]
+    task_ids = {add_task(submitter, submit_time): submit_time for submit_time in times}
+    expected = sorted(task_ids, key=lambda task_id: (task_ids[task_id], task_id), reverse=True)
+
+    result = pages(client, submitter=submitter, limit=2)
+    assert [len(page) for page in result] == [2, 2, 2, 1]
+    assert [task_id for page in result for task_id in page] == expected
+
+
+def test_last_full_page_has_no_cursor(client, submitter):
+    for minute in range(4):
+        add_task(submitter, START + timedelta(minutes=minute))
+    assert [len(page) for page in pages(client, submitter=submitter, limit=2)] == [2, 2]
+
+
+def test_cursor_is_stable_while_new_tasks_arrive(client, submitter):
+    old = [add_task(submitter, START + timedelta(minutes=minute)) for minute in range(4)]
+    first = client.get("/api/tasks/history", params={"submitter": submitter, "limit": 2}).json()
+    assert [task["task_id"] for task in first["tasks"]] == [old[3], old[2]]
+
+    add_task(submitter, START + timedelta(hours=1)) # Newer: belongs before the first page
+    second = client.get("/api/tasks/history", params={"submitter": submitter, "limit": 2, "cursor": first["next_cursor"]}).json()
+    assert [task["task_id"] for task in second["tasks"]] == [old[1], old[0]]
+    assert second["next_cursor"] is None
+
+
+def test_filters_apply_to_every_page(client, submitter):
+    failed = [add_task(submitter, START + timedelta(minutes=minute), status="failed") for minute in range(3)]
+    for minute in range(3):
+        add_task(submitter, START + timedelta(minutes=minute, seconds=30))
+    result = pages(client, submitter=submitter, status="failed", limit=2)
+    assert [task_id for page in result for task_id in page] == failed[::-1]
+
+
+def test_invalid_cursor_is_rejected(client):
+    assert client.get("/api/tasks/history", params={"cursor": "not-a-cursor"}).status_code == 400
+
+
+def test_full_text_search_finds_substrings(client, submitter):
+    budget = add_task(submitter, START)
+    hiring = add_task(submitter, START + timedelta(minutes=1))
+    index(budget, transcript="我们讨论了明年的预算安排和市场推广计划。", memo_draft="Budget review for 2026")
+    index(hiring, transcript="招聘计划需要在下个季度完成。", wordforword="Hiring plan, second quarter")
+
+    def found(q):
+        return {task_id for page in pages(client, submitter=submitter, q=q) for task_id in page}
+
+    assert found("预算安排") == {budget}
+    assert found("计划") == {budget, hiring} # Shorter than a trigram: substring fallback
+    assert found("review for") == {budget}
+    assert found("quarter") == {hiring}
+    assert found("不存在的内容") == set()
+
+
+def test_reindexing_replaces_the_old_text(submitter):
+    task_id = add_task(submitter, START)
+    index(task_id, transcript="first version of the transcript")
+    index(task_id, transcript="second version of the transcript")
+    assert task_id not in matching("first version")
+    assert task_id in matching("second version")
+
+
+def test_query_syntax_is_matched_literally(submitter):
+    task_id = add_task(submitter, START)
+    index(task_id, transcript='He said "ship it" AND left')
+    assert task_id in matching('"ship it" AND')
+    assert task_id not in matching("ship AND left")
+
+
+def test_long_documents_are_truncated_before_indexing(submitter, monkeypatch):
+    monkeypatch.setattr(search, "TASK_SEARCH_MAX_CHARS", 50)
+    task_id = add_task(submitter, START)
+    index(task_id, transcript="a" * 10 + " early words " + "b" * 40 + " late words")
+    assert task_id in matching("early words")
+    assert task_id not in matching("late words")
@@ -0,0 +1,151 @@
+"""Outbox delivery against the local SMTP sink: connection reuse, retries with backoff, streamed attachments."""
+import email
+import email.policy
+import os
+import tempfile
+import time
+from datetime import datetime
+
+import pytest
+
+from app import db, mailer
+from app.mailer import OutboxSender
+from benchmarks.smtp_sink import DROP, SmtpSink
+
+RETRY_DELAY = 0.2
+
+
+@pytest.fixture
+def sink(monkeypatch):
+    server = SmtpSink(keep_messages=True).start()
+    monkeypatch.setattr(mailer, "MAIL_SMTP_SERVER", "127.0.0.1")
+    monkeypatch.setattr(mailer, "MAIL_SMTP_PORT", server.port)
+    monkeypatch.setattr(mailer, "MAIL_USERNAME", "notify@example.com")
+    monkeypatch.setattr(mailer, "MAIL_PASSWORD", None)
+    monkeypatch.setattr(mailer, "MAIL_SMTP_STARTTLS", False)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def sender():
+    db.Base.metadata.create_all(bind=db.engine)
+    with db.session_scope() as session:
+        session.query(db.EmailOutbox).delete()
+    outbox = OutboxSender(retry_base_delay=RETRY_DELAY, max_attempts=3)
+    yield outbox
+    outbox._connection.close()
+
+
+def queue(subject: str = "Done", attachment_path: str = None) -> int:
+    with db.session_scope() as session:
+        message = db.EmailOutbox(
+            kind="completed", status="pending", sender="notify@example.com", to_email="user@example.com",
+            subject=subject, body_html="<p>done</p>", attachment_path=attachment_path,
+            attempts=0, next_attempt_at=datetime.now(), created_at=datetime.now(),
+        )
+        session.add(message)
+        session.flush()
+        return message.id
+
+
+def deliver_due(sender: OutboxSender) -> int:
+    """What the sender thread does for every due message, run inline."""
+    delivered = 0
+    while (message := sender._claim_next()) is not None:
+        sender.deliver(message)
+        delivered += 1
+    return delivered
+
+
+def outbox_row(message_id: int) -> db.EmailOutbox:
+    with db.session_scope() as session:
+        row = session.get(db.EmailOutbox, message_id)
+        session.expunge(row)
+        return row
+
+
+def test_one_connection_is_reused_for_consecutive_messages(sink, sender):
+    ids = [queue(f"Message {n}") for n in range(3)]
+    assert deliver_due(sender) == 3
+    assert sink.messages == 3
+    assert sink.connections == 1
+    assert [outbox_row(message_id).status for message_id in ids] == ["sent"] * 3
+
+
+def test_transient_reply_is_retried_after_backoff(sink, sender):
+    message_id = queue()
+    sink.fail_next("451 Try again later")
+    deliver_due(sender)
+    row = outbox_row(message_id)
+    assert (row.status, row.attempts) == ("pending", 1)
+    assert "451" in row.last_error
+    assert row.next_attempt_at > datetime.now()
+
+    assert deliver_due(sender) == 0 # Not due before the backoff has passed
+    time.sleep(RETRY_DELAY + 0.05)
+    deliver_due(sender)
+    row = outbox_row(message_id)
+    assert (row.status, row.attempts, row.last_error) == ("sent", 2, None)
+    # The failed DATA left the session unusable: the retry ran on a new one
+    assert sink.connections == 2
+
+
+def test_backoff_doubles_and_gives_up_after_max_attempts(sink, sender):
+    message_id = queue()
+    sink.fail_next("421 Busy", "421 Busy", "421 Busy")
+    delays = []
+    for _ in range(3):
+        deliver_due(sender)
+        row = outbox_row(message_id)
+        delays.append((row.next_attempt_at - datetime.now()).total_seconds())
+        time.sleep(max(0.0, delays[-1]) + 0.05)
+    assert outbox_row(message_id).status == "failed"
+    assert delays[1] > delays[0] * 1.5
+    assert sink.messages == 0
+
+
+def test_permanent_reply_is_not_retried(sink, sender):
+    message_id = queue()
+    sink.fail_next("550 Mailbox unavailable")
+    deliver_due(sender)
+    row = outbox_row(message_id)
+    assert (row.status, row.attempts) == ("failed", 1)
+
+
+def test_dropped_connection_is_reopened(sink, sender):
+    first, second = queue("First"), queue("Second")
+    sink.fail_next(DROP)
+    deliver_due(sender)
+    assert (outbox_row(first).status, outbox_row(second).status) == ("pending", "sent")
+    time.sleep(RETRY_DELAY + 0.05)
+    deliver_due(sender)
+    assert outbox_row(first).status == "sent"
+    assert sink.messages == 2
+
+
+def test_session_closed_by_the_server_between_messages_is_reopened(sink, sender):
+    queue("First")
+    deliver_due(sender)
+    sink.disconnect_all()
+    message_id = queue("Second")
+    deliver_due(sender)
+    assert outbox_row(message_id).status == "sent"
+    assert sink.connections == 2
+
+
+def test_streamed_attachment_arrives_intact(sink, sender):
+    content = os.urandom(5 * mailer._ATTACHMENT_CHUNK_BYTES + 123)
+    path = os.path.join(tempfile.mkdtemp(), "会议纪要.docx")
+    with open(path, "wb") as f:
+        f.write(content)
+    queue("With attachment", attachment_path=path)
+    deliver_due(sender)
+
+    received = email.message_from_bytes(sink.received[-1], policy=email.policy.default)
+    assert received["Subject"] == "With attachment"
+    (attachment,) = list(received.iter_attachments())
+    assert attachment.get_filename() == "会议纪要.docx"
+    assert attachment.get_content() == content
+    body = received.get_body(("html",))
+    assert "<p>done</p>" in body.get_content()
@@ -0,0 +1,150 @@
+"""Chunked word-for-word and memo generation driven by a deterministic local stand-in for the LLM."""
+import os
+import re
+import threading
+import time
+
+import pytest
+
+from app import mapreduce
+from app.cancellation import TaskCancelled, cancellation_scope, request_cancel
+from app.mapreduce import chunked_memo, chunked_wordforword, token_windows
+
+
+@pytest.fixture(autouse=True)
+def character_tokens(monkeypatch):
+    # One token per character, whether or not tiktoken is installed
+    monkeypatch.setattr(mapreduce, "token_encoding", lambda: None)
+    monkeypatch.setattr(mapreduce, "MAPREDUCE_CHUNK_TOKENS", 40)
+    monkeypatch.setattr(mapreduce, "MAPREDUCE_REDUCE_TOKENS", 40)
+    monkeypatch.setattr(mapreduce, "MAPREDUCE_WORKERS", 4)
+    monkeypatch.setattr(mapreduce, "MAPREDUCE_RETRY_BASE_DELAY", 0.01)
+
+
+class StubLLM:
+    """generate(input_dir, output_path) that lists the segment ids it was given, in input order."""
+
+    def __init__(self, prefix: str = "", delay=lambda name: 0.0, fail=lambda name: False):
+        self.prefix = prefix
+        self.delay = delay
+        self.fail = fail
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, input_dir: str, output_path: str) -> bool:
+        name = os.path.basename(input_dir)
+        with self._lock:
+            self.calls.append(name)
+        time.sleep(self.delay(name))
+        if self.fail(name):
+            return False
+        text = ""
+        for part in sorted(os.listdir(input_dir)):
+            with open(os.path.join(input_dir, part), encoding="utf-8") as f:
+                text += f.read()
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(self.prefix + " ".join(re.findall(r"s\d+", text)))
+        return True
+
+
+def write_transcripts(directory, count: int, words: int = 6) -> str:
+    transcripts_dir = os.path.join(directory, "transcripts")
+    os.makedirs(transcripts_dir)
+    for index in range(count):
+        with open(os.path.join(transcripts_dir, f"segment_{index:05d}.txt"), "w", encoding="utf-8") as f:
+            f.write(f"s{index:02d} " + "la " * words + "\n")
+    return transcripts_dir
+
+
+def segment_ids(count: int):
+    return [f"s{index:02d}" for index in range(count)]
+
+
+def test_windows_respect_the_budget_and_keep_order():
+    texts = [f"t{index} " * 3 for index in range(10)] # 9 characters each
+    windows = token_windows(texts, 20)
+    assert [piece for window in windows for piece in window] == texts
+    assert all(sum(len(piece) for piece in window) <= 20 for window in windows)
+    assert len(windows) == 5
+
+
+def test_oversized_texts_are_cut_or_kept_whole():
+    long_text = "line of text\n" * 10 # 130 characters
+    windows = token_windows(["head ", long_text, "tail"], 30)
+    assert "".join(piece for window in windows for piece in window) == "head " + long_text + "tail"
+    assert all(sum(len(piece) for piece in window) <= 30 for window in windows)
+    assert token_windows(["a", long_text, "b"], 30, split=False) == [["a"], [long_text], ["b"]]
+
+
+def test_wordforword_joins_windows_in_order(tmp_path):
+    transcripts_dir = write_transcripts(str(tmp_path), 12)
+    # Later windows finish first; the output must still follow the recording
+    llm = StubLLM(delay=lambda name: 0.05 * (20 - int(name.split("_")[1])) / 20)
+    os.makedirs(tmp_path / "wordforword")
+    output_path = str(tmp_path / "wordforword" / "out.txt")
+    assert chunked_wordforword(llm, transcripts_dir, output_path)
+    with open(output_path, encoding="utf-8") as f:
+        assert re.findall(r"s\d+", f.read()) == segment_ids(12)
+    assert len(llm.calls) > 1 and all(name.startswith("map_") for name in llm.calls)
+    assert sorted(os.listdir(tmp_path / "wordforword")) == ["out.txt"] # Work directory removed
+
+
+def test_memo_reduces_to_a_single_memo(tmp_path):
+    transcripts_dir = write_transcripts(str(tmp_path), 16)
+    llm = StubLLM(prefix="memo ")
+    output_path = str(tmp_path / "memo.txt")
+    assert chunked_memo(llm, transcripts_dir, output_path)
+    with open(output_path, encoding="utf-8") as f:
+        memo = f.read()
+    assert memo.startswith("memo ")
+    assert re.findall(r"s\d+", memo) == segment_ids(16)
+    assert any(name.startswith("reduce2_") for name in llm.calls) # Needed more than one level
+
+
+def test_memo_converges_when_every_partial_fills_the_budget(tmp_path, monkeypatch):
+    # Partial memos longer than the reduce budget are still combined pairwise
+    monkeypatch.setattr(mapreduce, "MAPREDUCE_REDUCE_TOKENS", 5)
+    transcripts_dir = write_transcripts(str(tmp_path), 8)
+    reduce_llm = StubLLM(prefix="merged ")
+    output_path = str(tmp_path / "memo.txt")
+    assert chunked_memo(StubLLM(prefix="partial "), transcripts_dir, output_path, reduce_generate=reduce_llm)
+    with open(output_path, encoding="utf-8") as f:
+        memo = f.read()
+    assert memo.startswith("merged ")
+    assert re.findall(r"s\d+", memo) == segment_ids(8)
+    assert reduce_llm.calls and all(name.startswith("reduce") for name in reduce_llm.calls)
+
+
+def test_first_failure_cancels_the_remaining_calls(tmp_path, monkeypatch):
+    monkeypatch.setattr(mapreduce, "MAPREDUCE_WORKERS", 1)
+    monkeypatch.setattr(mapreduce, "MAPREDUCE_CALL_RETRIES", 2)
+    transcripts_dir = write_transcripts(str(tmp_path), 12)
+    llm = StubLLM(fail=lambda name: name == "map_0000")
+    output_path = str(tmp_path / "memo.txt")
+    assert not chunked_memo(llm, transcripts_dir, output_path)
+    assert llm.calls == ["map_0000", "map_0000"] # Retried, then nothing else was started
+    assert not os.path.exists(output_path)
+    assert os.listdir(tmp_path) == ["transcripts"]
+
+
+def test_cancelled_task_stops_without_waiting_for_calls_in_flight(tmp_path):
+    transcripts_dir = write_transcripts(str(tmp_path), 12)
+    llm = StubLLM(delay=lambda name: 3.0)
+    errors = []
+
+    def run():
+        with cancellation_scope("task-1"):
+            try:
+                chunked_memo(llm, transcripts_dir, str(tmp_path / "memo.txt"))
+            except TaskCancelled as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.2)
+    start = time.monotonic()
+    assert request_cancel("task-1")
+    thread.join(timeout=2.0)
+    assert not thread.is_alive() and len(errors) == 1
+    assert time.monotonic() - start < 2.0
+    assert len(llm.calls) == mapreduce.MAPREDUCE_WORKERS # Queued windows were never started
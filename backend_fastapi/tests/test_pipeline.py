@@ -0,0 +1,50 @@
+"""Stage graph: failures wait for the running stages, cancellation does not."""
+import threading
+import time
+
+import pytest
+
+from app.cancellation import TaskCancelled, cancellation_scope, request_cancel
+from app.pipeline import Stage, StageGraph
+
+
+def failing(results):
+    raise RuntimeError("stage failed")
+
+
+def slow(seconds: float, finished: list):
+    def run(results):
+        time.sleep(seconds)
+        finished.append(seconds)
+        return seconds
+    return run
+
+
+def test_failure_is_raised_after_the_running_stages_finish():
+    finished = []
+    graph = StageGraph([Stage("fail", "failing", failing), Stage("slow", "slow", slow(0.3, finished))])
+    with pytest.raises(RuntimeError):
+        graph.run()
+    assert finished == [0.3]
+
+
+def test_cancel_while_waiting_after_a_failure_stops_at_once():
+    finished, errors = [], []
+    graph = StageGraph([Stage("fail", "failing", failing), Stage("slow", "slow", slow(3.0, finished))])
+
+    def run():
+        with cancellation_scope("task-1"):
+            try:
+                graph.run()
+            except TaskCancelled as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.2)
+    start = time.monotonic()
+    assert request_cancel("task-1")
+    thread.join(timeout=2.0)
+    assert not thread.is_alive() and len(errors) == 1
+    assert time.monotonic() - start < 2.0
+    assert finished == [] # The slow stage was abandoned, not waited for
@@ -0,0 +1,177 @@
+"""Rate limiter and retry/backoff of segment transcription against the local transcription stub."""
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from app import db, transcription
+from app.cancellation import TaskCancelled, cancellation_scope, request_cancel
+from app.ratelimit import ApiRateLimiter, DatabaseTokenBucket, TokenBucket
+from app.transcription import transcribe_segments
+from benchmarks.transcription_stub import TranscriptionStub
+
+MODEL = "stub-whisper"
+
+
+@pytest.fixture
+def stub():
+    server = TranscriptionStub().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(transcription, "TRANSCRIBE_RETRY_BASE_DELAY", 0.05)
+
+
+def stub_client(base_url: str):
+    """Directory-level entry point shaped like audio2text.process_directory_of_audio_files."""
+
+    def transcribe_directory(input_audio_segments_dir, output_transcripts_dir, model_name):
+        summary = {"successful_count": 0, "failed_count": 0}
+        for name in sorted(os.listdir(input_audio_segments_dir)):
+            with open(os.path.join(input_audio_segments_dir, name), "rb") as f:
+                request = urllib.request.Request(f"{base_url}/audio/transcriptions", data=f.read(), method="POST",
+                                                 headers={"Content-Type": "application/octet-stream"})
+            try:
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    text = response.read().decode()
+            except urllib.error.HTTPError:
+                summary["failed_count"] += 1
+                continue
+            with open(os.path.join(output_transcripts_dir, os.path.splitext(name)[0] + ".txt"), "w") as f:
+                f.write(text)
+            summary["successful_count"] += 1
+        return summary
+
+    return transcribe_directory
+
+
+def make_segments(directory, count: int, size: int = 1000):
+    audio_dir = os.path.join(directory, "audio_segments")
+    transcripts_dir = os.path.join(directory, "transcripts")
+    os.makedirs(audio_dir)
+    os.makedirs(transcripts_dir)
+    paths = []
+    for index in range(count):
+        path = os.path.join(audio_dir, f"segment_{index:05d}.mp3")
+        with open(path, "wb") as f:
+            f.write(b"\0" * size)
+        paths.append(path)
+    return paths, transcripts_dir
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate_per_second=20, capacity=5)
+    taken = []
+
+    def take():
+        for _ in range(5):
+            bucket.acquire()
+            taken.append(time.monotonic())
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=take) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # A burst of 5, then 10 more at 20 per second
+    assert len(taken) == 15
+    assert time.monotonic() - start >= 0.45
+    assert not bucket.acquire(timeout=0.01)
+
+
+def test_database_buckets_share_one_quota():
+    db.Base.metadata.create_all(bind=db.engine, tables=[db.RateLimitBucket.__table__])
+    node_a = DatabaseTokenBucket("test:shared", rate_per_second=0.01, capacity=3)
+    node_b = DatabaseTokenBucket("test:shared", rate_per_second=0.01, capacity=3)
+    assert node_a.acquire() and node_b.acquire() and node_a.acquire()
+    assert not node_b.acquire(timeout=0.1)
+
+
+def test_waiting_for_a_token_ends_when_the_task_is_cancelled():
+    bucket = TokenBucket(rate_per_second=0.01, capacity=1)
+    assert bucket.acquire()
+    errors = []
+
+    def wait_for_token():
+        with cancellation_scope("task-1"):
+            try:
+                bucket.acquire()
+            except TaskCancelled as e:
+                errors.append(e)
+
+    thread = threading.Thread(target=wait_for_token, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    assert request_cancel("task-1")
+    thread.join(timeout=0.5)
+    assert not thread.is_alive() and len(errors) == 1
+
+
+def test_rate_limited_segment_is_retried_with_backoff(stub, tmp_path):
+    stub.rate_limited = 2
+    segments, transcripts_dir = make_segments(str(tmp_path), 1)
+    reported = []
+    results = transcribe_segments(
+        segments, transcripts_dir, MODEL, stub_client(stub.base_url),
+        on_segment_done=lambda path, status, transcripts, error, attempts: reported.append((status, attempts)),
+        max_attempts=3, rate_limiter=ApiRateLimiter(),
+    )
+    assert reported == [("completed", 3)]
+    assert len(results[segments[0]]) == 1
+    assert len(stub.requests) == 3
+    # Exponential backoff: at least half of 0.05s, then half of 0.1s (jitter is 0.5x-1.5x)
+    gaps = [later - earlier for earlier, later in zip(stub.requests, stub.requests[1:])]
+    assert gaps[0] >= 0.025 and gaps[1] >= 0.05
+
+
+def test_segment_failing_every_attempt_is_reported_failed(stub, tmp_path):
+    stub.rate_limited = 100
+    segments, transcripts_dir = make_segments(str(tmp_path), 2)
+    reported = []
+    results = transcribe_segments(
+        segments, transcripts_dir, MODEL, stub_client(stub.base_url),
+        on_segment_done=lambda path, status, transcripts, error, attempts: reported.append(
+            (os.path.basename(path), status, attempts)),
+        max_attempts=2, rate_limiter=ApiRateLimiter(),
+    )
+    assert results == {segments[0]: None, segments[1]: None}
+    assert reported == [("segment_00000.mp3", "failed", 2), ("segment_00001.mp3", "failed", 2)]
+    assert len(stub.requests) == 4
+
+
+def run_tasks_concurrently(stub, tmp_path, limiter, segments_per_task: int, segment_size: int):
+    tasks = []
+    for name in ("task_a", "task_b"):
+        os.makedirs(tmp_path / name)
+        tasks.append(make_segments(str(tmp_path / name), segments_per_task, size=segment_size))
+    threads = [threading.Thread(target=transcribe_segments, args=(segments, transcripts_dir, MODEL, stub_client(stub.base_url)),
+                                kwargs={"rate_limiter": limiter}) for segments, transcripts_dir in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_tasks_draw_requests_from_one_shared_bucket(stub, tmp_path):
+    limiter = ApiRateLimiter({MODEL: {"requests_per_minute": 4, "bytes_per_minute": 0}})
+    run_tasks_concurrently(stub, tmp_path, limiter, segments_per_task=2, segment_size=1000)
+    assert len(stub.requests) == 4
+    # Both tasks' requests came out of the same bucket, which is now empty
+    assert not limiter.acquire(MODEL, timeout=0.1)
+    # Another model has its own quota
+    assert limiter.acquire("other-model", timeout=0.1)
+
+
+def test_tasks_draw_bytes_from_one_shared_bucket(stub, tmp_path):
+    limiter = ApiRateLimiter({MODEL: {"requests_per_minute": 0, "bytes_per_minute": 10000}})
+    run_tasks_concurrently(stub, tmp_path, limiter, segments_per_task=2, segment_size=2000)
+    assert stub.bytes == 8000
+    assert not limiter.acquire(MODEL, payload_bytes=3000, timeout=0.1)
+    assert limiter.acquire(MODEL, payload_bytes=2000, timeout=0.1)
@@ -0,0 +1,43 @@
+"""Claim order: priority first, then submitters with the fewest running tasks."""
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.db import PROCESSING_STATUSES
+from app.scheduler import TaskScheduler
+
+START = datetime(2025, 3, 1, 9, 0)
+
+
+@pytest.fixture
+def scheduler():
+    db.Base.metadata.create_all(bind=db.engine)
+    with db.session_scope() as session:
+        session.query(db.Task).delete() # Only this test's tasks compete for the claim
+    return TaskScheduler(runner=lambda task_id: None, worker_id="test-node")
+
+
+def add_task(submit_time: datetime, to_email=None, user_id=None, worker_id=None) -> str:
+    task_id = str(uuid.uuid4())
+    status = PROCESSING_STATUSES[0] if worker_id else "submitted"
+    with db.session_scope() as session:
+        session.add(db.Task(task_id=task_id, status=status, submit_time=submit_time, last_update_time=submit_time,
+                            to_email=to_email, user_id=user_id, worker_id=worker_id, file_name="a.mp3"))
+    return task_id
+
+
+def test_submitter_with_fewer_running_tasks_goes_first(scheduler):
+    add_task(START, to_email="busy@example.com", worker_id="other-node")
+    add_task(START + timedelta(minutes=1), to_email="busy@example.com")
+    idle = add_task(START + timedelta(minutes=2), to_email="idle@example.com")
+    assert scheduler._claim_next() == idle
+
+
+def test_anonymous_tasks_share_one_running_count(scheduler):
+    # Neither user_id nor To email: counted under "anonymous" like submitter_key() does
+    add_task(START, worker_id="other-node")
+    add_task(START + timedelta(minutes=1), to_email="")
+    named = add_task(START + timedelta(minutes=2), to_email="named@example.com")
+    assert scheduler._claim_next() == named
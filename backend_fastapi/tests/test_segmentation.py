@@ -0,0 +1,44 @@
+"""Streaming segmentation against a stand-in for ffmpeg that writes the segment list and a lot of stderr."""
+import os
+import stat
+import sys
+import textwrap
+
+import pytest
+
+from app import segmentation
+from app.segmentation import stream_split_audio
+
+# Writes more stderr than a pipe buffer holds before listing any segment, like a noisy decoder would
+FAKE_FFMPEG = textwrap.dedent("""\
+    import os, sys
+    pattern = sys.argv[-1]
+    sys.stderr.write("warning: damaged frame\\n" * 20000)
+    sys.stderr.flush()
+    for index in range(3):
+        path = pattern % index
+        with open(path, "wb") as f:
+            f.write(b"segment")
+        print(os.path.basename(path), flush=True)
+    sys.exit(int(os.environ.get("FAKE_FFMPEG_EXIT", "0")))
+""")
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    script = tmp_path / "ffmpeg"
+    script.write_text(f"#!{sys.executable}\n{FAKE_FFMPEG}")
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setattr(segmentation, "FFMPEG_BINARY", str(script))
+
+
+def test_noisy_stderr_does_not_block_segmentation(tmp_path, fake_ffmpeg):
+    output_dir = str(tmp_path / "segments")
+    segments = list(stream_split_audio(str(tmp_path / "input.mp3"), output_dir))
+    assert [os.path.basename(path) for path in segments] == [f"segment_{index:05d}.mp3" for index in range(3)]
+
+
+def test_failure_reports_ffmpeg_stderr(tmp_path, fake_ffmpeg, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_EXIT", "1")
+    with pytest.raises(RuntimeError, match="damaged frame"):
+        list(stream_split_audio(str(tmp_path / "input.mp3"), str(tmp_path / "segments")))
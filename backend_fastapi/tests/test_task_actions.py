@@ -0,0 +1,64 @@
+"""Cancel and retry are only allowed with the task token handed out on submission."""
+import uuid
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import db, downloads, main
+from app.downloads import task_token
+
+
+@pytest.fixture(scope="module")
+def client():
+    db.Base.metadata.create_all(bind=db.engine)
+    return TestClient(main.app) # No lifespan: nothing claims the queued tasks
+
+
+@pytest.fixture
+def signing_key(monkeypatch):
+    monkeypatch.setattr(downloads, "DOWNLOAD_SIGNING_KEY", "test-key")
+    monkeypatch.setattr(downloads, "DOWNLOAD_ALLOW_UNSIGNED", False)
+
+
+def add_task(status: str = "submitted") -> str:
+    task_id = str(uuid.uuid4())
+    with db.session_scope() as session:
+        session.add(db.Task(task_id=task_id, status=status, submit_time=datetime.now(), last_update_time=datetime.now(),
+                            to_email="user@example.com", file_name="a.mp3"))
+    return task_id
+
+
+def status_of(task_id: str) -> str:
+    with db.session_scope() as session:
+        return session.get(db.Task, task_id).status
+
+
+def test_cancel_needs_the_task_token(client, signing_key):
+    task_id = add_task()
+    assert client.post(f"/api/tasks/{task_id}/cancel").status_code == 403
+    assert client.post(f"/api/tasks/{task_id}/cancel", headers={"X-Task-Token": task_token(add_task())}).status_code == 403
+    assert status_of(task_id) == "submitted"
+
+    response = client.post(f"/api/tasks/{task_id}/cancel", headers={"X-Task-Token": task_token(task_id)})
+    assert response.status_code == 200
+    assert status_of(task_id) == "cancelled"
+
+
+def test_retry_needs_the_task_token(client, signing_key):
+    task_id = add_task(status="failed")
+    assert client.post(f"/api/tasks/{task_id}/retry", headers={"X-Task-Token": "0" * 64}).status_code == 403
+    assert status_of(task_id) == "failed"
+    assert client.post(f"/api/tasks/{task_id}/retry", headers={"X-Task-Token": task_token(task_id)}).status_code == 200
+    assert status_of(task_id) == "submitted"
+
+
+def test_without_a_signing_key_actions_are_refused_unless_unsigned_access_is_allowed(client, monkeypatch):
+    monkeypatch.setattr(downloads, "DOWNLOAD_SIGNING_KEY", "")
+    monkeypatch.setattr(downloads, "DOWNLOAD_ALLOW_UNSIGNED", False)
+    task_id = add_task()
+    assert task_token(task_id) is None
+    assert client.post(f"/api/tasks/{task_id}/cancel").status_code == 403
+
+    monkeypatch.setattr(downloads, "DOWNLOAD_ALLOW_UNSIGNED", True)
+    assert client.post(f"/api/tasks/{task_id}/cancel").status_code == 200
@@ -0,0 +1,38 @@
+"""Active task list: the ETag covers both the change cursor and the age of the estimates."""
+import types
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import db, main
+
+
+@pytest.fixture(scope="module")
+def client():
+    db.Base.metadata.create_all(bind=db.engine)
+    return TestClient(main.app) # No lifespan: nothing claims the queued tasks
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = types.SimpleNamespace(value=60 * 20_000.0) # Start of an estimate period
+    monkeypatch.setattr(main, "time", types.SimpleNamespace(time=lambda: now.value))
+    monkeypatch.setattr(main, "TASK_LIST_ESTIMATE_REFRESH_SECONDS", 60.0)
+    return now
+
+
+def test_unchanged_list_is_not_modified_within_the_estimate_period(client, clock):
+    first = client.get("/api/tasks")
+    assert first.status_code == 200
+    clock.value += 30
+    again = client.get("/api/tasks", headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+
+
+def test_estimates_are_refreshed_after_the_estimate_period(client, clock):
+    first = client.get("/api/tasks")
+    clock.value += 60
+    later = client.get("/api/tasks", headers={"If-None-Match": first.headers["ETag"]})
+    assert later.status_code == 200
+    assert later.headers["ETag"] != first.headers["ETag"]
+    assert later.json()["cursor"] == first.json()["cursor"]
@@ -0,0 +1,118 @@
+"""Resumable upload sessions: serialized appends, the running digest and claiming a finished upload."""
+import asyncio
+import hashlib
+import os
+import tempfile
+
+import pytest
+from fastapi import HTTPException
+
+from app import db, uploads
+from app.uploads import (
+    append_to_upload_session, claim_completed_upload, complete_upload_session, create_upload_session,
+    get_upload_session,
+)
+
+
+@pytest.fixture(autouse=True)
+def tables():
+    db.Base.metadata.create_all(bind=db.engine, tables=[db.UploadSession.__table__])
+
+
+@pytest.fixture
+def target_dir():
+    return tempfile.mkdtemp(prefix="a2m-uploads-")
+
+
+async def body(*chunks, gate: asyncio.Event = None):
+    for number, chunk in enumerate(chunks):
+        if gate is not None and number == 1:
+            await gate.wait()
+        yield chunk
+
+
+def append_token(upload_id):
+    with db.session_scope() as session:
+        return session.get(db.UploadSession, upload_id).append_token
+
+
+def append(upload_id, offset, *chunks):
+    return asyncio.run(append_to_upload_session(upload_id, offset, body(*chunks)))
+
+
+def test_resumed_chunks_hash_to_the_digest_of_the_whole_file(target_dir):
+    session = create_upload_session(target_dir, "a.mp3", 9)
+    append(session["upload_id"], 0, b"abc")
+    append(session["upload_id"], 3, b"def")
+    completed = append(session["upload_id"], 6, b"ghi")
+    assert completed["status"] == "complete"
+    assert completed["sha256"] == hashlib.sha256(b"abcdefghi").hexdigest()
+
+
+def test_digest_is_recomputed_when_the_cached_one_is_behind(target_dir):
+    session = create_upload_session(target_dir, "a.mp3", None)
+    append(session["upload_id"], 0, b"abc")
+    # Another worker appended these bytes: this process' digest only covers the first three
+    with open(session["part_path"], "ab") as f:
+        f.write(b"def")
+    uploads._update_session(session["upload_id"], received_bytes=6)
+    append(session["upload_id"], 6, b"ghi")
+    completed = complete_upload_session(session["upload_id"])
+    assert completed["sha256"] == hashlib.sha256(b"abcdefghi").hexdigest()
+
+
+def test_bytes_written_past_the_recorded_offset_are_not_hashed(target_dir):
+    session = create_upload_session(target_dir, "a.mp3", None)
+    append(session["upload_id"], 0, b"abc")
+    # A retried chunk after a write that was never recorded
+    with open(session["part_path"], "ab") as f:
+        f.write(b"xyz")
+    append(session["upload_id"], 3, b"def")
+    completed = complete_upload_session(session["upload_id"])
+    assert completed["sha256"] == hashlib.sha256(b"abcdef").hexdigest()
+    with open(session["part_path"], "rb") as f:
+        assert f.read() == b"abcdef"
+
+
+def test_concurrent_chunks_for_one_session_are_rejected(target_dir):
+    session = create_upload_session(target_dir, "a.mp3", None)
+    upload_id = session["upload_id"]
+
+    async def race():
+        gate = asyncio.Event()
+        first = asyncio.ensure_future(append_to_upload_session(upload_id, 0, body(b"abc", b"def", gate=gate)))
+        while append_token(upload_id) is None:
+            await asyncio.sleep(0.01)
+        with pytest.raises(HTTPException) as rejected:
+            await append_to_upload_session(upload_id, 0, body(b"zzz"))
+        gate.set()
+        return rejected.value, await first
+
+    rejected, first = asyncio.run(race())
+    assert rejected.status_code == 409
+    assert "still being received" in rejected.detail
+    assert first["offset"] == 6
+    with open(session["part_path"], "rb") as f:
+        assert f.read() == b"abcdef"
+
+
+def test_stale_claim_is_taken_over(target_dir, monkeypatch):
+    session = create_upload_session(target_dir, "a.mp3", None)
+    uploads._update_session(session["upload_id"], append_token="dead-request")
+    with pytest.raises(HTTPException):
+        append(session["upload_id"], 0, b"abc")
+    monkeypatch.setattr(uploads, "UPLOAD_APPEND_TIMEOUT_SECONDS", -1)
+    assert append(session["upload_id"], 0, b"abc")["offset"] == 3
+
+
+def test_a_completed_upload_is_claimed_once(target_dir):
+    session = create_upload_session(target_dir, "a.mp3", 3)
+    append(session["upload_id"], 0, b"abc")
+    first = os.path.join(target_dir, "first.mp3")
+    _, size, sha256 = claim_completed_upload(session["upload_id"], first)
+    assert (size, sha256) == (3, hashlib.sha256(b"abc").hexdigest())
+    with pytest.raises(HTTPException) as second:
+        claim_completed_upload(session["upload_id"], os.path.join(target_dir, "second.mp3"))
+    assert second.value.status_code == 409
+    assert os.path.isfile(first)
+    assert get_upload_session(session["upload_id"])["status"] == "consumed"